@@ -0,0 +1,203 @@
+import math
+
+import numpy as np
+
+# Probability bands, from the top: (lower bound, label).
+BANDS = ((0.8, "保"), (0.4, "稳"), (0.1, "冲"), (0.0, "难"))
+
+# Year-to-year noise of a cut-off rank (in log-rank units) assumed even for a
+# program whose past cut-offs were perfectly stable; ~12% either way.
+BASE_LOG_RANK_SPREAD = 0.12
+# Older years count less: weight = RECENCY_DECAY ** (years before the latest).
+RECENCY_DECAY = 0.7
+# Scale factor that makes the logistic curve track the normal CDF (max error < 0.01).
+_LOGISTIC_SCALE = 1.702
+
+
+class RankTable:
+    """
+    One year's score-rank distribution (一分一段表): the cumulative rank, i.e.
+    the number of candidates at or above each score.
+    """
+
+    def __init__(self, year, pairs):
+        data = np.asarray(pairs, dtype=float).reshape(-1, 2)
+        if not len(data):
+            raise ValueError(f"empty score_rank table for {year}")
+        order = np.argsort(data[:, 0])
+        self.year = year
+        self.scores = data[order, 0] # ascending
+        # Cumulative ranks can't grow with the score; clean up any bumps in the source.
+        self.ranks = np.minimum.accumulate(data[order, 1])
+        self._ranks_asc = self.ranks[::-1]
+        self._scores_desc = self.scores[::-1]
+        self.total = float(self.ranks[0])
+
+    def rank_for_score(self, scores):
+        """Rank (worst position) of candidates with the given scores."""
+        scores = np.asarray(scores, dtype=float)
+        i = np.searchsorted(self.scores, scores, side='right') - 1
+        ranks = self.ranks[np.clip(i, 0, len(self.ranks) - 1)]
+        return np.where(i < 0, self.total, ranks)
+
+    def score_for_rank(self, ranks):
+        """The score a candidate at the given rank had."""
+        j = np.searchsorted(self._ranks_asc, np.asarray(ranks, dtype=float), side='left')
+        return self._scores_desc[np.clip(j, 0, len(self._scores_desc) - 1)]
+
+
+_BAND_BOUNDS = np.array([bound for bound, _ in reversed(BANDS)]) # ascending
+_BAND_LABELS = np.array([label for _, label in BANDS])
+
+
+def _band_indexes(probabilities):
+    """Index into BANDS for each probability: the number of bounds above it."""
+    return len(BANDS) - np.searchsorted(_BAND_BOUNDS, probabilities, side='right')
+
+
+class AdmissionModel:
+    """
+    Admission estimates for one (province, stream), built once from the
+    score-line file and evaluated for a student in a single vectorized pass.
+
+    Each program's past cut-off ranks are first rescaled to the latest year's
+    cohort size (等比位次), then summarized as a recency-weighted mean and
+    spread of log-rank. A student's probability for every program is the
+    normal CDF (logistic approximation) of how far their log-rank sits above
+    that mean, in units of the spread.
+    """
+
+    def __init__(self, tables, admissions):
+        """
+        tables: {year: [[score, cumulative rank], ...]}
+        admissions: {year: [{"school", "major", "min_rank" and/or "min_score"}, ...]}
+        """
+        self.tables = {year: RankTable(year, pairs) for year, pairs in tables.items()}
+        self.latest_table = self.tables[max(self.tables)] if self.tables else None
+        self.years = sorted(set(admissions) | set(self.tables))
+
+        program_ids = {}
+        cells = [] # (program, year index, cut-off rank)
+        for year, rows in admissions.items():
+            year_index = self.years.index(year)
+            table = self.tables.get(year)
+            for row in rows:
+                min_rank = row.get("min_rank")
+                if min_rank is None and row.get("min_score") is not None and table is not None:
+                    min_rank = float(table.rank_for_score(row["min_score"]))
+                if not min_rank or min_rank <= 0:
+                    continue
+                key = (row["school"], row.get("major") or "")
+                program = program_ids.setdefault(key, len(program_ids))
+                cells.append((program, year_index, float(min_rank)))
+
+        self.schools = [school for school, _ in program_ids]
+        self.majors = [major for _, major in program_ids]
+        self._programs_by_school = {}
+        for index, school in enumerate(self.schools):
+            self._programs_by_school.setdefault(school, []).append(index)
+        cutoffs = np.full((len(program_ids), len(self.years)), np.nan)
+        if cells:
+            programs, year_indexes, ranks = (np.array(column) for column in zip(*cells))
+            cutoffs[programs.astype(int), year_indexes.astype(int)] = ranks
+        self.cutoff_ranks = cutoffs
+
+        # Rescale each year's cut-offs to the latest cohort, then collapse the year axis.
+        scale = np.ones(len(self.years))
+        if self.latest_table is not None:
+            for i, year in enumerate(self.years):
+                if year in self.tables:
+                    scale[i] = self.latest_table.total / self.tables[year].total
+        log_ranks = np.log(cutoffs * scale)
+        weights = np.where(np.isnan(log_ranks), 0.0,
+                           RECENCY_DECAY ** (len(self.years) - 1 - np.arange(len(self.years))))
+        weight_sums = weights.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nansum(log_ranks * weights, axis=1) / weight_sums
+            variance = np.nansum(weights * (np.nan_to_num(log_ranks) - mean[:, None]) ** 2, axis=1) / weight_sums
+        self.mean_log_rank = mean
+        self.spread = np.sqrt(np.nan_to_num(variance) + BASE_LOG_RANK_SPREAD ** 2)
+        self.years_seen = (weights > 0).sum(axis=1)
+        self._order_by_cutoff = np.argsort(mean) # most selective first
+
+    def __len__(self):
+        return len(self.schools)
+
+    def student_rank(self, value, kind="rank"):
+        """The student's rank in the latest year, from a rank or (with a rank table) a score."""
+        if value is None:
+            return None
+        value = float(value)
+        if kind == "score":
+            if self.latest_table is None:
+                return None
+            return float(self.latest_table.rank_for_score(value))
+        return value if value > 0 else None
+
+    def equivalent_scores(self, rank):
+        """{year: score} a candidate at this rank (scaled to each year's cohort) had."""
+        if not self.tables:
+            return {}
+        latest_total = self.latest_table.total
+        return {year: int(table.score_for_rank(rank * table.total / latest_total))
+                for year, table in sorted(self.tables.items(), reverse=True)}
+
+    def probabilities(self, rank):
+        """Admission probability for every program, in one pass."""
+        z = (self.mean_log_rank - math.log(rank)) / self.spread
+        return 1.0 / (1.0 + np.exp(-_LOGISTIC_SCALE * z))
+
+    def evaluate(self, rank):
+        """(probabilities, band labels) for every program."""
+        p = self.probabilities(rank)
+        return p, _BAND_LABELS[_band_indexes(p)]
+
+    def _describe(self, index, p):
+        name = f"{self.schools[index]} {self.majors[index]}".strip()
+        cutoffs = [f"{year}年{int(r)}" for year, r in zip(self.years, self.cutoff_ranks[index]) if not np.isnan(r)]
+        label = next(label for bound, label in BANDS if p >= bound)
+        return f"- {name}: {label} {round(p * 100)}%（最低位次 {' / '.join(reversed(cutoffs))}）"
+
+    def summarize(self, rank, text="", per_band=3, max_mentioned=8):
+        """
+        A compact prompt block: the student's equivalent scores, band counts over
+        the whole province, the programs of schools named in `text`, and the most
+        selective programs in each band.
+        """
+        if not len(self):
+            return ""
+        p = self.probabilities(rank)
+        bands = _band_indexes(p)
+        lines = []
+        equivalents = self.equivalent_scores(rank)
+        position = f"- 考生位次: {int(rank)}"
+        if equivalents:
+            position += "（同位次约等于 " + " / ".join(f"{y}年{s}分" for y, s in equivalents.items()) + "）"
+        lines.append(position)
+        counts = np.bincount(bands, minlength=len(BANDS))
+        lines.append("- 全省院校专业: " + " / ".join(f"{label} {count}" for (_, label), count in zip(BANDS, counts)))
+
+        mentioned = [i for school, programs in self._programs_by_school.items()
+                     if school and school in text for i in programs]
+        if mentioned:
+            mentioned.sort(key=lambda i: -p[i])
+            lines.append("- 考生提到的院校:")
+            lines.extend("  " + self._describe(i, p[i]) for i in mentioned[:max_mentioned])
+
+        ordered_bands = bands[self._order_by_cutoff]
+        for band, (_, label) in enumerate(BANDS[:-1]):
+            picks = self._order_by_cutoff[ordered_bands == band][:per_band]
+            if len(picks):
+                lines.append(f"- {label}（最难考的{len(picks)}个）:")
+                lines.extend("  " + self._describe(i, p[i]) for i in picks)
+        return "\n".join(lines)
+
+    def stats(self):
+        return {"years": self.years, "programs": len(self), "rank_tables": len(self.tables)}
+
+
+def build_model(score_rank, admissions):
+    """An AdmissionModel from per-year data of one stream, or None if there is no admissions data."""
+    if not admissions:
+        return None
+    return AdmissionModel(score_rank, admissions)
@@ -1,11 +1,33 @@
+import io
 import os
 import json
 import traceback
 from datetime import datetime, timezone, timedelta
-from flask import Flask, request, jsonify, send_from_directory, Response
-from openai import OpenAI
+from flask import Flask, request, jsonify, abort, send_file, Response
 from dotenv import load_dotenv
+import time
+import atexit
 import threading
+from score_index import ScoreLineIndex
+from counter_store import create_counter_store
+from rate_limiter import create_rate_limiter
+from usage_journal import UsageJournal
+from session_store import SessionStore, is_valid_session_id
+from upstream import UpstreamScheduler, UpstreamBusyError, TRANSIENT_ERRORS
+from upstream_router import UpstreamRouter, NoEndpointAvailable, parse_endpoints
+from completion_cache import CompletionCache, make_cache_key
+from sse import DeltaCoalescer, stream_frames, with_event_id
+from stream_buffer import StreamRegistry, ReplayUnavailable, parse_event_id
+from think_filter import ThinkFilter, strip_think
+from batch_runner import BatchRunner
+from session_analytics import SessionAnalytics
+from context_window import ContextWindow
+from prompts import SYSTEM_PROMPT, PROMPT_TEMPLATE_VERSION, build_user_prompt
+from invitation_codes import InvitationRegistry
+from metrics import MetricsRegistry
+from static_assets import StaticAssetStore
+from report_export import (EXPORT_FORMATS, REPORT_TITLE, ReportCache, RenderPool, ReportNotFound, PdfRendererUnavailable,
+                           content_hash, final_report, render as render_report)
 
 load_dotenv() # Load environment variables from .env file
 
@@ -13,21 +35,124 @@ load_dotenv() # Load environment variables from .env file
 # --- App Configuration ---
 DAILY_LIMIT = int(os.environ.get("DAILY_LIMIT", 100))
 RATE_LIMIT_PER_MINUTE = int(os.environ.get("RATE_LIMIT_PER_MINUTE", 10))
+CODE_RATE_LIMIT_PER_MINUTE = int(os.environ.get("CODE_RATE_LIMIT_PER_MINUTE", 0)) # 0 disables the per-code limit
 CONTEXT_TURNS = int(os.environ.get("CONTEXT_TURNS", 3))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 6000)) # estimated prompt tokens; 0 = turns only
 LOAD_SCORE_DATA = os.environ.get("LOAD_SCORE_DATA", "true").lower() == "true"
+SCORE_INDEX_CHECK_INTERVAL = float(os.environ.get("SCORE_INDEX_CHECK_INTERVAL", 5))
+INVITATION_CODES_CHECK_INTERVAL = float(os.environ.get("INVITATION_CODES_CHECK_INTERVAL", 5))
+# Shared counter store for usage and rate limits across gunicorn workers.
+# Leave unset to keep counters in-process (single worker).
+REDIS_URL = os.environ.get("REDIS_URL")
+USAGE_KEY_TTL = 2 * 24 * 3600 # Daily usage keys outlive their day so late readers still see them.
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", 2))
+USAGE_FLUSH_THRESHOLD = int(os.environ.get("USAGE_FLUSH_THRESHOLD", 20))
+SESSION_TTL_DAYS = float(os.environ.get("SESSION_TTL_DAYS", 0)) # 0 keeps sessions forever
+SESSION_REAP_INTERVAL = float(os.environ.get("SESSION_REAP_INTERVAL", 3600))
+SESSION_CACHE_MAX_MB = float(os.environ.get("SESSION_CACHE_MAX_MB", 32))
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get("UPSTREAM_MAX_CONCURRENCY", 64)) # per worker process; 0 = unlimited
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get("UPSTREAM_QUEUE_TIMEOUT", 30))
+UPSTREAM_MAX_QUEUE = int(os.environ.get("UPSTREAM_MAX_QUEUE", 256)) # waiting requests per worker; 0 = unbounded
+UPSTREAM_PRIORITY_BOOST = float(os.environ.get("UPSTREAM_PRIORITY_BOOST", 10)) # queue seconds skipped per priority level
+UPSTREAM_QUEUE_EVENT_INTERVAL = float(os.environ.get("UPSTREAM_QUEUE_EVENT_INTERVAL", 1))
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", 120))
+UPSTREAM_MAX_RETRIES = int(os.environ.get("UPSTREAM_MAX_RETRIES", 2))
+UPSTREAM_HEDGE_MS = float(os.environ.get("UPSTREAM_HEDGE_MS", 0)) # 0 disables hedged requests
+UPSTREAM_FAILURE_THRESHOLD = int(os.environ.get("UPSTREAM_FAILURE_THRESHOLD", 3))
+UPSTREAM_COOLDOWN = float(os.environ.get("UPSTREAM_COOLDOWN", 30))
+COMPLETION_CACHE_ENABLED = os.environ.get("COMPLETION_CACHE_ENABLED", "false").lower() == "true"
+COMPLETION_CACHE_MAX_MB = float(os.environ.get("COMPLETION_CACHE_MAX_MB", 64))
+COMPLETION_CACHE_TTL = float(os.environ.get("COMPLETION_CACHE_TTL", 86400))
+COMPLETION_CACHE_HITS_COUNT_QUOTA = os.environ.get("COMPLETION_CACHE_HITS_COUNT_QUOTA", "true").lower() == "true"
+COMPLETION_CACHE_REPLAY_CHUNK_CHARS = int(os.environ.get("COMPLETION_CACHE_REPLAY_CHUNK_CHARS", 24))
+COMPLETION_CACHE_REPLAY_INTERVAL_MS = float(os.environ.get("COMPLETION_CACHE_REPLAY_INTERVAL_MS", 15))
+SSE_COALESCE_MS = float(os.environ.get("SSE_COALESCE_MS", 50)) # 0 sends every token as its own frame
+SSE_COALESCE_BYTES = int(os.environ.get("SSE_COALESCE_BYTES", 1024))
+SSE_SPLIT_THINK = os.environ.get("SSE_SPLIT_THINK", "false").lower() == "true"
+STREAM_RESUME_ENABLED = os.environ.get("STREAM_RESUME_ENABLED", "true").lower() == "true"
+STREAM_BUFFER_TTL = float(os.environ.get("STREAM_BUFFER_TTL", 300)) # seconds a finished generation stays resumable
+STREAM_BUFFER_MAX_MB = float(os.environ.get("STREAM_BUFFER_MAX_MB", 64)) # all generations, per worker
+STREAM_BUFFER_STREAM_KB = float(os.environ.get("STREAM_BUFFER_STREAM_KB", 512)) # ring size of one generation
+STATIC_ASSETS = [name.strip() for name in os.environ.get("STATIC_ASSETS", "index.html,script.js,style.css").split(",") if name.strip()]
+STATIC_CHECK_INTERVAL = float(os.environ.get("STATIC_CHECK_INTERVAL", 5))
+REPORT_CACHE_MAX_MB = float(os.environ.get("REPORT_CACHE_MAX_MB", 256))
+REPORT_RENDER_WORKERS = int(os.environ.get("REPORT_RENDER_WORKERS", 2)) # PDF renders at once per worker
+BATCH_MAX_RECORDS = int(os.environ.get("BATCH_MAX_RECORDS", 500)) # per /api/batch request
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4)) # consultations at once per batch
+BATCH_MAX_RETRIES = int(os.environ.get("BATCH_MAX_RETRIES", 3))
+BATCH_RETRY_BACKOFF = float(os.environ.get("BATCH_RETRY_BACKOFF", 2)) # seconds, doubled per retry
+BATCH_PRIORITY = int(os.environ.get("BATCH_PRIORITY", -1)) # upstream queue priority; below interactive users
+ANALYTICS_REFRESH_INTERVAL = float(os.environ.get("ANALYTICS_REFRESH_INTERVAL", 300)) # 0: refresh from cron instead
+ANALYTICS_WORKERS = int(os.environ.get("ANALYTICS_WORKERS", 1)) # processes the refresh command parses with
 
 # --- File Paths ---
+STATIC_ROOT = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = '_data'
 SESSIONS_DIR = 'sessions'
+REPORT_CACHE_DIR = 'report_cache'
 SCORE_LINES_DIR = os.path.join(DATA_DIR, 'scorelines')
 USAGE_FILE = os.path.join(DATA_DIR, 'usage.json')
 USERS_FILE = os.path.join(DATA_DIR, 'users.json')
+ANALYTICS_FILE = os.path.join(DATA_DIR, 'analytics.json')
+ANALYTICS_CACHE_FILE = os.path.join(DATA_DIR, 'analytics_cache.json')
 
 # --- In-memory State ---
-usage_data = {}
-rate_limit_data = {} # { "ip": {"timestamp": time, "count": n} }
-valid_invitation_codes = []
 app_lock = threading.Lock()
+init_lock = threading.Lock()
+app_initialized = False
+counter_store = create_counter_store(REDIS_URL)
+ip_rate_limiter = create_rate_limiter(counter_store, RATE_LIMIT_PER_MINUTE, prefix="rate:ip")
+code_rate_limiter = create_rate_limiter(counter_store, CODE_RATE_LIMIT_PER_MINUTE, prefix="rate:code")
+invitation_registry = InvitationRegistry(USERS_FILE, check_interval=INVITATION_CODES_CHECK_INTERVAL)
+score_index = ScoreLineIndex(SCORE_LINES_DIR, check_interval=SCORE_INDEX_CHECK_INTERVAL)
+# Write-behind mirror of usage.json; the authoritative counts live in counter_store.
+usage_journal = UsageJournal(USAGE_FILE, flush_interval=USAGE_FLUSH_INTERVAL, flush_threshold=USAGE_FLUSH_THRESHOLD)
+atexit.register(usage_journal.close)
+session_store = SessionStore(
+    SESSIONS_DIR,
+    ttl=SESSION_TTL_DAYS * 86400,
+    cache_max_bytes=int(SESSION_CACHE_MAX_MB * 1024 * 1024),
+    cache_turns=max(CONTEXT_TURNS, 1)
+)
+upstream_scheduler = UpstreamScheduler(UPSTREAM_MAX_CONCURRENCY, queue_timeout=UPSTREAM_QUEUE_TIMEOUT,
+                                       max_queue=UPSTREAM_MAX_QUEUE, priority_boost=UPSTREAM_PRIORITY_BOOST)
+upstream_router = None
+upstream_router_config = None
+context_window = ContextWindow(CONTEXT_TOKEN_BUDGET, CONTEXT_TURNS)
+completion_cache = CompletionCache(int(COMPLETION_CACHE_MAX_MB * 1024 * 1024), COMPLETION_CACHE_TTL)
+# Only these files are served; everything else in the repo (data, images, sessions) is not.
+static_assets = StaticAssetStore(STATIC_ROOT, STATIC_ASSETS, check_interval=STATIC_CHECK_INTERVAL)
+report_cache = ReportCache(REPORT_CACHE_DIR, int(REPORT_CACHE_MAX_MB * 1024 * 1024))
+# PDF layout is CPU-bound; it runs on a few OS threads so it doesn't freeze the worker's streams.
+report_render_pool = RenderPool(REPORT_RENDER_WORKERS)
+# Parsing runs in a child process; the server itself only reads the summary file.
+session_analytics = SessionAnalytics(SESSIONS_DIR, ANALYTICS_CACHE_FILE, ANALYTICS_FILE, workers=ANALYTICS_WORKERS)
+# Generations run decoupled from their request so a dropped client can reattach with Last-Event-ID.
+stream_registry = StreamRegistry(STREAM_BUFFER_TTL, int(STREAM_BUFFER_MAX_MB * 1024 * 1024),
+                                 int(STREAM_BUFFER_STREAM_KB * 1024))
+# Registered after the usage journal so it runs first: let generations finish and count before the last flush.
+atexit.register(stream_registry.join, UPSTREAM_TIMEOUT)
+
+# --- Metrics ---
+# Per worker process; exported in the Prometheus text format at /api/metrics.
+metrics = MetricsRegistry("gaokao")
+handler_requests = metrics.counter("handler_requests", "Consultation requests by outcome.", ["outcome"])
+stage_seconds = metrics.histogram("handler_stage_seconds", "Time spent in each stage of /api/handler.", ["stage"])
+prompt_tokens = metrics.histogram("prompt_tokens", "Estimated tokens sent upstream per request.",
+                                  buckets=(250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 12000, 16000, 32000))
+upstream_deltas = metrics.counter("upstream_deltas", "Content deltas (roughly tokens) received from the upstream.")
+upstream_chars = metrics.counter("upstream_chars", "Characters of completion text received from the upstream.")
+sse_bytes = metrics.counter("sse_bytes", "Bytes of SSE frames written to clients.")
+quota_hits = metrics.counter("quota_hits", "Requests refused for an exhausted daily quota.", ["scope"])
+report_exports = metrics.counter("report_exports", "Report downloads by format and cache result.", ["format", "cache"])
+batch_records = metrics.counter("batch_records", "Batch consultation records by status.", ["status"])
+stream_resumes = metrics.counter("stream_resumes", "Reconnects with Last-Event-ID by result.", ["result"])
+metrics.gauge("upstream_in_flight", "Upstream requests currently streaming.",
+              lambda: upstream_scheduler.stats()["in_flight"])
+metrics.gauge("upstream_waiting", "Requests waiting for an upstream slot.",
+              lambda: upstream_scheduler.stats()["waiting"])
+metrics.gauge("stream_buffer_bytes", "Bytes of SSE frames held for resumable streams.",
+              lambda: stream_registry.stats()["buffered_bytes"])
 
 
 # --- Time & Date Helpers ---
@@ -37,214 +162,323 @@ def get_beijing_today_str():
     return datetime.now(beijing_tz).strftime('%Y-%m-%d')
 
 # --- Initialization Functions ---
-def load_or_initialize_data():
-    """Loads all necessary data from files into memory."""
-    global usage_data, valid_invitation_codes
+def reset_daily_usage():
+    """Seeds today's usage counter from the usage file; at startup and on each day rollover."""
     with app_lock:
-        # Load Usage Data
+        # Load Usage Data, replaying the last flushed snapshot
         today_str = get_beijing_today_str()
-        try:
-            if os.path.exists(USAGE_FILE):
-                with open(USAGE_FILE, 'r') as f:
-                    data = json.load(f)
-                if today_str not in data:
-                    usage_data = {today_str: 0}
-                else:
-                    usage_data = data
-            else:
-                usage_data = {today_str: 0}
-                _write_usage_file()
-        except (json.JSONDecodeError, FileNotFoundError):
-            usage_data = {today_str: 0}
-            _write_usage_file()
-        print(f"Usage initialized for {today_str}: {usage_data.get(today_str, 0)} requests.")
+        file_usage = usage_journal.load(today_str)
+        # Seed the counter store from the file; a no-op if another worker already did.
+        counter_store.seed(_usage_key(today_str), file_usage, USAGE_KEY_TTL)
+        print(f"Usage initialized for {today_str}: {get_current_usage_count(today_str)} requests.")
+
+def init_app():
+    """One-time startup work for this process; later calls return at once."""
+    global app_initialized
+    if app_initialized:
+        return
+    with init_lock:
+        if app_initialized:
+            return
+        reset_daily_usage()
 
         # Load Users/Invitation Codes
-        try:
-            if os.path.exists(USERS_FILE):
-                with open(USERS_FILE, 'r') as f:
-                    users = json.load(f)
-                    valid_invitation_codes = users.get("valid_codes", [])
-            else:
-                # Create a default users file if it doesn't exist
-                valid_invitation_codes = ["DEFAULT_CODE"]
-                with open(USERS_FILE, 'w') as f:
-                    json.dump({"valid_codes": valid_invitation_codes}, f, indent=2)
-        except (json.JSONDecodeError, FileNotFoundError):
-            valid_invitation_codes = []
-        print(f"Loaded {len(valid_invitation_codes)} invitation codes.")
+        if not os.path.exists(USERS_FILE):
+            # Create a default users file if it doesn't exist
+            with open(USERS_FILE, 'w') as f:
+                json.dump({"valid_codes": ["DEFAULT_CODE"]}, f, indent=2)
+        invitation_registry.reload()
 
         # Create sessions directory if it doesn't exist
         os.makedirs(SESSIONS_DIR, exist_ok=True)
         os.makedirs(SCORE_LINES_DIR, exist_ok=True)
 
+        # Move any flat or legacy session files into shards without delaying startup.
+        session_store.migrate_in_background()
+        session_store.start_reaper(SESSION_REAP_INTERVAL)
+        session_analytics.start_refresher(ANALYTICS_REFRESH_INTERVAL)
+
+        # Build the score-line index up front so the first request doesn't pay for it.
+        if LOAD_SCORE_DATA:
+            score_index.reload()
+        # Likewise the compressed static assets.
+        static_assets.reload()
+        app_initialized = True
+
 # --- Usage & Rate Limit Helpers ---
+def _usage_key(today_str):
+    return f"usage:{today_str}"
+
+def get_current_usage_count(today_str):
+    """Reads today's usage count from the counter store."""
+    return counter_store.get(_usage_key(today_str))
+
 def get_current_usage():
     """Gets the current usage count for today."""
     today_str = get_beijing_today_str()
-    if today_str not in usage_data:
-        load_or_initialize_data()
-    return usage_data.get(today_str, 0)
+    if not usage_journal.has_day(today_str):
+        reset_daily_usage()
+    return get_current_usage_count(today_str)
 
 def increment_usage():
-    """Increments usage count and writes to file."""
-    global usage_data
-    with app_lock:
-        today_str = get_beijing_today_str()
-        if today_str not in usage_data:
-            usage_data = {today_str: 1}
-        else:
-            usage_data[today_str] = usage_data.get(today_str, 0) + 1
-        _write_usage_file()
-        return usage_data[today_str]
-
-def _write_usage_file():
-    """Writes the current usage_data to the file (internal, needs lock)."""
-    os.makedirs(os.path.dirname(USAGE_FILE), exist_ok=True)
-    with open(USAGE_FILE, 'w') as f:
-        json.dump(usage_data, f, indent=2)
-
-def check_rate_limit(ip):
-    """Checks if an IP has exceeded the rate limit. Returns True if limited."""
-    global rate_limit_data
-    with app_lock:
-        current_time = datetime.now().timestamp()
-        
-        # Clean up old entries
-        for old_ip in list(rate_limit_data.keys()):
-            if current_time - rate_limit_data[old_ip]['timestamp'] > 60:
-                del rate_limit_data[old_ip]
-
-        if ip not in rate_limit_data:
-            rate_limit_data[ip] = {"timestamp": current_time, "count": 1}
-            return False
-        
-        if current_time - rate_limit_data[ip]['timestamp'] > 60:
-            rate_limit_data[ip] = {"timestamp": current_time, "count": 1}
-            return False
-        
-        rate_limit_data[ip]['count'] += 1
-        return rate_limit_data[ip]['count'] > RATE_LIMIT_PER_MINUTE
-
-# --- Session History Helpers ---
-def load_session_history(session_id):
-    """Loads chat history for a given session ID."""
-    session_file = os.path.join(SESSIONS_DIR, f"{session_id}.json")
-    if os.path.exists(session_file):
-        try:
-            with open(session_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            return []
-    return []
-
-def save_session_history(session_id, history):
-    """Saves chat history for a given session ID."""
-    session_file = os.path.join(SESSIONS_DIR, f"{session_id}.json")
-    with open(session_file, 'w', encoding='utf-8') as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
-
-def load_score_data(province, stream):
+    """Increments usage count in the counter store; the usage file is flushed in the background."""
+    today_str = get_beijing_today_str()
+    new_usage = counter_store.incr(_usage_key(today_str), USAGE_KEY_TTL)
+    if not counter_store.shared:
+        # With a shared store (Redis) workers must not race on rewriting the file.
+        usage_journal.record(today_str, new_usage)
+    return new_usage
+
+def _code_usage_key(today_str, invitation_code):
+    return f"usage:{today_str}:code:{invitation_code}"
+
+def validate_invitation_code(invitation_code):
+    """Returns (CodePolicy, None) for a usable code, or (None, error message)."""
+    policy = invitation_registry.lookup(invitation_code)
+    if policy is None:
+        return None, "无效的邀请码。"
+    if policy.expired(get_beijing_today_str()):
+        return None, "该邀请码已过期。"
+    return policy, None
+
+def operator_check():
     """
-    Loads score line data for a given province and stream from a single file
-    named after the province, e.g., '江苏.json'.
+    None if the request carries a code with "admin": true in users.json (in the
+    JSON body or an X-Invitation-Code header), else the 403 response to send.
     """
-    if not LOAD_SCORE_DATA or not province:
+    body = request.get_json(silent=True) or {}
+    invitation_code = request.headers.get('X-Invitation-Code') or (body.get('invitationCode') if isinstance(body, dict) else None)
+    code_policy, code_error = validate_invitation_code(invitation_code)
+    if code_policy is None:
+        return jsonify({"error": code_error}), 403
+    if not code_policy.admin:
+        return jsonify({"error": "该邀请码没有查看运营数据的权限。"}), 403
+    return None
+
+def code_quota_exhausted(invitation_code, policy):
+    """True if a code with a per-code daily limit has used it up today."""
+    if not policy.daily_limit:
+        return False
+    return counter_store.get(_code_usage_key(get_beijing_today_str(), invitation_code)) >= policy.daily_limit
+
+def increment_code_usage(invitation_code, policy):
+    if policy.daily_limit:
+        counter_store.incr(_code_usage_key(get_beijing_today_str(), invitation_code), USAGE_KEY_TTL)
+
+def reserve_code_usage(invitation_code, policy):
+    """
+    Takes one use of a code's daily limit up front, atomically in the counter
+    store, so concurrent requests in any worker can't overshoot it. Returns the
+    key to hand to release_code_usage() if the use doesn't happen, False if the
+    limit is used up, or None for a code without a limit.
+    """
+    if not policy.daily_limit:
         return None
+    key = _code_usage_key(get_beijing_today_str(), invitation_code)
+    if counter_store.incr(key, USAGE_KEY_TTL) > policy.daily_limit:
+        counter_store.decr(key, USAGE_KEY_TTL)
+        return False
+    return key
+
+def release_code_usage(key):
+    """Gives back a use taken by reserve_code_usage()."""
+    if key:
+        counter_store.decr(key, USAGE_KEY_TTL)
+
+def get_upstream_router():
+    """
+    Returns the router for the configured upstream endpoints, or None if none are
+    configured. It is rebuilt only when the configuration changes, so endpoint
+    health and latency history carry over between requests.
+    """
+    global upstream_router, upstream_router_config
+    config = (
+        os.environ.get("OPENAI_ENDPOINTS"), os.environ.get("OPENAI_API_KEY"), os.environ.get("OPENAI_API_BASE"),
+        os.environ.get("OPENAI_MODEL_NAME", "gemini-2.5-flash"), UPSTREAM_HEDGE_MS, UPSTREAM_FAILURE_THRESHOLD,
+        UPSTREAM_COOLDOWN, UPSTREAM_TIMEOUT, UPSTREAM_MAX_RETRIES,
+    )
+    if config != upstream_router_config:
+        specs = parse_endpoints(*config[:4])
+        upstream_router = UpstreamRouter(
+            specs, hedge_after=UPSTREAM_HEDGE_MS / 1000, failure_threshold=UPSTREAM_FAILURE_THRESHOLD,
+            cooldown=UPSTREAM_COOLDOWN, timeout=UPSTREAM_TIMEOUT, max_retries=UPSTREAM_MAX_RETRIES
+        ) if specs else None
+        upstream_router_config = config
+    return upstream_router
+
+def check_rate_limit(ip, invitation_code=None):
+    """
+    Checks the per-IP and, if enabled, per-invitation-code sliding-window limits.
+    Returns True if limited.
+    """
+    if ip_rate_limiter.hit(ip):
+        return True
+    return bool(invitation_code) and code_rate_limiter.hit(invitation_code)
 
-    # For new gaokao, map to traditional streams
-    if "物理" in stream:
-        stream_key = "理科"
-    elif "历史" in stream:
-        stream_key = "文科"
-    else: # For provinces that don't distinguish
-        stream_key = stream
+# --- Session History Helpers ---
+def load_session_history(session_id, max_turns=CONTEXT_TURNS):
+    """Loads the last `max_turns` turns of chat history for a given session ID."""
+    try:
+        history = session_store.load_recent(session_id, max_turns)
+    except OSError as e:
+        print(f"Error loading session {session_id}: {e}")
+        return []
+    # Turns saved before reasoning was filtered while streaming may still carry think tags.
+    return [
+        {**m, "content": strip_think(m["content"])}
+        if m.get("role") == "assistant" and "think>" in m.get("content", "") else m
+        for m in history
+    ]
 
-    score_data = {}
-    filepath = os.path.join(SCORE_LINES_DIR, f"{province}.json")
+def save_session_turn(session_id, user_message, assistant_message):
+    """Appends one user/assistant turn to a session's history."""
+    session_store.append_turn(session_id, [
+        {"role": "user", "content": user_message},
+        {"role": "assistant", "content": assistant_message}
+    ])
 
-    if not os.path.exists(filepath):
-        print(f"Score data file not found for province: {province}")
+def lookup_score_entry(province, stream):
+    """Returns the indexed ScoreEntry (batches + prompt block + admission model), or None."""
+    if not LOAD_SCORE_DATA or not province:
         return None
 
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            if data.get('province') == province:
-                for yearly_entry in data.get('yearly_data', []):
-                    year = yearly_entry.get('year', '未知年份')
-                    if stream_key in yearly_entry.get('batches', {}):
-                        score_data[year] = yearly_entry['batches'][stream_key]
-    except (json.JSONDecodeError, Exception) as e:
-        print(f"Error loading or parsing score data for {province}: {e}")
-    
-    return score_data if score_data else None
+    entry = score_index.get(province, stream)
+    if entry is None:
+        print(f"Score data not found for province: {province}, stream: {stream}")
+    return entry
+
+def load_score_data(province, stream):
+    """
+    Returns the year -> batches score line data for a given province and stream,
+    served from the in-memory index of `_data/scorelines/<province>.json` files.
+    """
+    entry = lookup_score_entry(province, stream)
+    return entry.batches if entry else None
 
 
-app = Flask(__name__, static_url_path='', static_folder='.')
+app = Flask(__name__, static_folder=None)
 
 def get_system_prompt():
-    """Generates the static system prompt for the AI."""
-    return "\n\n".join([
-        "你是一位顶级的、资深的、充满智慧的高考志愿填报专家。你的任务是为一位正在纠结中的高三学生或家长，提供一份专业、客观、有深度、有温度的志愿对比分析报告。",
-        "**重要指令**: 在你输出最终的分析报告之前，请务必先进行一步深度思考。将你的思考过程、分析逻辑、以及数据检索的步骤，完整地包含在 `<think>` 和 `</think>` 标签之间。这部分内容是给专业用户看的，可以帮助他们理解你的决策过程。思考结束后，再输出面向用户的、完整的Markdown格式报告。",
-        "**你的任务和要求:**",
-        "1.  **深度思考**:",
-        "    *   第一步: 识别用户的核心问题和纠结的点。",
-        "    *   第二步: 基于你掌握的知识，并结合用户提供的结构化参考数据（如招生计划、分数线等）进行分析。",
-        "    *   第三步: 设定评估维度，并简述每个维度的评估逻辑。",
-        "2.  **正式报告**:",
-        "    *   **创建方案PK记分卡:** 这是报告的核心！请创建一个Markdown表格，从以下维度对核心方案进行对比打分（满分5星，用 ★★★☆☆ 表示）：录取概率、学校实力/声誉、专业前景/钱景、城市发展/生活品质、个人兴趣/困惑匹配度。",
-        "    *   **详细文字解读:** 针对记分卡中的每一项，展开详细的、有理有据的文字分析。",
-        "    *   **“对话式”分析与建议:** 模拟与学生面对面对话的口吻，设身处地地理解他的困惑。",
-        "    *   **最终结论总结:** 给出一个清晰的、总结性的结论。",
-        "**输出格式要求:**",
-        "- **必须**先输出`<think>`标签包裹的思考内容，然后再输出正式报告。",
-        "- **绝对禁止**在正式报告中重复或提及任何`<think>`标签内的思考过程。正式报告必须是直接面向最终用户的、干净的、独立的分析内容。",
-        "- 正式报告**必须**是完整的Markdown格式。",
-        "- 正式报告**必须**包含“方案PK记- 记分卡”表格。",
-        "- **格式示例**: `<think>这是我的思考过程...</think># 高考志愿对比分析报告\n## 方案PK记分卡\n| 评估维度 | ...`"
-    ])
+    """Returns the static system prompt for the AI."""
+    return SYSTEM_PROMPT
 
-def prepare_user_prompt(user_data, score_data=None):
-    """Prepares the user's input part of the prompt."""
-    user_info = user_data.get('rawText', '')
-    province = user_data.get('province', '未知')
-    rank = user_data.get('rank', '未知')
-
-    prompt_parts = [
-        "**学生背景:**",
-        f"- 省份: {province}",
-        f"- 分数/位次: {rank}",
-        "- 他本次的原始笔记和困惑如下:",
-        "---",
-        user_info,
-        "---"
-    ]
-    
-    if score_data:
-        score_info = json.dumps(score_data, ensure_ascii=False, indent=2)
-        prompt_parts.extend([
-            "**参考数据 (历年分数线):**",
-            "---",
-            score_info,
-            "---"
-        ])
+def prepare_user_prompt(user_data, score_block=None, admission_summary=None):
+    """Prepares the user's input part of the prompt, with an optional precompiled score block."""
+    return build_user_prompt(user_data, score_block, admission_summary)
 
-    return "\n\n".join(prompt_parts)
+def estimate_admissions(user_data, score_entry):
+    """Precomputed admission odds for the prompt, or None if the score lines carry no admissions data."""
+    model = score_entry.model if score_entry else None
+    if model is None:
+        return None
+    # Older frontends only say which one it is in the raw text.
+    kind = user_data.get('scoreType') or ('score' if '分数:' in user_data.get('rawText', '') else 'rank')
+    try:
+        rank = model.student_rank(user_data.get('rank'), kind)
+    except (TypeError, ValueError):
+        return None
+    if not rank:
+        return None
+    return model.summarize(rank, user_data.get('rawText', ''))
+
+# Upstream errors worth retrying a batch record for; anything else fails the record.
+BATCH_RETRY_ERRORS = TRANSIENT_ERRORS + (NoEndpointAvailable, UpstreamBusyError)
+
+def prepare_batch():
+    """The part of startup the batch command needs: the score-line index."""
+    if LOAD_SCORE_DATA:
+        score_index.reload()
+
+def run_consultation(user_data):
+    """
+    One consultation outside /api/handler, for batch mode: the same prompt as an
+    initial request (no session history), waiting for an upstream slot behind
+    interactive users. Returns the report text, reasoning removed.
+    """
+    score_entry = lookup_score_entry(user_data.get('province'), user_data.get('stream'))
+    admission_summary = estimate_admissions(user_data, score_entry)
+    if score_entry:
+        user_prompt = prepare_user_prompt(user_data, score_entry.prompt_block, admission_summary)
+    else:
+        user_prompt = prepare_user_prompt(user_data)
+    messages_for_api, _ = context_window.build(get_system_prompt(), [], user_prompt)
+    router = get_upstream_router()
+    if router is None:
+        raise RuntimeError("OPENAI_API_KEY or OPENAI_API_BASE is not configured")
+    with upstream_scheduler.slot(BATCH_PRIORITY):
+        with router.open_stream(messages_for_api) as routed:
+            text = "".join(routed)
+    return strip_think(text)
+
+def replay_cached_completion(text):
+    """Re-emits a cached completion in chunks, paced like a live stream."""
+    interval = COMPLETION_CACHE_REPLAY_INTERVAL_MS / 1000
+    step = max(COMPLETION_CACHE_REPLAY_CHUNK_CHARS, 1)
+    for i in range(0, len(text), step):
+        if i and interval > 0:
+            time.sleep(interval)
+        yield text[i:i + step]
+
+def metered_frames(frames):
+    """Passes SSE frames through, counting the bytes written to the client."""
+    try:
+        for frame in frames:
+            # Token frames are ASCII (json.dumps escapes the text), so only error frames get encoded.
+            sse_bytes.inc(len(frame) if frame.isascii() else len(frame.encode('utf-8')))
+            yield frame
+    finally:
+        # Close the inner stream right away when the client disconnects.
+        frames.close()
+
+def buffered_frames(buffer, after=0):
+    """Follows a generation's buffer from event `after`, numbering each frame for Last-Event-ID."""
+    try:
+        for seq, frame in buffer.follow(after):
+            yield with_event_id(frame, buffer.event_id(seq))
+    except ReplayUnavailable as e:
+        print(f"Cannot resume stream: {e}")
+        error_message = {'error': '连接中断时间过长，部分回答内容已无法恢复，请重新提交。'}
+        yield f"event: error\ndata: {json.dumps(error_message, ensure_ascii=False)}\n\n"
+
+def resume_stream(last_event_id, invitation_code, session_id):
+    """Reattaches a reconnecting client to its generation, replaying what it missed."""
+    parsed = parse_event_id(last_event_id)
+    buffer = stream_registry.get(parsed[0], (invitation_code, session_id)) if parsed else None
+    if buffer is None:
+        stream_resumes.inc(result="not_found")
+        return jsonify({"error": "该次回答已过期或不存在，请重新提交。"}), 410
+    stream_resumes.inc(result="resumed")
+    return Response(metered_frames(buffered_frames(buffer, parsed[1])), mimetype='text/event-stream')
+
+def quota_exhausted_response(current_usage):
+    error_msg = {"error": f"非常抱歉，今日的免费体验名额（{DAILY_LIMIT}次）已被抢完！请您明日再来。"}
+    return jsonify({**error_msg, "usage": {"used": current_usage, "limit": DAILY_LIMIT}}), 429
+
+def code_quota_exhausted_response(policy):
+    return jsonify({"error": f"该邀请码今日的使用次数（{policy.daily_limit}次）已用完，请明日再来。"}), 429
+
+@app.before_request
+def ensure_initialized():
+    # gunicorn imports the app in each worker without calling anything, so the first request does it.
+    init_app()
 
 # --- Static File Routes ---
+def static_response(name):
+    """Serves an allowlisted asset from memory, precompressed and with conditional-GET support."""
+    result = static_assets.respond(name, request.headers.get('Accept-Encoding'),
+                                   request.headers.get('If-None-Match'), request.args.get('v'))
+    if result is None:
+        abort(404)
+    status, body, headers = result
+    return Response(body, status=status, headers=headers)
+
 @app.route('/')
 def serve_index():
-    return send_from_directory('.', 'index.html')
-
-@app.route('/_data/<path:path>')
-def serve_data_files(path):
-    return send_from_directory('_data', path)
+    return static_response('index.html')
 
 @app.route('/<path:path>')
 def serve_static(path):
-    return send_from_directory('.', path)
+    return static_response(path)
 
 # --- API Routes ---
 @app.route('/api/usage', methods=['GET'])
@@ -255,6 +489,48 @@ def get_usage():
     except Exception as e:
         return jsonify({"used": "N/A", "limit": "N/A", "error": str(e)}), 500
 
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """Internal counters for operators, for codes with "admin": true (sent as X-Invitation-Code)."""
+    denied = operator_check()
+    if denied is not None:
+        return denied
+    return jsonify({
+        "usage_journal": usage_journal.stats(),
+        "invitation_codes": invitation_registry.stats(),
+        "session_store": session_store.stats(),
+        "upstream": upstream_scheduler.stats(),
+        "upstream_endpoints": upstream_router.stats() if upstream_router else None,
+        "completion_cache": completion_cache.stats() if COMPLETION_CACHE_ENABLED else None,
+        "context_window": context_window.stats(),
+        "static_assets": static_assets.stats(),
+        "report_cache": report_cache.stats(),
+        "report_render": report_render_pool.stats(),
+        "stream_buffers": stream_registry.stats() if STREAM_RESUME_ENABLED else None,
+        "session_analytics": session_analytics.stats(),
+        "prompt_template_version": PROMPT_TEMPLATE_VERSION,
+    })
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus scrape endpoint for this worker's timings and counters."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/analytics', methods=['POST'])
+def get_analytics():
+    """Session totals per province and day for operators, as last computed by session_analytics.py."""
+    denied = operator_check()
+    if denied is not None:
+        return denied
+    try:
+        summary = session_analytics.read_summary()
+    except (OSError, ValueError) as e:
+        print(f"Error reading session analytics: {e}")
+        return jsonify({"error": "服务器内部错误：无法读取会话统计。"}), 500
+    if summary is None:
+        return jsonify({"error": "会话统计尚未生成，请稍后再试。"}), 503
+    return jsonify(summary)
+
 @app.route('/api/verify_code', methods=['POST'])
 def verify_code():
     body = request.get_json(silent=True)
@@ -262,34 +538,145 @@ def verify_code():
         return jsonify({"success": False, "error": "无效的请求格式。"}), 400
     
     invitation_code = body.get('invitationCode')
-    if invitation_code in valid_invitation_codes:
+    code_policy, code_error = validate_invitation_code(invitation_code)
+    if code_policy is not None:
         return jsonify({"success": True})
     else:
-        return jsonify({"success": False, "error": "无效的邀请码。"}), 403
+        return jsonify({"success": False, "error": code_error}), 403
+
+@app.route('/api/report', methods=['POST'])
+def export_report():
+    """Downloads a session's latest report as Markdown, HTML or PDF, rendered on the server."""
+    body = request.get_json(silent=True)
+    if not body:
+        return jsonify({"error": "无效的请求格式。"}), 400
+    code_policy, code_error = validate_invitation_code(body.get('invitationCode'))
+    if code_policy is None:
+        return jsonify({"error": code_error}), 403
+    session_id = body.get('sessionId')
+    if not is_valid_session_id(session_id):
+        return jsonify({"error": "无效的会话ID。"}), 400
+    fmt = body.get('format', 'pdf')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "不支持的导出格式。"}), 400
+
+    try:
+        question, report = final_report(session_store.load_recent(session_id, 1))
+    except ReportNotFound:
+        return jsonify({"error": "没有可导出的报告。"}), 404
+    except OSError as e:
+        print(f"Error loading session {session_id} for export: {e}")
+        return jsonify({"error": "服务器内部错误：无法读取会话记录。"}), 500
+
+    digest = content_hash(fmt, question, report)
+    name = ReportCache.file_name(session_id, digest, fmt)
+    data = report_cache.get(name)
+    cache_result = "hit" if data is not None else "miss"
+    if data is None:
+        try:
+            with stage_seconds.time(stage="report_render"):
+                if fmt == "pdf":
+                    data = report_render_pool.run(render_report, fmt, question, report)
+                else:
+                    data = render_report(fmt, question, report)
+        except PdfRendererUnavailable as e:
+            print(f"PDF export unavailable: {e}")
+            return jsonify({"error": "服务器暂不支持导出PDF。"}), 501
+        report_cache.put(name, data)
+    report_exports.inc(format=fmt, cache=cache_result)
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    # Served from memory: the cached file may be evicted by another request at any time.
+    # A POST is never answered 304, but the ETag still lets clients tell renderings apart.
+    return send_file(io.BytesIO(data), mimetype=mimetype, as_attachment=True,
+                     download_name=f"{REPORT_TITLE}.{extension}", etag=digest, conditional=False, max_age=0)
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """
+    Runs consultations for a list of students and streams one JSON line per
+    result as each finishes, then a summary line. Only for codes with batch
+    access; each record counts against the code's own daily limit, not the
+    site-wide one. A record takes its use before it starts and gives it back if
+    it fails, so concurrent batches for one code never exceed its limit.
+    """
+    body = request.get_json(silent=True)
+    if not body:
+        return jsonify({"error": "无效的请求格式。"}), 400
+    invitation_code = body.get('invitationCode')
+    code_policy, code_error = validate_invitation_code(invitation_code)
+    if code_policy is None:
+        return jsonify({"error": code_error}), 403
+    if not code_policy.batch:
+        return jsonify({"error": "该邀请码没有批量咨询权限。"}), 403
+    records = body.get('records')
+    if not isinstance(records, list) or not records or not all(isinstance(r, dict) for r in records):
+        return jsonify({"error": "请求格式错误或缺少'records'字段。"}), 400
+    if len(records) > BATCH_MAX_RECORDS:
+        return jsonify({"error": f"单次最多提交{BATCH_MAX_RECORDS}条记录。"}), 400
+
+    def consult(user_data):
+        reservation = reserve_code_usage(invitation_code, code_policy)
+        if reservation is False:
+            raise RuntimeError("daily limit of this invitation code reached")
+        try:
+            return run_consultation(user_data)
+        except BaseException:
+            release_code_usage(reservation)
+            raise
+
+    runner = BatchRunner(consult, concurrency=BATCH_CONCURRENCY, max_retries=BATCH_MAX_RETRIES,
+                         backoff=BATCH_RETRY_BACKOFF, retry_on=BATCH_RETRY_ERRORS)
+    items = [(str(r.get('id') or i), r.get('userInput', r)) for i, r in enumerate(records, 1)]
+
+    def lines():
+        for result in runner.run(items, total=len(items)):
+            batch_records.inc(status=result["status"])
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+        yield json.dumps({"summary": runner.progress()}) + "\n"
+
+    return Response(lines(), mimetype='application/x-ndjson')
 
 @app.route('/api/handler', methods=['POST'])
 def handler():
     # --- Security & Rate Limiting ---
     body = request.get_json(silent=True)
     if not body:
+        handler_requests.inc(outcome="bad_request")
         return jsonify({"error": "无效的请求格式。"}), 400
 
     # 1. Invitation Code Check
     invitation_code = body.get('invitationCode')
-    if not invitation_code or invitation_code not in valid_invitation_codes:
-        return jsonify({"error": "无效的邀请码。"}), 403
+    code_policy, code_error = validate_invitation_code(invitation_code)
+    if code_policy is None:
+        handler_requests.inc(outcome="invalid_code")
+        return jsonify({"error": code_error}), 403
+
+    # A reconnect picks up the generation it lost instead of starting (and paying for) a new one.
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id and STREAM_RESUME_ENABLED:
+        return resume_stream(last_event_id, invitation_code, body.get('sessionId'))
 
-    # 2. IP-based Rate Limiting
+    # 2. IP and Invitation-Code Rate Limiting
     client_ip = request.remote_addr
-    if check_rate_limit(client_ip):
+    if check_rate_limit(client_ip, invitation_code):
+        handler_requests.inc(outcome="rate_limited")
         return jsonify({"error": "您的请求过于频繁，请稍后再试。"}), 429
 
-    # 3. Daily Usage Limit
+    # 3. Daily Usage Limits (site-wide, then per code)
+    quota_error = None
     try:
         current_usage = get_current_usage()
         if current_usage >= DAILY_LIMIT:
-            error_msg = {"error": f"非常抱歉，今日的免费体验名额（{DAILY_LIMIT}次）已被抢完！请您明日再来。"}
-            return jsonify({**error_msg, "usage": {"used": current_usage, "limit": DAILY_LIMIT}}), 429
+            quota_error = quota_exhausted_response(current_usage)
+            quota_scope = "site"
+        elif code_quota_exhausted(invitation_code, code_policy):
+            quota_error = code_quota_exhausted_response(code_policy)
+            quota_scope = "code"
+        # Cache hits that don't count against the quota can still be served below.
+        if quota_error is not None and not (COMPLETION_CACHE_ENABLED and not COMPLETION_CACHE_HITS_COUNT_QUOTA):
+            quota_hits.inc(scope=quota_scope)
+            handler_requests.inc(outcome="quota_exhausted")
+            return quota_error
     except Exception as e:
         print(f"Error during usage check: {e}")
         pass # Allow to proceed if usage check fails, but log it.
@@ -297,16 +684,21 @@ def handler():
     # --- Main Logic ---
     try:
         if 'userInput' not in body:
+            handler_requests.inc(outcome="bad_request")
             return jsonify({"error": "请求格式错误或缺少'userInput'字段。"}), 400
         
         user_data = body.get('userInput', {})
         session_id = body.get('sessionId')
+        if session_id and not is_valid_session_id(session_id):
+            handler_requests.inc(outcome="bad_request")
+            return jsonify({"error": "无效的会话ID。"}), 400
         is_follow_up = user_data.get('isFollowUp', False)
         
         # Load history if session_id is provided
         history = []
         if session_id:
-            history = load_session_history(session_id)
+            with stage_seconds.time(stage="load_history"):
+                history = load_session_history(session_id)
 
         # If it's a follow-up, the prompt is just the raw text.
         # Otherwise, prepare the full prompt with context.
@@ -314,78 +706,160 @@ def handler():
             user_prompt = user_data.get('rawText', '')
         else:
             # Load score data only for initial requests
-            score_data = load_score_data(user_data.get('province'), user_data.get('stream'))
-            user_prompt = prepare_user_prompt(user_data, score_data)
+            with stage_seconds.time(stage="score_lookup"):
+                score_entry = lookup_score_entry(user_data.get('province'), user_data.get('stream'))
+            with stage_seconds.time(stage="admission_estimate"):
+                admission_summary = estimate_admissions(user_data, score_entry)
+            with stage_seconds.time(stage="prompt_build"):
+                if score_entry:
+                    user_prompt = prepare_user_prompt(user_data, score_entry.prompt_block, admission_summary)
+                else:
+                    user_prompt = prepare_user_prompt(user_data)
+
+        # --- Prepare messages for OpenAI API, including history ---
+        system_prompt = get_system_prompt()
+        with stage_seconds.time(stage="context_build"):
+            messages_for_api, context_stats = context_window.build(system_prompt, history, user_prompt)
+        prompt_tokens.observe(context_stats.total_tokens)
+        if context_stats.turns_truncated or context_stats.turns_dropped:
+            print(f"Context for session {session_id}: {context_stats.total_tokens} tokens, "
+                  f"{context_stats.turns_included} turns kept ({context_stats.turns_truncated} shortened), "
+                  f"{context_stats.turns_dropped} dropped")
+        model_name = os.environ.get("OPENAI_MODEL_NAME", "gemini-2.5-flash")
+
+        # --- Completion cache (initial consultations only) ---
+        cache_key = None
+        cached_response = None
+        if COMPLETION_CACHE_ENABLED and not is_follow_up:
+            cache_key = make_cache_key(model_name, messages_for_api)
+            cached_response = completion_cache.get(cache_key)
+        if quota_error is not None and cached_response is None:
+            quota_hits.inc(scope=quota_scope)
+            handler_requests.inc(outcome="quota_exhausted")
+            return quota_error
 
     except FileNotFoundError:
+        handler_requests.inc(outcome="error")
         return jsonify({"error": "服务器内部错误：关键数据文件丢失。"}), 500
     except Exception as e:
+        handler_requests.inc(outcome="error")
         error_trace = traceback.format_exc()
         print(f"UNHANDLED EXCEPTION IN HANDLER: {error_trace}")
         return jsonify({"error": f"服务器在准备请求时发生错误: {e}"}), 500
 
     def stream_response(p):
+        outcome = "disconnected" # kept if the stream is closed early
+        started = time.perf_counter()
         try:
-            # --- Update usage and prepare for streaming ---
-            new_usage = increment_usage()
-            yield f"event: usage\ndata: {json.dumps({'used': new_usage, 'limit': DAILY_LIMIT})}\n\n"
-
-            # --- Prepare messages for OpenAI API, including history ---
-            system_prompt = get_system_prompt()
-            messages_for_api = [{"role": "system", "content": system_prompt}]
-            messages_for_api.extend(history[-CONTEXT_TURNS*2:])
-            messages_for_api.append({"role": "user", "content": user_prompt})
-
-            # --- Stream response from OpenAI ---
-            api_key = os.environ.get("OPENAI_API_KEY")
-            base_url = os.environ.get("OPENAI_API_BASE")
-            if not api_key or not base_url:
-                error_message = {'error': '服务器环境变量 OPENAI_API_KEY 或 OPENAI_API_BASE 未配置。'}
-                yield f"event: error\ndata: {json.dumps(error_message, ensure_ascii=False)}\n\n"
+            if cached_response is not None:
+                # --- Replay a cached completion without calling the upstream ---
+                if COMPLETION_CACHE_HITS_COUNT_QUOTA:
+                    new_usage = increment_usage()
+                    increment_code_usage(invitation_code, code_policy)
+                else:
+                    new_usage = get_current_usage()
+                yield f"event: usage\ndata: {json.dumps({'used': new_usage, 'limit': DAILY_LIMIT})}\n\n"
+                think_filter = ThinkFilter()
+                yield from stream_frames(replay_cached_completion(cached_response), DeltaCoalescer(0),
+                                         think_filter, split_think=SSE_SPLIT_THINK)
+                if session_id:
+                    with stage_seconds.time(stage="save_history"):
+                        save_session_turn(session_id, user_data.get('rawText', ''), think_filter.report)
+                outcome = "cached"
+                yield f"event: end\ndata: End of stream\n\n"
                 return
-            
-            client = OpenAI(api_key=api_key, base_url=base_url)
-            model_name = os.environ.get("OPENAI_MODEL_NAME", "gemini-2.5-flash")
-            
-            stream = client.chat.completions.create(
-                messages=messages_for_api,
-                model=model_name,
-                stream=True
-            )
-
-            # --- Handle streaming and save history ---
-            assistant_response_full = ""
-            for chunk in stream:
-                content = chunk.choices[0].delta.content
-                if content:
-                    assistant_response_full += content
-                    yield f"event: message\ndata: {json.dumps(content)}\n\n"
-            
-            if session_id:
-                # Strip the <think> block before saving to history
-                assistant_response_clean = assistant_response_full
-                think_start = assistant_response_full.find('<think>')
-                think_end = assistant_response_full.find('</think>')
-                if think_start != -1 and think_end != -1:
-                    assistant_response_clean = assistant_response_full[think_end + len('</think>'):].strip()
-
-                new_history = history + [
-                    {"role": "user", "content": user_data.get('rawText', '')},
-                    {"role": "assistant", "content": assistant_response_clean}
-                ]
-                save_session_history(session_id, new_history)
-
-            yield f"event: end\ndata: End of stream\n\n"
 
+            # Wait in line for an upstream slot before charging the daily quota.
+            ticket = upstream_scheduler.enqueue(code_policy.priority)
+            try:
+                with stage_seconds.time(stage="queue_wait"):
+                    for position, eta in upstream_scheduler.wait(ticket, UPSTREAM_QUEUE_EVENT_INTERVAL):
+                        yield f"event: queued\ndata: {json.dumps({'position': position, 'eta_seconds': eta})}\n\n"
+
+                # --- Update usage and prepare for streaming ---
+                new_usage = increment_usage()
+                increment_code_usage(invitation_code, code_policy)
+                yield f"event: usage\ndata: {json.dumps({'used': new_usage, 'limit': DAILY_LIMIT})}\n\n"
+
+                # --- Stream response from OpenAI ---
+                router = get_upstream_router()
+                if router is None:
+                    outcome = "error"
+                    error_message = {'error': '服务器环境变量 OPENAI_API_KEY 或 OPENAI_API_BASE 未配置。'}
+                    yield f"event: error\ndata: {json.dumps(error_message, ensure_ascii=False)}\n\n"
+                    return
+
+                # --- Handle streaming and save history ---
+                # The raw text (reasoning included) is only kept when it is going into the cache.
+                response_parts = [] if cache_key else None
+                think_filter = ThinkFilter()
+                # Fails over (and hedges, if enabled) until the first token; closing the stream
+                # returns its connection to the pool, even if the client went away.
+                upstream_started = time.perf_counter()
+                with router.open_stream(messages_for_api) as routed:
+                    stage_seconds.observe(time.perf_counter() - upstream_started, stage="upstream_ttft")
+
+                    def deltas():
+                        count = chars = 0
+                        try:
+                            for content in routed:
+                                count += 1
+                                chars += len(content)
+                                if response_parts is not None:
+                                    response_parts.append(content)
+                                yield content
+                        finally:
+                            upstream_deltas.inc(count)
+                            upstream_chars.inc(chars)
+
+                    yield from stream_frames(deltas(), DeltaCoalescer(SSE_COALESCE_MS, SSE_COALESCE_BYTES),
+                                             think_filter, split_think=SSE_SPLIT_THINK, abort=routed.abort)
+                stage_seconds.observe(time.perf_counter() - upstream_started, stage="upstream_stream")
+
+                if cache_key:
+                    completion_cache.put(cache_key, "".join(response_parts))
+
+                if session_id:
+                    # Only the report goes to history; the reasoning is never re-sent as context.
+                    with stage_seconds.time(stage="save_history"):
+                        save_session_turn(session_id, user_data.get('rawText', ''), think_filter.report)
+
+                outcome = "completed"
+                yield f"event: end\ndata: End of stream\n\n"
+            finally:
+                upstream_scheduler.release(ticket)
+
+        except UpstreamBusyError:
+            outcome = "busy"
+            error_message = {'error': '当前咨询人数过多，请稍后再试。'}
+            yield f"event: error\ndata: {json.dumps(error_message, ensure_ascii=False)}\n\n"
+        except TRANSIENT_ERRORS + (NoEndpointAvailable,) as e:
+            outcome = "upstream_unavailable"
+            print(f"Upstream unavailable: {e!r}")
+            error_message = {'error': 'AI服务暂时繁忙，请稍后再试。'}
+            yield f"event: error\ndata: {json.dumps(error_message, ensure_ascii=False)}\n\n"
         except Exception as e:
+            outcome = "error"
             error_trace = traceback.format_exc()
             print(f"UNHANDLED EXCEPTION IN STREAM: {error_trace}")
             error_message = { "error": f"服务器在与AI通信时发生错误: {e}", "traceback": error_trace }
             yield f"event: error\ndata: {json.dumps(error_message, ensure_ascii=False)}\n\n"
-
-    return Response(stream_response(user_prompt), mimetype='text/event-stream')
+        finally:
+            stage_seconds.observe(time.perf_counter() - started, stage="stream_total")
+            handler_requests.inc(outcome=outcome)
+
+    frames = stream_response(user_prompt)
+    buffer = stream_registry.start((invitation_code, session_id), frames) if STREAM_RESUME_ENABLED else None
+    if buffer is not None:
+        # The generation now runs to the end on its own, even if this client goes away.
+        frames = buffered_frames(buffer)
+    response = Response(metered_frames(frames), mimetype='text/event-stream')
+    response.headers['X-Prompt-Tokens'] = str(context_stats.total_tokens)
+    response.headers['X-History-Turns'] = str(context_stats.turns_included)
+    response.headers['X-Prompt-Version'] = PROMPT_TEMPLATE_VERSION
+    return response
 
 if __name__ == "__main__":
-    load_or_initialize_data()
+    init_app()
     port = int(os.environ.get("PORT", 5000))
     app.run(debug=True, host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,236 @@
+"""
+Batch consultations for a whole cohort.
+
+Reads student records from a CSV or JSONL file, runs one consultation per
+record on a bounded thread pool (each one spends its time waiting on the
+upstream, so threads are enough), retries transient failures with
+exponential backoff, and appends every result to a JSONL file as it lands.
+Records whose result is already in the output file are skipped, so an
+interrupted run picks up where it stopped when started again.
+
+Input, one record per row/line:
+    CSV:   a header row; `id` (optional) plus userInput fields such as
+           province, stream, rank, scoreType, rawText
+    JSONL: {"id": ..., "userInput": {...}} or a bare userInput object
+Records without an id are numbered by their position in the file.
+
+Usage:
+    python batch_runner.py students.csv
+    python batch_runner.py students.jsonl -o results.jsonl --concurrency 8 --retries 3
+"""
+import os
+import csv
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+INT_FIELDS = ("rank",)
+
+
+def _csv_user_input(row):
+    user_input = {key: value for key, value in row.items() if key != "id" and value not in (None, "")}
+    for key in INT_FIELDS:
+        if key in user_input:
+            try:
+                user_input[key] = int(float(user_input[key]))
+            except ValueError:
+                pass
+    return user_input
+
+
+def read_records(path):
+    """Yields (record id, userInput dict) from a .csv or .jsonl file."""
+    if path.lower().endswith(".csv"):
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            for number, row in enumerate(csv.DictReader(f), 1):
+                yield str(row.get("id") or number), _csv_user_input(row)
+        return
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            user_input = record.get("userInput", record) if isinstance(record, dict) else None
+            if not isinstance(user_input, dict):
+                raise ValueError(f"{path}:{number}: expected a JSON object")
+            yield str(record.get("id") or number), user_input
+
+
+def load_checkpoint(path):
+    """Ids that already have a successful result in an output file (a torn last line is ignored)."""
+    done = set()
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if result.get("status") == "ok":
+                    done.add(result["id"])
+    except FileNotFoundError:
+        pass
+    return done
+
+
+class BatchRunner:
+    """
+    Runs `consult(user_input)` for each record with at most `concurrency`
+    running at once and only a few more read ahead, so a huge input file is
+    never loaded whole.
+
+    Exceptions of a type in `retry_on` are retried up to `max_retries` times,
+    sleeping `backoff * 2**n` seconds (capped at `max_backoff`, with jitter)
+    in between; any other exception fails the record at once. A failed record
+    becomes a result with status "failed" rather than stopping the batch.
+    """
+
+    def __init__(self, consult, concurrency=4, max_retries=3, backoff=1.0, max_backoff=30.0,
+                 retry_on=(Exception,), sleep=time.sleep, clock=time.monotonic):
+        self.consult = consult
+        self.concurrency = max(concurrency, 1)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = retry_on
+        self._sleep = sleep
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.total = None
+        self.started_at = None
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retries = 0
+
+    def _run_one(self, record_id, user_input):
+        started = self._clock()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                report = self.consult(user_input)
+                return {"id": record_id, "status": "ok", "report": report, "attempts": attempt,
+                        "seconds": round(self._clock() - started, 3)}
+            except self.retry_on as e:
+                if attempt > self.max_retries:
+                    error = e
+                    break
+                with self._lock:
+                    self.retries += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                self._sleep(delay * (0.5 + random.random() / 2))
+            except Exception as e:
+                error = e
+                break
+        return {"id": record_id, "status": "failed", "error": f"{type(error).__name__}: {error}",
+                "attempts": attempt, "seconds": round(self._clock() - started, 3)}
+
+    def run(self, records, skip=(), total=None):
+        """
+        Yields one result dict per record not in `skip`, in completion order.
+        `total` (the number of records to run, for the ETA) is optional.
+        """
+        self.total = total
+        self.started_at = self._clock()
+        pending = set()
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            for record_id, user_input in records:
+                if record_id in skip:
+                    self.skipped += 1
+                    continue
+                if len(pending) >= self.concurrency * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from self._collect(finished)
+                pending.add(pool.submit(self._run_one, record_id, user_input))
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from self._collect(finished)
+
+    def _collect(self, futures):
+        for future in futures:
+            result = future.result()
+            if result["status"] == "ok":
+                self.completed += 1
+            else:
+                self.failed += 1
+            yield result
+
+    def progress(self):
+        """Counts so far, throughput (records/s) and, if the total is known, the ETA in seconds."""
+        elapsed = self._clock() - self.started_at if self.started_at is not None else 0.0
+        processed = self.completed + self.failed
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = round(max(self.total - processed, 0) / rate, 1)
+        return {"total": self.total, "completed": self.completed, "failed": self.failed,
+                "skipped": self.skipped, "retries": self.retries, "elapsed_seconds": round(elapsed, 1),
+                "records_per_second": round(rate, 3), "eta_seconds": eta}
+
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if not f.tell():
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def run_to_file(runner, input_path, output_path, progress_interval=5.0, report=print):
+    """
+    Runs every record of `input_path` not yet done in `output_path`, appending
+    results as they complete. Returns the final progress dict.
+    """
+    done = load_checkpoint(output_path)
+    total = sum(1 for record_id, _ in read_records(input_path) if record_id not in done)
+    last_report = time.monotonic()
+    with open(output_path, 'a', encoding='utf-8') as out:
+        if not _ends_with_newline(output_path):
+            out.write("\n") # a run killed mid-write left a torn last line; start ours on a fresh one
+        for result in runner.run(read_records(input_path), skip=done, total=total):
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush() # each line is a checkpoint
+            if time.monotonic() - last_report >= progress_interval:
+                last_report = time.monotonic()
+                report(_format_progress(runner.progress()))
+    progress = runner.progress()
+    report(_format_progress(progress))
+    return progress
+
+
+def _format_progress(p):
+    eta = f", ETA {p['eta_seconds']}s" if p["eta_seconds"] is not None else ""
+    return (f"Batch: {p['completed'] + p['failed']}/{p['total']} done ({p['completed']} ok, {p['failed']} failed; "
+            f"{p['skipped']} skipped as already done), {p['records_per_second']} records/s{eta}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="CSV or JSONL file of userInput records")
+    parser.add_argument("-o", "--output", help="JSONL results file (default: <input>.results.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=4, help="consultations running at once")
+    parser.add_argument("--retries", type=int, default=3, help="retries per record on transient upstream errors")
+    parser.add_argument("--backoff", type=float, default=2.0, help="first retry delay in seconds, doubled each time")
+    parser.add_argument("--progress-interval", type=float, default=5.0, help="seconds between progress lines")
+    args = parser.parse_args(argv)
+    output = args.output or os.path.splitext(args.input)[0] + ".results.jsonl"
+
+    # The app module reads its configuration from the environment / .env, like the server does.
+    import app
+    app.prepare_batch()
+    runner = BatchRunner(app.run_consultation, concurrency=args.concurrency, max_retries=args.retries,
+                         backoff=args.backoff, retry_on=app.BATCH_RETRY_ERRORS)
+    progress = run_to_file(runner, args.input, output, args.progress_interval)
+    print(f"Results written to {output}")
+    return 1 if progress["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+Admission engine benchmark.
+
+Builds a synthetic whole-province data set — a 一分一段 table and per-program
+minimum ranks for several years — and times the AdmissionModel used by the
+handler against a plain Python loop computing the same estimates program by
+program, which is what doing this per request without the engine amounts to.
+Reports the model build time (paid once per score-line reload) and the
+per-student time for the probability pass and for the full prompt summary.
+
+Usage:
+    python bench/bench_admission.py
+    python bench/bench_admission.py --schools 2000 --majors 15 --students 200 --json
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from admission_engine import AdmissionModel, BANDS, BASE_LOG_RANK_SPREAD, RECENCY_DECAY
+
+LOGISTIC_SCALE = 1.702
+
+
+def synthetic_province(schools, majors, years, cohort, seed):
+    """({year: [[score, rank], ...]}, {year: [program rows]}) for one stream."""
+    rng = random.Random(seed)
+    tables, admissions = {}, {}
+    latest = 2024
+    bases = [(f"大学{s:04d}", f"专业{m:02d}", math.exp(rng.uniform(math.log(50), math.log(cohort))))
+             for s in range(schools) for m in range(majors)]
+    for offset in range(years):
+        year = latest - offset
+        size = cohort * (1 - 0.03 * offset)
+        # Roughly normal scores: rank grows fastest around the middle.
+        tables[year] = [[score, int(size / (1 + math.exp(-(600 - score) / 40)))] for score in range(300, 751)]
+        admissions[year] = [{"school": school, "major": major,
+                             "min_rank": int(base * (1 - 0.03 * offset) * math.exp(rng.gauss(0, 0.15)))}
+                            for school, major, base in bases]
+    return tables, admissions
+
+
+def python_estimate(tables, admissions, rank):
+    """The same estimate without the engine: one Python pass over every program and year."""
+    latest_year = max(tables)
+    totals = {year: max(rank for _, rank in pairs) for year, pairs in tables.items()}
+    years = sorted(admissions)
+    per_program = {}
+    for year in years:
+        weight = RECENCY_DECAY ** (years[-1] - year)
+        scale = totals[latest_year] / totals[year]
+        for row in admissions[year]:
+            key = (row["school"], row["major"])
+            per_program.setdefault(key, []).append((weight, math.log(row["min_rank"] * scale)))
+    bands = {label: 0 for _, label in BANDS}
+    for samples in per_program.values():
+        total = sum(w for w, _ in samples)
+        mean = sum(w * x for w, x in samples) / total
+        variance = sum(w * (x - mean) ** 2 for w, x in samples) / total
+        spread = math.sqrt(variance + BASE_LOG_RANK_SPREAD ** 2)
+        p = 1.0 / (1.0 + math.exp(-LOGISTIC_SCALE * (mean - math.log(rank)) / spread))
+        bands[next(label for bound, label in BANDS if p >= bound)] += 1
+    return bands
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--schools", type=int, default=2000)
+    parser.add_argument("--majors", type=int, default=15, help="majors per school")
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--cohort", type=int, default=400000, help="candidates in the latest year")
+    parser.add_argument("--students", type=int, default=100, help="students timed per measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    tables, admissions = synthetic_province(args.schools, args.majors, args.years, args.cohort, args.seed)
+    started = time.perf_counter()
+    model = AdmissionModel(tables, admissions)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    rng = random.Random(args.seed + 1)
+    ranks = [rng.randint(100, args.cohort // 2) for _ in range(args.students)]
+    text = "想报 大学0001 或 大学0420"
+
+    def per_student_ms(fn):
+        started = time.perf_counter()
+        for rank in ranks:
+            fn(rank)
+        return (time.perf_counter() - started) * 1000 / len(ranks)
+
+    # Band counts must agree, or the comparison is meaningless.
+    _, labels = model.evaluate(ranks[0])
+    engine_bands = {label: int((labels == label).sum()) for _, label in BANDS}
+    assert engine_bands == python_estimate(tables, admissions, ranks[0]), "engine and baseline disagree"
+
+    rows = [
+        {"method": "python_loop", "per_student_ms": round(per_student_ms(
+            lambda r: python_estimate(tables, admissions, r)), 3)},
+        {"method": "engine_evaluate", "per_student_ms": round(per_student_ms(model.evaluate), 3)},
+        {"method": "engine_summarize", "per_student_ms": round(per_student_ms(
+            lambda r: model.summarize(r, text)), 3)},
+    ]
+    report = {"params": vars(args), "programs": len(model), "build_ms": round(build_ms, 1), "results": rows}
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{len(model)} programs x {args.years} years, model built in {report['build_ms']} ms")
+    print("method | per_student_ms")
+    for row in rows:
+        print(f"{row['method']} | {row['per_student_ms']}")
+
+
+if __name__ == "__main__":
+    main()
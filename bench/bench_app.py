@@ -0,0 +1,317 @@
+"""
+End-to-end load test for the app.
+
+Starts app.py as a real server (gunicorn with gevent workers, the Flask dev
+server, or both) in a scratch directory, backed by a local fake
+OpenAI-compatible upstream with a configurable first-token delay and token
+rate. Each scenario is then driven at increasing concurrency over real HTTP:
+
+    handler  POST /api/handler (a full streamed consultation)
+    usage    GET /api/usage
+    static   GET /, /style.css and /script.js in turn
+
+For every (server, scenario, concurrency) it reports requests/s, TTFB (time
+to response headers), time-to-first-token (first `message` event, handler
+only) and p50/p99 latencies. `--output` writes the JSON report to a file;
+`--baseline` compares this run against an earlier report and exits 1 if
+throughput dropped or p99 latency grew by more than `--tolerance`.
+
+Usage:
+    python bench/bench_app.py --servers gunicorn dev --concurrency 1 8 32
+    python bench/bench_app.py --servers gunicorn --workers 2 --scenarios handler --output run.json
+    python bench/bench_app.py --servers gunicorn --baseline run.json --tolerance 0.15
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from bench.fake_upstream import FakeUpstream
+from bench.bench_upstream import percentile, _ms
+
+SCENARIOS = ("handler", "usage", "static")
+STATIC_PATHS = ("/", "/style.css", "/script.js")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class AppServer:
+    """app.py running in a child process, in its own scratch directory."""
+
+    def __init__(self, kind, upstream_url, workers=1, env=None):
+        self.kind = kind
+        self.port = _free_port()
+        self.workdir = tempfile.mkdtemp(prefix=f"bench-{kind}-")
+        self.env = {
+            **os.environ,
+            "PYTHONPATH": ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""),
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_API_BASE": upstream_url,
+            "OPENAI_MODEL_NAME": "fake-model",
+            "DAILY_LIMIT": "100000000",
+            "RATE_LIMIT_PER_MINUTE": "0",
+            **(env or {}),
+        }
+        self.workers = workers
+        self.process = None
+        self._log = None
+
+    def command(self):
+        bind = f"127.0.0.1:{self.port}"
+        if self.kind == "gunicorn":
+            return [sys.executable, "-m", "gunicorn", "-k", "gevent", "-w", str(self.workers),
+                    "--bind", bind, "--log-level", "warning", "app:app"]
+        # The dev server as `python app.py` runs it, minus the debugger and reloader.
+        return [sys.executable, "-c",
+                "import app; app.init_app(); "
+                f"app.app.run(host='127.0.0.1', port={self.port}, threaded=True)"]
+
+    def start(self, timeout=30):
+        shutil.copytree(os.path.join(ROOT, '_data', 'scorelines'), os.path.join(self.workdir, '_data', 'scorelines'))
+        with open(os.path.join(self.workdir, '_data', 'users.json'), 'w') as f:
+            json.dump({"valid_codes": ["bench"]}, f)
+        self._log = open(os.path.join(self.workdir, 'server.log'), 'w+')
+        self.process = subprocess.Popen(self.command(), cwd=self.workdir, env=self.env,
+                                        stdout=self._log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                status, _, _ = request("GET", self.port, "/api/usage")
+                if status == 200:
+                    return self
+            except OSError:
+                pass
+            time.sleep(0.1)
+        log = self.log()
+        self.stop()
+        raise RuntimeError(f"{self.kind} server did not start:\n{log}")
+
+    def log(self):
+        self._log.flush()
+        self._log.seek(0)
+        return self._log.read()[-4000:]
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self._log is not None:
+            self._log.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def request(method, port, path, body=None, timeout=120):
+    """
+    One request on a fresh connection. Returns (status, timings, error), where
+    timings has `ttfb` and `total` and, for event streams, `ttft`; error is None
+    on success, else the status line or the stream's `error` event.
+    """
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers["Content-Type"] = "application/json"
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        timings = {"ttfb": time.perf_counter() - started, "ttft": None}
+        error = None if response.status == 200 else f"HTTP {response.status} {response.reason}"
+        if response.getheader("Content-Type", "").startswith("text/event-stream"):
+            in_error = False
+            for line in response:
+                if timings["ttft"] is None and line.startswith(b"event: message"):
+                    timings["ttft"] = time.perf_counter() - started
+                elif line.startswith(b"event: error"):
+                    in_error = True
+                elif in_error and line.startswith(b"data: "):
+                    error = line[6:].decode('utf-8', 'replace').strip()
+                    in_error = False
+        else:
+            response.read()
+        timings["total"] = time.perf_counter() - started
+        return response.status, timings, error
+    finally:
+        conn.close()
+
+
+def _scenario_request(scenario, port, n):
+    if scenario == "handler":
+        # A distinct question per request, so nothing can be served from a cache.
+        return request("POST", port, "/api/handler", {
+            "invitationCode": "bench",
+            "userInput": {"rawText": f"南京大学还是东南大学？#{n}", "province": "江苏", "stream": "物理", "rank": "5000"},
+        })
+    if scenario == "usage":
+        return request("GET", port, "/api/usage")
+    return request("GET", port, STATIC_PATHS[n % len(STATIC_PATHS)])
+
+
+def run_level(server, scenario, concurrency, rounds):
+    results = []
+    errors = []
+
+    def worker(offset):
+        for i in range(rounds):
+            try:
+                results.append(_scenario_request(scenario, server.port, offset * rounds + i))
+            except Exception as e:
+                errors.append(repr(e))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    ok = [timings for _, timings, error in results if error is None]
+    failures = [error for _, _, error in results if error is not None] + errors
+    ttfb = [t["ttfb"] for t in ok]
+    ttft = [t["ttft"] for t in ok if t["ttft"] is not None]
+    totals = [t["total"] for t in ok]
+    return {
+        "server": server.kind,
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(results) + len(errors),
+        "errors": len(errors),
+        "failed": len(results) - len(ok),
+        "seconds": round(elapsed, 4),
+        "requests_per_second": round(len(ok) / elapsed, 2) if elapsed else None,
+        "ttfb_p50_ms": _ms(percentile(ttfb, 50)),
+        "ttfb_p99_ms": _ms(percentile(ttfb, 99)),
+        "ttft_p50_ms": _ms(percentile(ttft, 50)),
+        "ttft_p99_ms": _ms(percentile(ttft, 99)),
+        "latency_p50_ms": _ms(percentile(totals, 50)),
+        "latency_p99_ms": _ms(percentile(totals, 99)),
+        "error_sample": failures[0][:300] if failures else None,
+    }
+
+
+def run_suite(servers, scenarios, concurrency, rounds, workers=1, tokens=50, token_interval=0.002,
+              first_token_delay=0.05, warmup=2, env=None):
+    """Runs every scenario at every concurrency level against each server kind."""
+    results = []
+    with FakeUpstream(tokens=tokens, token_interval=token_interval, first_token_delay=first_token_delay) as upstream:
+        for kind in servers:
+            with AppServer(kind, upstream.base_url, workers=workers, env=env) as server:
+                for scenario in scenarios:
+                    for n in range(warmup):
+                        _scenario_request(scenario, server.port, -1 - n)
+                    for level in concurrency:
+                        results.append(run_level(server, scenario, level, rounds))
+    return results
+
+
+def _row_key(row):
+    return (row["server"], row["scenario"], row["concurrency"])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Lines describing how each row moved against the baseline report, and
+    whether any of them regressed past `tolerance` (a fraction).
+    """
+    previous = {_row_key(row): row for row in baseline.get("results", [])}
+    lines = []
+    regressed = False
+    for row in results:
+        old = previous.get(_row_key(row))
+        if old is None:
+            continue
+        notes = []
+        for field, higher_is_better in (("requests_per_second", True), ("latency_p99_ms", False),
+                                        ("ttft_p99_ms", False)):
+            before, after = old.get(field), row.get(field)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = " REGRESSION"
+                regressed = True
+            notes.append(f"{field} {before} -> {after} ({change:+.1%}){flag}")
+        lines.append(f"{row['server']}/{row['scenario']}@{row['concurrency']}: " + "; ".join(notes))
+    return lines, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", nargs="+", choices=["gunicorn", "dev"], default=["gunicorn", "dev"])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--rounds", type=int, default=10, help="requests per concurrent caller")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn worker processes")
+    parser.add_argument("--tokens", type=int, default=50, help="tokens per fake completion")
+    parser.add_argument("--token-interval", type=float, default=0.002, help="seconds between fake tokens")
+    parser.add_argument("--first-token-delay", type=float, default=0.05, help="fake upstream latency in seconds")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed requests per scenario")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed regression before exiting 1")
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    report = {
+        "params": vars(args),
+        "python": sys.version.split()[0],
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": run_suite(args.servers, args.scenarios, args.concurrency, args.rounds, args.workers,
+                             args.tokens, args.token_interval, args.first_token_delay, args.warmup),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        columns = ["server", "scenario", "concurrency", "requests", "errors", "failed", "requests_per_second",
+                   "ttfb_p50_ms", "ttfb_p99_ms", "ttft_p50_ms", "ttft_p99_ms", "latency_p50_ms", "latency_p99_ms"]
+        print(" | ".join(columns))
+        for row in report["results"]:
+            print(" | ".join(str(row[c]) for c in columns))
+        for row in report["results"]:
+            if row["error_sample"]:
+                print(f"{row['server']}/{row['scenario']}@{row['concurrency']} failed: {row['error_sample']}",
+                      file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            lines, regressed = compare(report["results"], json.load(f), args.tolerance)
+        print("\n".join(lines), file=sys.stderr)
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
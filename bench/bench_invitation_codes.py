@@ -0,0 +1,91 @@
+"""
+Invitation-code lookup benchmark.
+
+Writes a users.json with N codes (optionally a share of them stored hashed and
+with per-code limits), then measures how long the registry takes to load it
+and the cost of one lookup for a valid code, an unknown code and a hashed code.
+The old `code in list` scan is measured alongside for comparison.
+
+Usage:
+    python bench/bench_invitation_codes.py --codes 1000 100000
+    python bench/bench_invitation_codes.py --codes 100000 --hashed-share 0.5 --json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from invitation_codes import InvitationRegistry, hash_code
+
+
+def _per_call_ns(fn, arg, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn(arg)
+    return round((time.perf_counter() - started) / repeat * 1e9, 1)
+
+
+def run(count, hashed_share, repeat, scan_repeat, directory):
+    rng = random.Random(count)
+    codes = [f"SCHOOL{i // 1000:03d}_{rng.getrandbits(40):010x}" for i in range(count)]
+    hashed_count = int(count * hashed_share)
+    users = {
+        "valid_codes": codes[hashed_count:],
+        "codes": {hash_code(code): {"daily_limit": 5, "expires": "2099-12-31"} for code in codes[:hashed_count]},
+    }
+    path = os.path.join(directory, f"users-{count}.json")
+    with open(path, 'w') as f:
+        json.dump(users, f)
+
+    registry = InvitationRegistry(path, check_interval=3600)
+    started = time.perf_counter()
+    registry.reload()
+    load_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    as_list = list(codes)
+    last_plain = codes[-1]
+    row = {
+        "codes": count,
+        "hashed_codes": hashed_count,
+        "file_kb": round(os.path.getsize(path) / 1024, 1),
+        "load_ms": load_ms,
+        "lookup_hit_ns": _per_call_ns(registry.lookup, last_plain, repeat),
+        "lookup_miss_ns": _per_call_ns(registry.lookup, "NO_SUCH_CODE", repeat),
+        "lookup_hashed_ns": _per_call_ns(registry.lookup, codes[0], repeat) if hashed_count else None,
+        "list_scan_hit_ns": _per_call_ns(as_list.__contains__, last_plain, scan_repeat),
+    }
+    assert registry.lookup(last_plain) is not None
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--codes", nargs="+", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--hashed-share", type=float, default=0.0, help="fraction of codes stored as sha256")
+    parser.add_argument("--repeat", type=int, default=200000, help="lookups timed per measurement")
+    parser.add_argument("--scan-repeat", type=int, default=200, help="list scans timed per measurement")
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    report = {"params": vars(args), "results": []}
+    with tempfile.TemporaryDirectory() as directory:
+        for count in args.codes:
+            report["results"].append(run(count, args.hashed_share, args.repeat, args.scan_repeat, directory))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    columns = ["codes", "hashed_codes", "file_kb", "load_ms", "lookup_hit_ns",
+               "lookup_miss_ns", "lookup_hashed_ns", "list_scan_hit_ns"]
+    print(" | ".join(columns))
+    for row in report["results"]:
+        print(" | ".join(str(row[c]) for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Static asset serving benchmark.
+
+Compares the old routes (`send_from_directory` straight from disk, no
+compression) with the in-memory StaticAssetStore used by app.py, for the
+three files a page load fetches. For each asset it reports the bytes sent on
+a first visit and on a revalidation (If-None-Match), and the worker time per
+request, measured in-process through Flask's test client so network time
+doesn't blur it.
+
+Usage:
+    python bench/bench_static.py
+    python bench/bench_static.py --repeat 2000 --accept-encoding gzip --json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from flask import Flask, send_from_directory
+
+import static_assets
+from static_assets import StaticAssetStore
+
+ASSETS = ("index.html", "script.js", "style.css")
+
+
+def legacy_app():
+    """The routes app.py had before the static store."""
+    legacy = Flask("legacy", root_path=ROOT, static_folder=None)
+
+    @legacy.route('/')
+    def serve_index():
+        return send_from_directory('.', 'index.html')
+
+    @legacy.route('/<path:path>')
+    def serve_static(path):
+        return send_from_directory('.', path)
+
+    return legacy
+
+
+def store_app():
+    """The same routes backed by StaticAssetStore, as app.py serves them."""
+    from flask import request, abort, Response
+    store = StaticAssetStore(ROOT, ASSETS, check_interval=5)
+    store.reload()
+    served = Flask("store", root_path=ROOT, static_folder=None)
+
+    def static_response(name):
+        result = store.respond(name, request.headers.get('Accept-Encoding'),
+                               request.headers.get('If-None-Match'), request.args.get('v'))
+        if result is None:
+            abort(404)
+        status, body, headers = result
+        return Response(body, status=status, headers=headers)
+
+    @served.route('/')
+    def serve_index():
+        return static_response('index.html')
+
+    @served.route('/<path:path>')
+    def serve_static(path):
+        return static_response(path)
+
+    return served
+
+
+def _measure(client, path, headers, repeat):
+    response = client.get(path, headers=headers)
+    size = len(response.get_data())
+    started = time.perf_counter()
+    for _ in range(repeat):
+        client.get(path, headers=headers).get_data()
+    return response, size, round((time.perf_counter() - started) / repeat * 1e6, 1)
+
+
+def run(name, app, accept_encoding, repeat):
+    client = app.test_client()
+    rows = []
+    for asset in ASSETS:
+        path = '/' if asset == "index.html" else '/' + asset
+        first, first_bytes, first_us = _measure(client, path, {"Accept-Encoding": accept_encoding}, repeat)
+        etag = first.headers.get("ETag")
+        revalidate_headers = {"Accept-Encoding": accept_encoding, "If-None-Match": etag} if etag else {}
+        again, again_bytes, again_us = _measure(client, path, revalidate_headers, repeat)
+        rows.append({
+            "server": name,
+            "asset": asset,
+            "file_bytes": os.path.getsize(os.path.join(ROOT, asset)),
+            "encoding": first.headers.get("Content-Encoding", "identity"),
+            "first_visit_bytes": first_bytes,
+            "first_visit_us": first_us,
+            "revalidate_status": again.status_code,
+            "revalidate_bytes": again_bytes,
+            "revalidate_us": again_us,
+            "cache_control": first.headers.get("Cache-Control"),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=500, help="requests timed per measurement")
+    parser.add_argument("--accept-encoding", default="gzip, deflate, br")
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    report = {"params": vars(args), "brotli": static_assets.brotli is not None, "results": []}
+    report["results"] += run("send_from_directory", legacy_app(), args.accept_encoding, args.repeat)
+    report["results"] += run("static_store", store_app(), args.accept_encoding, args.repeat)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    columns = ["server", "asset", "file_bytes", "encoding", "first_visit_bytes", "first_visit_us",
+               "revalidate_status", "revalidate_bytes", "revalidate_us"]
+    print(" | ".join(columns))
+    for row in report["results"]:
+        print(" | ".join(str(row[c]) for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Concurrent-stream benchmark for the upstream LLM client.
+
+Starts a local fake OpenAI-compatible SSE server and drives N concurrent
+streams against it, either with a fresh OpenAI client per stream (the old
+behaviour) or with the pooled process-wide client from `upstream.get_client`.
+`--target app` goes through the real `/api/handler` instead, once per
+`--max-in-flight` setting of the upstream scheduler (0 = no cap). With
+`--upstream-capacity` the fake server answers 429 beyond that many concurrent
+streams, which shows how the scheduler behaves under overload.
+
+Reports streams/s, goodput (successful streams/s), time-to-first-token and
+total-latency percentiles, and how many TCP connections the upstream saw.
+Use `--json` for machine-readable output.
+
+Usage:
+    python bench/bench_upstream.py --concurrency 1 8 32 64 --tokens 50
+    python bench/bench_upstream.py --target app --concurrency 16 --json
+    python bench/bench_upstream.py --target app --upstream-capacity 8 --max-in-flight 0 8 --concurrency 32
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bench.fake_upstream import FakeUpstream
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def _client_stream(mode, base_url, results):
+    from openai import OpenAI
+    import upstream
+
+    started = time.perf_counter()
+    if mode == "per-request":
+        client = OpenAI(api_key="bench", base_url=base_url)
+    else:
+        client = upstream.get_client("bench", base_url)
+    first_token = None
+    with client.chat.completions.create(
+        messages=[{"role": "user", "content": "bench"}], model="fake-model", stream=True
+    ) as stream:
+        for chunk in stream:
+            if first_token is None and chunk.choices and chunk.choices[0].delta.content:
+                first_token = time.perf_counter() - started
+    results.append((first_token, time.perf_counter() - started, True))
+
+
+def _app_stream(test_client, results):
+    started = time.perf_counter()
+    response = test_client.post('/api/handler', json={
+        "invitationCode": "bench",
+        "userInput": {"rawText": "bench", "province": "江苏", "stream": "物理"},
+    }, buffered=False)
+    first_token = None
+    failed = response.status_code != 200
+    for data in response.response:
+        if first_token is None and b"event: message" in data:
+            first_token = time.perf_counter() - started
+        if b"event: error" in data:
+            failed = True
+    results.append((first_token, time.perf_counter() - started, not failed))
+
+
+def _prepare_app(base_url, workdir):
+    """Imports the app against the fake upstream, with its data files in `workdir`."""
+    os.environ.update({
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_API_BASE": base_url,
+        "OPENAI_MODEL_NAME": "fake-model",
+        "DAILY_LIMIT": "100000000",
+        "RATE_LIMIT_PER_MINUTE": "0",
+        "SSE_COALESCE_MS": "0",
+    })
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    shutil.copytree(os.path.join(root, '_data', 'scorelines'), os.path.join(workdir, '_data', 'scorelines'))
+    with open(os.path.join(workdir, '_data', 'users.json'), 'w') as f:
+        json.dump({"valid_codes": ["bench"]}, f)
+    os.chdir(workdir)
+    import app
+    app.init_app()
+    app.ip_rate_limiter.limit = 0
+    return app
+
+
+def _set_max_in_flight(app, max_in_flight, queue_timeout):
+    from upstream import UpstreamScheduler
+    app.upstream_scheduler = UpstreamScheduler(max_in_flight, queue_timeout=queue_timeout, max_queue=0)
+
+
+def run_level(target, mode, upstream, concurrency, rounds, test_client=None):
+    results = []
+    errors = []
+    before = dict(upstream.stats)
+
+    def worker():
+        for _ in range(rounds):
+            try:
+                if target == "app":
+                    _app_stream(test_client, results)
+                else:
+                    _client_stream(mode, upstream.base_url, results)
+            except Exception as e:
+                errors.append(repr(e))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if r[2]]
+    ttft = [r[0] for r in ok if r[0] is not None]
+    totals = [r[1] for r in ok]
+    return {
+        "target": target,
+        "mode": mode,
+        "concurrency": concurrency,
+        "streams": len(results),
+        "errors": len(errors),
+        "seconds": round(elapsed, 4),
+        "failed": len(results) - len(ok),
+        "streams_per_second": round(len(results) / elapsed, 2) if elapsed else None,
+        "goodput_per_second": round(len(ok) / elapsed, 2) if elapsed else None,
+        "ttft_p50_ms": _ms(percentile(ttft, 50)),
+        "ttft_p99_ms": _ms(percentile(ttft, 99)),
+        "total_p50_ms": _ms(percentile(totals, 50)),
+        "total_p99_ms": _ms(percentile(totals, 99)),
+        "upstream_connections": upstream.stats["connections"] - before["connections"],
+        "upstream_max_active_streams": upstream.stats["max_active_streams"],
+        "upstream_throttled": upstream.stats["throttled"] - before["throttled"],
+    }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=["client", "app"], default="client")
+    parser.add_argument("--modes", nargs="+", choices=["per-request", "pooled"], default=["per-request", "pooled"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--rounds", type=int, default=4, help="streams per concurrent caller")
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--token-interval", type=float, default=0.002)
+    parser.add_argument("--first-token-delay", type=float, default=0.05)
+    parser.add_argument("--upstream-capacity", type=int, default=0, help="fake upstream answers 429 beyond this")
+    parser.add_argument("--max-in-flight", nargs="+", type=int, default=[64], help="app scheduler caps to compare")
+    parser.add_argument("--queue-timeout", type=float, default=60)
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    report = {"params": vars(args), "results": []}
+    with FakeUpstream(tokens=args.tokens, token_interval=args.token_interval,
+                      first_token_delay=args.first_token_delay, capacity=args.upstream_capacity) as upstream:
+        if args.target == "app":
+            workdir = tempfile.mkdtemp(prefix="bench-app-")
+            cwd = os.getcwd()
+            app = None
+            try:
+                app = _prepare_app(upstream.base_url, workdir)
+                test_client = app.app.test_client()
+                for max_in_flight in args.max_in_flight:
+                    for concurrency in args.concurrency:
+                        _set_max_in_flight(app, max_in_flight, args.queue_timeout)
+                        report["results"].append(run_level("app", f"max_in_flight={max_in_flight}", upstream,
+                                                           concurrency, args.rounds, test_client))
+            finally:
+                if app is not None:
+                    app.usage_journal.flush() # nothing left for the exit hook to write elsewhere
+                os.chdir(cwd)
+                shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            for mode in args.modes:
+                for concurrency in args.concurrency:
+                    report["results"].append(run_level("client", mode, upstream, concurrency, args.rounds))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    columns = ["target", "mode", "concurrency", "streams", "errors", "failed", "goodput_per_second",
+               "ttft_p50_ms", "ttft_p99_ms", "total_p99_ms", "upstream_connections", "upstream_throttled"]
+    print(" | ".join(columns))
+    for row in report["results"]:
+        print(" | ".join(str(row[c]) for c in columns))
+
+
+if __name__ == "__main__":
+    main()
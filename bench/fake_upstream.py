@@ -0,0 +1,200 @@
+"""
+A local, OpenAI-compatible streaming server for tests and benchmarks.
+
+It answers `POST .../chat/completions` with `stream: true` by sending
+`tokens` chat.completion.chunk SSE events, waiting `first_token_delay`
+seconds before the first one and `token_interval` seconds between the rest.
+A client that hangs up during the first-token wait is counted in
+`stats["disconnects"]` right away.
+Setting `fail_status` makes every request fail with that HTTP status instead,
+and with `capacity` set, requests beyond that many concurrent streams get a
+429 like a provider's rate limit. All of these can be changed on a running
+server.
+
+Usage:
+    python bench/fake_upstream.py --port 8900 --tokens 200 --token-interval 0.01
+"""
+import sys
+import json
+import socket
+import select
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, so connection reuse is observable
+
+    def setup(self):
+        super().setup()
+        self.server.upstream._count("connections")
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _client_gone(self, timeout):
+        """Waits up to `timeout` seconds; True as soon as the client hangs up instead."""
+        readable, _, _ = select.select([self.connection], [], [], timeout)
+        try:
+            return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+        except ConnectionError:
+            return True
+
+    def do_POST(self):
+        upstream = self.server.upstream
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            payload = {}
+        upstream._count("requests")
+        upstream.last_payload = payload
+
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        if upstream.fail_status:
+            upstream._count("failures")
+            self._send_json(upstream.fail_status, {"error": {"message": "injected failure", "type": "fake"}})
+            return
+
+        if not upstream._stream_started():
+            upstream._count("throttled")
+            self._send_json(429, {"error": {"message": "too many concurrent requests", "type": "rate_limit"}})
+            return
+
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            if upstream.first_token_delay and self._client_gone(upstream.first_token_delay):
+                upstream._count("disconnects")
+                self.close_connection = True
+                return
+            model = payload.get("model", "fake-model")
+            for i, token in enumerate(upstream.token_source(payload)):
+                if i:
+                    time.sleep(upstream.token_interval)
+                chunk = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                }
+                self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            # [DONE] and the terminating chunk go out together, like most providers send them.
+            self.wfile.write(b"e\r\ndata: [DONE]\n\n\r\n0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            upstream._count("disconnects")
+        finally:
+            upstream._stream_finished()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on a kept-alive connection are expected, not errors.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeUpstream:
+    """Runs the fake server in a background thread; use as a context manager."""
+
+    def __init__(self, host="127.0.0.1", port=0, tokens=20, token_interval=0.0,
+                 first_token_delay=0.0, fail_status=None, token_text="tok ", capacity=0):
+        self.tokens = tokens
+        self.token_interval = token_interval
+        self.first_token_delay = first_token_delay
+        self.fail_status = fail_status
+        self.token_text = token_text
+        self.capacity = capacity
+        self.last_payload = None
+        self.stats = {"connections": 0, "requests": 0, "failures": 0, "throttled": 0, "disconnects": 0,
+                      "active_streams": 0, "max_active_streams": 0}
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.upstream = self
+        self._thread = None
+
+    def token_source(self, payload):
+        """The tokens streamed for one request; override for scripted replies."""
+        return (self.token_text for _ in range(self.tokens))
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _stream_started(self):
+        """Claims a stream slot; False if the server is at `capacity`."""
+        with self._lock:
+            if self.capacity and self.stats["active_streams"] >= self.capacity:
+                return False
+            self.stats["active_streams"] += 1
+            self.stats["max_active_streams"] = max(self.stats["max_active_streams"], self.stats["active_streams"])
+            return True
+
+    def _stream_finished(self):
+        with self._lock:
+            self.stats["active_streams"] -= 1
+
+    def start(self):
+        # A short poll interval keeps shutdown (and so test teardown) quick.
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.05},
+                                        name="fake-upstream", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible streaming server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--token-interval", type=float, default=0.01)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--fail-status", type=int, default=None)
+    parser.add_argument("--capacity", type=int, default=0, help="concurrent streams before answering 429")
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(args.host, args.port, args.tokens, args.token_interval,
+                            args.first_token_delay, args.fail_status, capacity=args.capacity)
+    print(f"Fake upstream listening at {upstream.base_url}")
+    try:
+        upstream._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,78 @@
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+def _normalize_text(text):
+    """NFKC (full-width -> half-width) and collapsed whitespace, so trivial edits share a key."""
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+def make_cache_key(model, messages):
+    """Hash of the model name and the normalized message list."""
+    normalized = [{"role": m.get("role"), "content": _normalize_text(m.get("content"))} for m in messages]
+    payload = json.dumps({"model": model, "messages": normalized}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """In-process LRU of finished completions, bounded by total size and per-entry TTL."""
+
+    def __init__(self, max_bytes, ttl, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict() # {key: (text, nbytes, expires_at)}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def _remove(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self._bytes -= nbytes
+
+    def get(self, key):
+        """Returns the cached completion text for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] <= self._clock():
+                self._remove(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, text):
+        nbytes = len(text.encode("utf-8"))
+        if not text or nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (text, nbytes, self._clock() + self.ttl)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
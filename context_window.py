@@ -0,0 +1,149 @@
+import re
+import threading
+from collections import namedtuple
+
+# CJK ideographs, CJK punctuation and full-width forms: roughly one token each.
+_WIDE_CHARS = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_MESSAGE_OVERHEAD = 4 # role and separators of one chat message
+_TRUNCATION_MARK = "\n……（较早的内容已截断）"
+_MIN_EXCERPT_TOKENS = 32
+
+ContextStats = namedtuple('ContextStats', [
+    'system_tokens', 'history_tokens', 'user_tokens', 'total_tokens',
+    'turns_included', 'turns_truncated', 'turns_dropped',
+])
+
+
+def estimate_tokens(text):
+    """
+    Offline upper-bound style estimate: one token per CJK character, one per
+    four other characters. Close enough to budget prompts without a tokenizer.
+    """
+    if not text:
+        return 0
+    wide = len(_WIDE_CHARS.findall(text))
+    return wide + -(-(len(text) - wide) // 4)
+
+
+def message_tokens(message):
+    return estimate_tokens(message.get("content", "")) + _MESSAGE_OVERHEAD
+
+
+def excerpt(text, max_tokens):
+    """The longest prefix of `text` (plus a truncation mark) within `max_tokens`."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - estimate_tokens(_TRUNCATION_MARK)
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo].rstrip() + _TRUNCATION_MARK
+
+
+def _pair_turns(history):
+    """Groups a flat message list into turns (a user message and what follows it)."""
+    turns = []
+    for message in history:
+        if message.get("role") == "user" or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+class ContextWindow:
+    """
+    Assembles the messages for one upstream request within a token budget.
+
+    The system prompt and the current user prompt are always sent whole; the
+    remaining budget is filled with the most recent history turns. The first
+    turn that doesn't fit is shortened to an excerpt if enough budget is left,
+    and everything older is dropped. A budget of 0 only applies `max_turns`.
+    """
+
+    def __init__(self, token_budget, max_turns=0):
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.total_tokens = 0
+        self.max_total_tokens = 0
+        self.turns_truncated = 0
+        self.turns_dropped = 0
+
+    def build(self, system_prompt, history, user_prompt):
+        """Returns (messages, ContextStats)."""
+        system_message = {"role": "system", "content": system_prompt}
+        user_message = {"role": "user", "content": user_prompt}
+        system_tokens = message_tokens(system_message)
+        user_tokens = message_tokens(user_message)
+
+        all_turns = _pair_turns(history)
+        turns = all_turns[-self.max_turns:] if self.max_turns > 0 else all_turns
+        dropped = len(all_turns) - len(turns)
+
+        remaining = self.token_budget - system_tokens - user_tokens if self.token_budget > 0 else None
+        selected = []
+        truncated = 0
+        history_tokens = 0
+        for index in range(len(turns) - 1, -1, -1):
+            turn = turns[index]
+            cost = sum(message_tokens(m) for m in turn)
+            if remaining is None or cost <= remaining:
+                selected.append(turn)
+            elif remaining - _MESSAGE_OVERHEAD * len(turn) >= _MIN_EXCERPT_TOKENS * len(turn):
+                turn = self._shorten(turn, remaining)
+                cost = sum(message_tokens(m) for m in turn)
+                selected.append(turn)
+                truncated += 1
+                dropped += index
+                history_tokens += cost
+                break
+            else:
+                dropped += index + 1
+                break
+            history_tokens += cost
+            if remaining is not None:
+                remaining -= cost
+
+        messages = [system_message]
+        for turn in reversed(selected):
+            messages.extend(turn)
+        messages.append(user_message)
+
+        total = system_tokens + history_tokens + user_tokens
+        stats = ContextStats(system_tokens, history_tokens, user_tokens, total,
+                             len(selected), truncated, dropped)
+        with self._lock:
+            self.requests += 1
+            self.total_tokens += total
+            self.max_total_tokens = max(self.max_total_tokens, total)
+            self.turns_truncated += truncated
+            self.turns_dropped += dropped
+        return messages, stats
+
+    @staticmethod
+    def _shorten(turn, budget):
+        # Give the question up to a third of the space; the answer gets the rest.
+        content_budget = budget - _MESSAGE_OVERHEAD * len(turn)
+        shortened = []
+        for message in turn:
+            share = content_budget // 3 if message.get("role") == "user" and len(turn) > 1 else content_budget
+            content = excerpt(message.get("content", ""), max(share, 0))
+            content_budget -= estimate_tokens(content)
+            shortened.append({**message, "content": content})
+        return shortened
+
+    def stats(self):
+        return {
+            "token_budget": self.token_budget,
+            "requests": self.requests,
+            "avg_prompt_tokens": round(self.total_tokens / self.requests, 1) if self.requests else None,
+            "max_prompt_tokens": self.max_total_tokens,
+            "turns_truncated": self.turns_truncated,
+            "turns_dropped": self.turns_dropped,
+        }
@@ -0,0 +1,141 @@
+import time
+import heapq
+import threading
+
+
+class MemoryCounterStore:
+    """
+    Process-local counters with per-key expiry. Used when no Redis is configured,
+    i.e. a single worker process (dev server, GitHub Actions container).
+    """
+
+    shared = False
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._values = {}   # {key: (value, expires_at)}
+        self._expiry = []   # heap of (expires_at, key); one entry per key, at or before its expiry
+        self._lock = threading.Lock()
+
+    def _evict_expired(self, now):
+        """Drops keys whose expiry has passed (needs lock). Amortized O(log n)."""
+        while self._expiry and self._expiry[0][0] <= now:
+            _, key = heapq.heappop(self._expiry)
+            current = self._values.get(key)
+            if current is None:
+                continue
+            if current[1] <= now:
+                del self._values[key]
+            else:
+                # The key's expiry was pushed back since this entry was queued.
+                heapq.heappush(self._expiry, (current[1], key))
+
+    def _incr_locked(self, key, ttl, now, amount=1):
+        """
+        Adds `amount` to `key` and pushes its expiry back to now + `ttl` (needs
+        lock). Only a new key gets a heap entry; an existing one is requeued at
+        its later expiry when its old entry comes up.
+        """
+        current = self._values.get(key)
+        value = (current[0] if current is not None else 0) + amount
+        expires_at = now + ttl
+        self._values[key] = (value, expires_at)
+        if current is None:
+            heapq.heappush(self._expiry, (expires_at, key))
+        return value
+
+    def incr(self, key, ttl):
+        """Increments `key` by one, (re)sets its expiry to `ttl` seconds and returns the new value."""
+        with self._lock:
+            now = self._clock()
+            self._evict_expired(now)
+            return self._incr_locked(key, ttl, now)
+
+    def incr_with_previous(self, key, previous_key, ttl):
+        """Increments `key` and also returns the value of `previous_key`."""
+        with self._lock:
+            now = self._clock()
+            self._evict_expired(now)
+            value = self._incr_locked(key, ttl, now)
+            return value, self._values.get(previous_key, (0, None))[0]
+
+    def decr(self, key, ttl):
+        """Takes back one increment of `key` (e.g. a rejected request) and returns the new value."""
+        with self._lock:
+            now = self._clock()
+            self._evict_expired(now)
+            return self._incr_locked(key, ttl, now, amount=-1)
+
+    def get(self, key):
+        """Returns the current value of `key`, or 0 if it is missing or expired."""
+        with self._lock:
+            self._evict_expired(self._clock())
+            return self._values.get(key, (0, None))[0]
+
+    def seed(self, key, value, ttl):
+        """Sets `key` to `value` only if it doesn't exist yet."""
+        with self._lock:
+            now = self._clock()
+            self._evict_expired(now)
+            if key in self._values:
+                return False
+            self._values[key] = (value, now + ttl)
+            heapq.heappush(self._expiry, (now + ttl, key))
+            return True
+
+
+class RedisCounterStore:
+    """Counters shared by every worker process, stored in Redis."""
+
+    shared = True
+
+    def __init__(self, client):
+        self.client = client
+
+    def incr(self, key, ttl):
+        """INCR + EXPIRE in a single MULTI/EXEC round trip; returns the new value."""
+        pipe = self.client.pipeline(transaction=True)
+        pipe.incr(key)
+        pipe.expire(key, int(ttl))
+        value, _ = pipe.execute()
+        return int(value)
+
+    def incr_with_previous(self, key, previous_key, ttl):
+        """INCR + EXPIRE on `key` and GET `previous_key`, in one round trip."""
+        pipe = self.client.pipeline(transaction=True)
+        pipe.incr(key)
+        pipe.expire(key, int(ttl))
+        pipe.get(previous_key)
+        value, _, previous = pipe.execute()
+        return int(value), int(previous) if previous is not None else 0
+
+    def decr(self, key, ttl):
+        """DECR + EXPIRE in one round trip, so the key can't be left without a TTL."""
+        pipe = self.client.pipeline(transaction=True)
+        pipe.decr(key)
+        pipe.expire(key, int(ttl))
+        value, _ = pipe.execute()
+        return int(value)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return int(value) if value is not None else 0
+
+    def seed(self, key, value, ttl):
+        return bool(self.client.set(key, value, ex=int(ttl), nx=True))
+
+
+def create_counter_store(redis_url=None):
+    """Returns a Redis-backed store when `redis_url` is set and reachable, else an in-memory one."""
+    if redis_url:
+        try:
+            import redis
+            client = redis.Redis.from_url(redis_url, decode_responses=True)
+            client.ping()
+            print(f"Using Redis counter store at {redis_url}.")
+            return RedisCounterStore(client)
+        except ImportError:
+            print("REDIS_URL is set but the 'redis' package is not installed; falling back to in-memory counters.")
+        except Exception as e:
+            print(f"Could not connect to Redis at {redis_url} ({e}); falling back to in-memory counters.")
+    return MemoryCounterStore()
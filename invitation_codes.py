@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import namedtuple
+
+HASH_PREFIX = "sha256:"
+
+
+class CodePolicy(namedtuple('CodePolicy', ['daily_limit', 'expires_on', 'priority', 'batch', 'admin'],
+                            defaults=(0, False, False))):
+    """
+    Limits attached to one invitation code. A daily_limit of 0 means no per-code
+    limit; a higher priority moves the code's requests ahead in the upstream queue;
+    `batch` allows the code to submit bulk consultations to /api/batch; `admin`
+    allows it to read the operator endpoints (/api/analytics, /api/stats).
+    """
+    __slots__ = ()
+
+    def expired(self, today_str):
+        return self.expires_on is not None and today_str > self.expires_on
+
+
+UNLIMITED = CodePolicy(0, None)
+
+
+def hash_code(code):
+    """The form a code takes when stored hashed in users.json."""
+    return HASH_PREFIX + hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+def _parse_users(data):
+    """
+    Parses users.json into ({code: CodePolicy}, {sha256 hex: CodePolicy}).
+
+    Accepted layout (every key optional):
+        {"valid_codes": ["CODE", ...],
+         "default_daily_limit": 0, "default_priority": 0,
+         "codes": {"CODE" or "sha256:<hex>": {"daily_limit": 5, "expires": "2025-07-31", "priority": 1,
+                                             "batch": false, "admin": false}}}
+    """
+    policies = {} # shared instances, so 100k codes with the same limits cost one tuple
+    def policy(daily_limit, expires_on, priority=0, batch=False, admin=False):
+        key = (int(daily_limit or 0), str(expires_on) if expires_on else None, int(priority or 0), bool(batch),
+               bool(admin))
+        if key == tuple(UNLIMITED):
+            return UNLIMITED
+        return policies.setdefault(key, CodePolicy(*key))
+
+    default = policy(data.get("default_daily_limit", 0), None, data.get("default_priority", 0))
+    plain = {code: default for code in data.get("valid_codes", []) if isinstance(code, str)}
+    hashed = {}
+    for code, options in (data.get("codes") or {}).items():
+        options = options if isinstance(options, dict) else {}
+        entry = policy(options.get("daily_limit", default.daily_limit), options.get("expires"),
+                       options.get("priority", default.priority), options.get("batch", False),
+                       options.get("admin", False))
+        if code.startswith(HASH_PREFIX):
+            hashed[code[len(HASH_PREFIX):].lower()] = entry
+        else:
+            plain[code] = entry
+    return plain, hashed
+
+
+class InvitationRegistry:
+    """
+    Dict-backed registry of invitation codes loaded from `users.json`.
+
+    Lookups are a single dict probe (plus one sha256 when the file stores hashed
+    codes). The file is re-checked at most every `check_interval` seconds and a
+    changed file is swapped in atomically; a file that fails to parse leaves the
+    previous codes in place.
+    """
+
+    def __init__(self, path, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._plain = {}
+        self._hashed = {}
+        self._mtime = None
+        self._last_check = None
+        self._reload_lock = threading.Lock()
+        self.reloads = 0
+
+    def reload(self, force=False, blocking=True):
+        """Re-reads the file if its mtime or size changed and publishes the new codes."""
+        if not self._reload_lock.acquire(blocking=blocking):
+            return
+        try:
+            try:
+                st = os.stat(self.path)
+                mtime = (st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                mtime = None
+            if force or mtime != self._mtime:
+                try:
+                    if mtime is None:
+                        plain, hashed = {}, {}
+                    else:
+                        with open(self.path, 'r', encoding='utf-8') as f:
+                            plain, hashed = _parse_users(json.load(f))
+                    self._plain, self._hashed = plain, hashed
+                    self._mtime = mtime
+                    self.reloads += 1
+                    print(f"Loaded {len(self)} invitation codes.")
+                except (json.JSONDecodeError, OSError, AttributeError, TypeError, ValueError) as e:
+                    print(f"Error loading invitation codes from {self.path}: {e}")
+            self._last_check = time.monotonic()
+        finally:
+            self._reload_lock.release()
+
+    def _maybe_reload(self):
+        """Checks the file mtime at most once per `check_interval` seconds."""
+        last_check = self._last_check
+        if last_check is not None and time.monotonic() - last_check < self.check_interval:
+            return
+        self.reload(blocking=last_check is None)
+
+    def lookup(self, code):
+        """Returns the CodePolicy for a code, or None if it isn't valid."""
+        if not code or not isinstance(code, str):
+            return None
+        self._maybe_reload()
+        policy = self._plain.get(code)
+        if policy is None and self._hashed:
+            policy = self._hashed.get(hash_code(code)[len(HASH_PREFIX):])
+        return policy
+
+    def __len__(self):
+        return len(self._plain) + len(self._hashed)
+
+    def stats(self):
+        return {"codes": len(self), "hashed_codes": len(self._hashed), "reloads": self.reloads}
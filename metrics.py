@@ -0,0 +1,167 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Seconds; spans run from sub-millisecond file reads to multi-minute streams.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _label_key(names, labels):
+    if not names:
+        return ()
+    return tuple([labels[n] for n in names])
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    """Bucketed observations (Prometheus cumulative `le` buckets plus sum and count)."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {} # {label values: [per-bucket counts..., +Inf count, sum]}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the wall-clock duration of the block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        series = self._series.get(_label_key(self.labelnames, labels))
+        return sum(series[:-1]) if series else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(series[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge:
+    """A value read from a callback at scrape time, e.g. a queue length."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, callback):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def samples(self):
+        try:
+            value = self.callback()
+        except Exception as e:
+            print(f"Error reading gauge {self.name}: {e}")
+            return
+        if value is not None:
+            yield f"{self.name} {_format_value(value)}"
+
+
+class MetricsRegistry:
+    """
+    In-process metrics rendered in the Prometheus text format.
+
+    Recording is a dict lookup and a short lock (around a microsecond), cheap
+    enough to leave on. Every label a metric declares must be passed when
+    recording. Each gunicorn worker keeps its own numbers, so a scrape sees one
+    worker at a time.
+    """
+
+    def __init__(self, namespace=""):
+        self.namespace = namespace
+        self._metrics = []
+
+    def _add(self, metric):
+        if self.namespace:
+            metric.name = f"{self.namespace}_{metric.name}"
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, callback):
+        return self._add(Gauge(name, help, callback))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
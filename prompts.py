@@ -0,0 +1,82 @@
+import json
+import hashlib
+
+# Message layout, chosen so consecutive requests share the longest possible
+# byte-identical prefix (which OpenAI-compatible providers cache):
+#   1. SYSTEM_PROMPT - identical for every request
+#   2. history turns - identical across one session's follow-ups
+#   3. the user prompt, which starts with the per-(province, stream) score
+#      block, then the per-student admission estimates, and ends with the
+#      student's own text
+# Everything static is compiled once at import (or score-index load) time.
+
+SYSTEM_PROMPT = "\n\n".join([
+    "你是一位顶级的、资深的、充满智慧的高考志愿填报专家。你的任务是为一位正在纠结中的高三学生或家长，提供一份专业、客观、有深度、有温度的志愿对比分析报告。",
+    "**重要指令**: 在你输出最终的分析报告之前，请务必先进行一步深度思考。将你的思考过程、分析逻辑、以及数据检索的步骤，完整地包含在 `<think>` 和 `</think>` 标签之间。这部分内容是给专业用户看的，可以帮助他们理解你的决策过程。思考结束后，再输出面向用户的、完整的Markdown格式报告。",
+    "**你的任务和要求:**",
+    "1.  **深度思考**:",
+    "    *   第一步: 识别用户的核心问题和纠结的点。",
+    "    *   第二步: 基于你掌握的知识，并结合用户提供的结构化参考数据（如招生计划、分数线等）进行分析。",
+    "    *   第三步: 设定评估维度，并简述每个维度的评估逻辑。",
+    "2.  **正式报告**:",
+    "    *   **创建方案PK记分卡:** 这是报告的核心！请创建一个Markdown表格，从以下维度对核心方案进行对比打分（满分5星，用 ★★★☆☆ 表示）：录取概率、学校实力/声誉、专业前景/钱景、城市发展/生活品质、个人兴趣/困惑匹配度。",
+    "    *   **详细文字解读:** 针对记分卡中的每一项，展开详细的、有理有据的文字分析。",
+    "    *   **“对话式”分析与建议:** 模拟与学生面对面对话的口吻，设身处地地理解他的困惑。",
+    "    *   **最终结论总结:** 给出一个清晰的、总结性的结论。",
+    "**输出格式要求:**",
+    "- **必须**先输出`<think>`标签包裹的思考内容，然后再输出正式报告。",
+    "- **绝对禁止**在正式报告中重复或提及任何`<think>`标签内的思考过程。正式报告必须是直接面向最终用户的、干净的、独立的分析内容。",
+    "- 正式报告**必须**是完整的Markdown格式。",
+    "- 正式报告**必须**包含“方案PK记- 记分卡”表格。",
+    "- **格式示例**: `<think>这是我的思考过程...</think># 高考志愿对比分析报告\n## 方案PK记分卡\n| 评估维度 | ...`"
+])
+
+_SCORE_BLOCK_TEMPLATE = "\n\n".join([
+    "**参考数据 (历年分数线):**",
+    "---",
+    "{score_info}",
+    "---",
+])
+
+_ADMISSION_BLOCK_TEMPLATE = "\n\n".join([
+    "**录取概率测算 (由历年一分一段表和院校最低位次计算，请直接采用，无需自行估算):**",
+    "{summary}",
+])
+
+_STUDENT_BLOCK_TEMPLATE = "\n\n".join([
+    "**学生背景:**",
+    "- 省份: {province}",
+    "- 分数/位次: {rank}",
+    "- 他本次的原始笔记和困惑如下:",
+    "---",
+    "{raw_text}",
+    "---",
+])
+
+# Changes whenever any template text changes, so prefix-cache hit rates can be
+# compared per prompt version.
+PROMPT_TEMPLATE_VERSION = hashlib.sha256(
+    "\x00".join([SYSTEM_PROMPT, _SCORE_BLOCK_TEMPLATE, _ADMISSION_BLOCK_TEMPLATE, _STUDENT_BLOCK_TEMPLATE]).encode("utf-8")
+).hexdigest()[:12]
+
+
+def compile_score_block(score_data):
+    """Serializes one (province, stream) score table into its prompt block."""
+    return _SCORE_BLOCK_TEMPLATE.format(score_info=json.dumps(score_data, ensure_ascii=False, indent=2))
+
+
+def build_user_prompt(user_data, score_block=None, admission_summary=None):
+    """
+    The user message of an initial consultation: score block first, then the
+    admission estimates, student text last.
+    """
+    student_block = _STUDENT_BLOCK_TEMPLATE.format(
+        province=user_data.get('province', '未知'),
+        rank=user_data.get('rank', '未知'),
+        raw_text=user_data.get('rawText', ''),
+    )
+    blocks = [score_block] if score_block else []
+    if admission_summary:
+        blocks.append(_ADMISSION_BLOCK_TEMPLATE.format(summary=admission_summary))
+    blocks.append(student_block)
+    return "\n\n".join(blocks)
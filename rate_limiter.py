@@ -0,0 +1,104 @@
+import time
+import threading
+from collections import deque
+
+
+class SlidingWindowLog:
+    """
+    Exact sliding-window-log limiter for a single process.
+
+    Each key keeps a deque of the timestamps it was admitted at (never more than
+    `limit` of them). All admissions also go into a per-shard, time-ordered
+    expiry queue; every call pops the expired head of that queue, so idle keys
+    are evicted lazily in amortized O(1) instead of by sweeping the whole table.
+    Keys are spread over independently locked shards so unrelated clients don't
+    contend, and nothing here shares a lock with usage accounting.
+    """
+
+    def __init__(self, limit, window=60, shards=16, clock=time.monotonic):
+        self.limit = limit
+        self.window = window
+        self._clock = clock
+        self._shards = [({}, deque(), threading.Lock()) for _ in range(shards)]
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _expire(self, hits, expiry, now):
+        """Evicts timestamps and keys that fell out of the window (needs shard lock)."""
+        cutoff = now - self.window
+        while expiry and expiry[0][0] <= cutoff:
+            _, key = expiry.popleft()
+            log = hits.get(key)
+            if log is None:
+                continue
+            while log and log[0] <= cutoff:
+                log.popleft()
+            if not log:
+                del hits[key]
+
+    def hit(self, key):
+        """Records a request for `key`. Returns True if it is over the limit."""
+        if self.limit <= 0:
+            return False
+        hits, expiry, lock = self._shard(key)
+        with lock:
+            now = self._clock()
+            self._expire(hits, expiry, now)
+            log = hits.get(key)
+            if log is None:
+                log = hits[key] = deque()
+            else:
+                cutoff = now - self.window
+                while log and log[0] <= cutoff:
+                    log.popleft()
+            if len(log) >= self.limit:
+                return True
+            log.append(now)
+            expiry.append((now, key))
+            return False
+
+    def tracked_keys(self):
+        """Number of keys currently held in memory."""
+        return sum(len(hits) for hits, _, _ in self._shards)
+
+
+class SlidingWindowCounter:
+    """
+    Sliding-window limiter over a shared counter store (Redis), so the limit
+    holds across worker processes. It weights the previous fixed window by how
+    much of it still overlaps the sliding window, which costs one round trip per
+    admitted request and two keys per client instead of a per-request log. A
+    rejected request takes its increment back, so a client that keeps retrying
+    while limited isn't locked out past the window.
+    """
+
+    def __init__(self, store, limit, window=60, prefix="rate", clock=time.time):
+        self.store = store
+        self.limit = limit
+        self.window = window
+        self.prefix = prefix
+        self._clock = clock
+
+    def hit(self, key):
+        """Records a request for `key`. Returns True if it is over the limit."""
+        if self.limit <= 0:
+            return False
+        now = self._clock()
+        bucket = int(now // self.window)
+        elapsed = (now % self.window) / self.window
+        current_key = f"{self.prefix}:{key}:{bucket}"
+        current, previous = self.store.incr_with_previous(
+            current_key, f"{self.prefix}:{key}:{bucket - 1}", self.window * 2
+        )
+        if previous * (1 - elapsed) + current > self.limit:
+            self.store.decr(current_key, self.window * 2)
+            return True
+        return False
+
+
+def create_rate_limiter(store, limit, window=60, prefix="rate"):
+    """Shared-store limiter when the store spans workers, else the exact in-process log."""
+    if store.shared:
+        return SlidingWindowCounter(store, limit, window, prefix=prefix)
+    return SlidingWindowLog(limit, window)
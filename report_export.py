@@ -0,0 +1,452 @@
+import os
+import re
+import html
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from think_filter import strip_think
+
+# Bump when the rendered output changes, so cached reports are rebuilt.
+RENDERER_VERSION = "1"
+
+EXPORT_FORMATS = {
+    "md": ("text/markdown; charset=utf-8", "md"),
+    "html": ("text/html; charset=utf-8", "html"),
+    "pdf": ("application/pdf", "pdf"),
+}
+
+REPORT_TITLE = "高考志愿AI分析报告"
+
+_REPORT_CSS = """
+@page { size: A4; margin: 18mm 16mm; }
+body { font-family: "Noto Sans CJK SC", "Source Han Sans SC", "PingFang SC", "Microsoft YaHei", sans-serif;
+       color: #1f2d2d; line-height: 1.7; font-size: 11pt; }
+h1 { color: #0f6e6e; font-size: 20pt; border-bottom: 2px solid #0f6e6e; padding-bottom: 6px; }
+h2 { color: #0f6e6e; font-size: 15pt; margin-top: 1.4em; }
+h3, h4 { color: #205858; }
+.question { background: #eef7f7; border-left: 4px solid #0f6e6e; padding: 8px 12px; white-space: pre-wrap; }
+table { border-collapse: collapse; width: 100%; margin: 0.8em 0; }
+th, td { border: 1px solid #b8d4d4; padding: 4px 8px; text-align: left; vertical-align: top; }
+th { background: #e2f0f0; }
+blockquote { color: #4a6060; border-left: 3px solid #b8d4d4; margin-left: 0; padding-left: 12px; }
+code { background: #f2f4f4; padding: 0 3px; }
+pre { background: #f2f4f4; padding: 8px; white-space: pre-wrap; }
+.footer { color: #8a9a9a; font-size: 9pt; margin-top: 2em; border-top: 1px solid #dde8e8; padding-top: 6px; }
+"""
+
+
+class ReportNotFound(Exception):
+    """The session has no finished assistant report."""
+
+
+class PdfRendererUnavailable(Exception):
+    """WeasyPrint (or the system libraries it needs) isn't installed."""
+
+
+def final_report(messages):
+    """Returns (question, report) for the last assistant turn of a session."""
+    for i in range(len(messages) - 1, -1, -1):
+        message = messages[i]
+        if message.get("role") == "assistant" and (message.get("content") or "").strip():
+            question = ""
+            if i > 0 and messages[i - 1].get("role") == "user":
+                question = messages[i - 1].get("content") or ""
+            return question, strip_think(message["content"]).strip()
+    raise ReportNotFound("no assistant report in session")
+
+
+def content_hash(fmt, question, report):
+    """Identifies one rendering: the format, the renderer version and the report text."""
+    digest = hashlib.sha256()
+    for part in (fmt, RENDERER_VERSION, question, report):
+        digest.update(part.encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()[:24]
+
+
+# --- Markdown ---
+def build_markdown(question, report):
+    """The downloadable Markdown document: the student's question, then the report."""
+    parts = [f"# {REPORT_TITLE}\n"]
+    if question.strip():
+        parts.append("## 我的输入\n\n" + "\n".join("> " + line for line in question.strip().splitlines()) + "\n")
+    parts.append("## AI分析报告\n\n" + report + "\n")
+    return "\n".join(parts)
+
+
+_CODE_SPAN = re.compile(r'`([^`\n]+)`')
+_LINK = re.compile(r'\[([^\]]+)\]\((https?://[^)\s]+)\)')
+_BOLD = re.compile(r'\*\*(.+?)\*\*|__(.+?)__')
+_ITALIC = re.compile(r'(?<![*\w])\*(?![\s*])(.+?)(?<![\s*])\*(?!\*)')
+_STRIKE = re.compile(r'~~(.+?)~~')
+_HEADING = re.compile(r'^(#{1,6})\s+(.*?)\s*#*\s*$')
+_RULE = re.compile(r'^\s*([-*_])(\s*\1){2,}\s*$')
+_LIST_ITEM = re.compile(r'^(\s*)([-*+]|\d+[.)])\s+(.*)$')
+_TABLE_SEPARATOR = re.compile(r'^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$')
+_FENCE = re.compile(r'^\s*(```|~~~)')
+
+
+def _inline(text):
+    out = []
+    for i, part in enumerate(_CODE_SPAN.split(text)):
+        if i % 2:
+            out.append(f"<code>{html.escape(part)}</code>")
+            continue
+        part = html.escape(part)
+        part = _LINK.sub(lambda m: f'<a href="{m.group(2)}">{m.group(1)}</a>', part)
+        part = _BOLD.sub(lambda m: f"<strong>{m.group(1) or m.group(2)}</strong>", part)
+        part = _ITALIC.sub(r"<em>\1</em>", part)
+        part = _STRIKE.sub(r"<del>\1</del>", part)
+        out.append(part)
+    return "".join(out)
+
+
+def _table_cells(line):
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|"):
+        line = line[:-1]
+    return [cell.strip() for cell in line.split("|")]
+
+
+def _is_table_start(lines, i):
+    return "|" in lines[i] and i + 1 < len(lines) and "-" in lines[i + 1] and bool(_TABLE_SEPARATOR.match(lines[i + 1]))
+
+
+def _starts_block(lines, i):
+    line = lines[i]
+    return bool(_HEADING.match(line) or _RULE.match(line) or _LIST_ITEM.match(line) or _FENCE.match(line)
+                or line.lstrip().startswith(">") or _is_table_start(lines, i))
+
+
+def markdown_to_html(text):
+    """
+    Renders the Markdown subset model reports use (headings, lists, tables,
+    quotes, rules, code and emphasis) to HTML. Raw HTML in the input is
+    escaped, never passed through.
+    """
+    lines = text.replace("\r\n", "\n").split("\n")
+    out = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.strip():
+            i += 1
+            continue
+
+        if _FENCE.match(line):
+            fence = _FENCE.match(line).group(1)
+            body = []
+            i += 1
+            while i < len(lines) and not lines[i].strip().startswith(fence):
+                body.append(lines[i])
+                i += 1
+            out.append(f"<pre><code>{html.escape(chr(10).join(body))}</code></pre>")
+            i += 1
+            continue
+
+        heading = _HEADING.match(line)
+        if heading:
+            level = len(heading.group(1))
+            out.append(f"<h{level}>{_inline(heading.group(2))}</h{level}>")
+            i += 1
+            continue
+
+        if _RULE.match(line):
+            out.append("<hr>")
+            i += 1
+            continue
+
+        if _is_table_start(lines, i):
+            header = _table_cells(line)
+            out.append("<table><thead><tr>" + "".join(f"<th>{_inline(c)}</th>" for c in header) + "</tr></thead><tbody>")
+            i += 2
+            while i < len(lines) and "|" in lines[i] and lines[i].strip():
+                cells = _table_cells(lines[i])
+                cells += [""] * (len(header) - len(cells))
+                out.append("<tr>" + "".join(f"<td>{_inline(c)}</td>" for c in cells[:len(header)]) + "</tr>")
+                i += 1
+            out.append("</tbody></table>")
+            continue
+
+        if line.lstrip().startswith(">"):
+            quoted = []
+            while i < len(lines) and lines[i].lstrip().startswith(">"):
+                quoted.append(re.sub(r'^\s*>\s?', '', lines[i]))
+                i += 1
+            out.append(f"<blockquote>{markdown_to_html(chr(10).join(quoted))}</blockquote>")
+            continue
+
+        if _LIST_ITEM.match(line):
+            i = _render_list(lines, i, out)
+            continue
+
+        paragraph = []
+        while i < len(lines) and lines[i].strip() and (not paragraph or not _starts_block(lines, i)):
+            paragraph.append(_inline(lines[i].strip()))
+            i += 1
+        out.append("<p>" + "<br>\n".join(paragraph) + "</p>")
+    return "\n".join(out)
+
+
+def _render_list(lines, i, out):
+    """Renders consecutive (possibly nested) list items starting at line i; returns the next line."""
+    stack = [] # [indent, tag] per open list
+    while i < len(lines):
+        line = lines[i]
+        item = _LIST_ITEM.match(line)
+        if not line.strip():
+            # A blank line continues the list only if another item follows.
+            j = i + 1
+            while j < len(lines) and not lines[j].strip():
+                j += 1
+            if j < len(lines) and _LIST_ITEM.match(lines[j]):
+                i = j
+                continue
+            break
+        if item is None:
+            if not line.startswith((" ", "\t")) and _starts_block(lines, i):
+                break
+            out.append(" " + _inline(line.strip())) # continuation of the current item
+            i += 1
+            continue
+        indent = len(item.group(1).expandtabs(4))
+        tag = "ol" if item.group(2)[0].isdigit() else "ul"
+        while stack and indent < stack[-1][0]:
+            out.append(f"</li></{stack.pop()[1]}>")
+        if stack and indent == stack[-1][0]:
+            if tag != stack[-1][1]:
+                out.append(f"</li></{stack[-1][1]}><{tag}>")
+                stack[-1][1] = tag
+            else:
+                out.append("</li>")
+        else:
+            out.append(f"<{tag}>")
+            stack.append([indent, tag])
+        out.append("<li>" + _inline(item.group(3)))
+        i += 1
+    while stack:
+        out.append(f"</li></{stack.pop()[1]}>")
+    return i
+
+
+# --- HTML & PDF ---
+def render_html(question, report):
+    """A standalone, print-ready HTML page for the report."""
+    question_html = f'<h2>我的输入</h2>\n<div class="question">{html.escape(question.strip())}</div>\n' if question.strip() else ""
+    return (
+        "<!DOCTYPE html>\n<html lang=\"zh-CN\">\n<head>\n<meta charset=\"utf-8\">\n"
+        f"<title>{REPORT_TITLE}</title>\n<style>{_REPORT_CSS}</style>\n</head>\n<body>\n"
+        f"<h1>{REPORT_TITLE}</h1>\n{question_html}<h2>AI分析报告</h2>\n"
+        f"<div class=\"report\">\n{markdown_to_html(report)}\n</div>\n"
+        "<p class=\"footer\">本报告由AI生成，仅供参考，请以各省教育考试院及高校官方发布的信息为准。</p>\n"
+        "</body>\n</html>\n"
+    )
+
+
+_pdf_unavailable = None # why WeasyPrint couldn't be loaded, so it is only tried once
+
+
+def render_pdf(html_text):
+    """Renders the HTML page to PDF bytes with WeasyPrint, which runs fully offline."""
+    global _pdf_unavailable
+    if _pdf_unavailable is not None:
+        raise PdfRendererUnavailable(_pdf_unavailable)
+    try:
+        from weasyprint import HTML
+    except (ImportError, OSError) as e:
+        # OSError: the package is there but Pango/fontconfig are missing.
+        _pdf_unavailable = str(e)
+        raise PdfRendererUnavailable(_pdf_unavailable) from e
+    return HTML(string=html_text).write_pdf()
+
+
+def render(fmt, question, report):
+    """Returns the report rendered in one of EXPORT_FORMATS as bytes."""
+    if fmt == "md":
+        return build_markdown(question, report).encode('utf-8')
+    page = render_html(question, report)
+    if fmt == "html":
+        return page.encode('utf-8')
+    if fmt == "pdf":
+        return render_pdf(page)
+    raise ValueError(f"unknown export format: {fmt!r}")
+
+
+def _gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+class RenderPool:
+    """
+    Runs CPU-bound renders (PDF layout takes hundreds of milliseconds or more)
+    on real OS threads, at most `workers` at once; callers beyond that wait
+    their turn. Run inline in a gevent worker a render would stall every
+    stream on that worker; on an OS thread the event loop still gets the GIL
+    every switch interval.
+
+    Under gevent, monkey-patched threads are greenlets, so gevent's own
+    thread pool is used; otherwise a ThreadPoolExecutor. The pool is created
+    on first use, after the worker has forked.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(workers, 1)
+        self._pool = None
+        self._lock = threading.Lock()
+        self.pending = 0 # running or waiting for a thread
+        self.completed = 0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                if _gevent_patched():
+                    from gevent.threadpool import ThreadPool
+                    self._pool = ThreadPool(self.workers)
+                else:
+                    self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="report-render")
+            return self._pool
+
+    def run(self, fn, *args):
+        """Calls `fn(*args)` on the pool and returns its result, blocking only the calling greenlet/thread."""
+        pool = self._get_pool()
+        # Counted on the caller's side: a gevent-patched lock must not be taken from the pool's native threads.
+        with self._lock:
+            self.pending += 1
+        try:
+            if isinstance(pool, ThreadPoolExecutor):
+                return pool.submit(fn, *args).result()
+            return pool.apply(fn, args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers, "pending": self.pending, "completed": self.completed}
+
+
+# --- Disk cache ---
+class ReportCache:
+    """
+    Rendered reports on disk, named `<session>-<content hash>.<ext>` and evicted
+    least recently used first once they take more than `max_bytes`.
+
+    A session keeps only its newest rendering per format: storing a new one
+    removes the session's older files for that format. Each worker tracks
+    recency for the files it has seen; a file removed by another worker is
+    simply a miss.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # {file name: size}, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def file_name(session_id, digest, fmt):
+        return f"{session_id}-{digest}.{EXPORT_FORMATS[fmt][1]}"
+
+    def _load(self):
+        """Indexes files left by earlier runs, oldest first (needs the lock)."""
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            names = [n for n in os.listdir(self.directory) if not n.endswith(".tmp")]
+        except FileNotFoundError:
+            return
+        found = []
+        for name in names:
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            found.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._bytes += size
+        self._evict()
+
+    def _evict(self, keep=None):
+        """Drops least recently used files until under budget, never `keep` (needs the lock)."""
+        while self._bytes > self.max_bytes and self._entries:
+            if next(iter(self._entries)) == keep:
+                break
+            name, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            self._remove(name)
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def get(self, name):
+        """
+        Returns the cached rendering's bytes, or None. They are read under the
+        lock, so this worker can't evict the file halfway; a file another
+        worker removed is a miss.
+        """
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            self._load()
+            if name in self._entries:
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    self._bytes -= self._entries.pop(name)
+                else:
+                    self._entries.move_to_end(name)
+                    self.hits += 1
+                    return data
+            self.misses += 1
+        return None
+
+    def put(self, name, data):
+        """
+        Writes a rendering atomically. One larger than the whole budget is not
+        kept; otherwise older files make room for it, never the new one itself.
+        """
+        if len(data) > self.max_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        session_prefix = name.rsplit("-", 1)[0] + "-"
+        extension = os.path.splitext(name)[1]
+        with self._lock:
+            self._load()
+            for stale in [n for n in self._entries if n != name and n.startswith(session_prefix)
+                          and n.endswith(extension) and "-" not in n[len(session_prefix):]]:
+                self._bytes -= self._entries.pop(stale)
+                self._remove(stale)
+            self._bytes -= self._entries.pop(name, 0)
+            self._entries[name] = len(data)
+            self._bytes += len(data)
+            self._evict(keep=name)
+
+    def stats(self):
+        with self._lock:
+            return {"files": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
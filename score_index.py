@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import threading
+from collections import namedtuple
+from prompts import compile_score_block
+from admission_engine import build_model
+
+# One (province, stream) slice of a score-line file: the year -> batches dict,
+# the same data already serialized as the score block that opens the user
+# prompt (None for a stream with admissions data but no batches), and the AdmissionModel built from the optional score_rank/admissions
+# data (None without it).
+ScoreEntry = namedtuple('ScoreEntry', ['batches', 'prompt_block', 'model'])
+
+
+def normalize_stream(stream):
+    """Maps a frontend stream label to the key used in the score-line files."""
+    stream = stream or ''
+    # For new gaokao, map to traditional streams
+    if "物理" in stream:
+        return "理科"
+    if "历史" in stream:
+        return "文科"
+    # For provinces that don't distinguish
+    return stream
+
+
+def _parse_score_file(filepath, province):
+    """
+    Parses one province file into {stream_key: ScoreEntry}. Besides the batch
+    cut-offs, each year may carry, per stream:
+        "score_rank": {"理科": [[score, cumulative rank], ...]}  (一分一段表)
+        "admissions": {"理科": [{"school": "...", "major": "...", "min_rank": 1200, "min_score": 640}, ...]}
+    """
+    with open(filepath, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('province') != province:
+        print(f"Score data file {filepath} does not match province '{province}', skipped.")
+        return {}
+
+    by_stream = {}
+    score_rank = {}
+    admissions = {}
+    for yearly_entry in data.get('yearly_data', []):
+        year = yearly_entry.get('year', '未知年份')
+        for stream_key, batches in yearly_entry.get('batches', {}).items():
+            by_stream.setdefault(stream_key, {})[year] = batches
+        for stream_key, pairs in (yearly_entry.get('score_rank') or {}).items():
+            score_rank.setdefault(stream_key, {})[year] = pairs
+        for stream_key, rows in (yearly_entry.get('admissions') or {}).items():
+            admissions.setdefault(stream_key, {})[year] = rows
+
+    entries = {}
+    for stream_key in set(by_stream) | set(admissions):
+        batches = by_stream.get(stream_key, {})
+        entries[stream_key] = ScoreEntry(
+            batches, compile_score_block(batches) if batches else None,
+            build_model(score_rank.get(stream_key, {}), admissions.get(stream_key)),
+        )
+    return entries
+
+
+class ScoreLineIndex:
+    """
+    In-memory index of every `<province>.json` file in the score-lines directory,
+    keyed by (province, normalized stream).
+
+    Readers never take a lock: a reload builds a fresh dict and swaps the reference,
+    so in-flight requests keep using the snapshot they already hold.
+    """
+
+    def __init__(self, directory, check_interval=5.0):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._entries = {}   # {(province, stream_key): ScoreEntry}
+        self._files = {}     # {province: (mtime, {stream_key: ScoreEntry})}
+        self._last_check = None
+        self._reload_lock = threading.Lock()
+
+    def _scan(self):
+        """Returns {province: (path, mtime)} for every score-line file on disk."""
+        found = {}
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return found
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                found[name[:-len('.json')]] = (path, os.stat(path).st_mtime)
+            except FileNotFoundError:
+                continue
+        return found
+
+    def reload(self, force=False, blocking=True):
+        """Re-reads files whose mtime changed and atomically publishes a new index."""
+        if not self._reload_lock.acquire(blocking=blocking):
+            # Someone else is already reloading; keep serving the current snapshot.
+            return
+        try:
+            on_disk = self._scan()
+            files = {}
+            changed = force or set(on_disk) != set(self._files)
+            for province, (path, mtime) in on_disk.items():
+                cached = self._files.get(province)
+                if cached and cached[0] == mtime and not force:
+                    files[province] = cached
+                    continue
+                changed = True
+                try:
+                    files[province] = (mtime, _parse_score_file(path, province))
+                except (ValueError, OSError, AttributeError, KeyError, TypeError) as e:
+                    print(f"Error loading or parsing score data for {province}: {e}")
+                    # Keep serving the last good version of a file that is mid-write.
+                    if cached:
+                        files[province] = cached
+
+            if changed:
+                entries = {}
+                for province, (_, streams) in files.items():
+                    for stream_key, entry in streams.items():
+                        entries[(province, stream_key)] = entry
+                self._files = files
+                self._entries = entries
+                print(f"Score-line index loaded: {len(files)} provinces, {len(entries)} streams.")
+            self._last_check = time.monotonic()
+        finally:
+            self._reload_lock.release()
+
+    def _maybe_reload(self):
+        """Checks file mtimes at most once per `check_interval` seconds."""
+        last_check = self._last_check
+        if last_check is not None and time.monotonic() - last_check < self.check_interval:
+            return
+        # Only the very first access waits for the initial build.
+        self.reload(blocking=last_check is None)
+
+    def get(self, province, stream):
+        """Returns the ScoreEntry for a province and stream, or None."""
+        if not province:
+            return None
+        self._maybe_reload()
+        return self._entries.get((province, normalize_stream(stream)))
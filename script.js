@@ -3,6 +3,7 @@ document.addEventListener('DOMContentLoaded', () => {
     let suggestions = [];
     let sessionId = `session-${Date.now()}-${Math.random().toString(36).substring(2, 9)}`;
     let isAuthenticated = false;
+    const MAX_RECONNECT_ATTEMPTS = 3;
 
     // --- Element Cache ---
     const submitButton = document.getElementById('submit-button');
@@ -434,6 +435,17 @@ document.addEventListener('DOMContentLoaded', () => {
         let thinkStartTime = null;
         let firstThoughtChunkProcessed = false;
         let firstAnswerChunkReceived = false;
+        let sawReasoningEvent = false;
+        let wasQueued = false;
+        let lastEventId = null;
+        let reconnectAttempts = 0;
+
+        async function waitToReconnect() {
+            if (!lastEventId || reconnectAttempts >= MAX_RECONNECT_ATTEMPTS) return false;
+            reconnectAttempts++;
+            await new Promise(resolve => setTimeout(resolve, 1000 * reconnectAttempts));
+            return true;
+        }
 
         const debouncedRenderAnswerMarkdown = debounce(() => {
             const currentScroll = reportContainer.scrollTop;
@@ -448,197 +460,259 @@ document.addEventListener('DOMContentLoaded', () => {
         }, 150);
 
         try {
-            const response = await fetch('/api/handler', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    userInput,
-                    sessionId,
-                    invitationCode: modalInput.value.trim()
-                })
-            });
+            // After a dropped connection, reattach to the same answer instead of starting over.
+            while (true) {
+                let response;
+                try {
+                    const headers = { 'Content-Type': 'application/json' };
+                    if (lastEventId) headers['Last-Event-ID'] = lastEventId;
+                    response = await fetch('/api/handler', {
+                        method: 'POST',
+                        headers,
+                        body: JSON.stringify({
+                            userInput,
+                            sessionId,
+                            invitationCode: modalInput.value.trim()
+                        })
+                    });
+                } catch (networkError) {
+                    if (await waitToReconnect()) continue;
+                    throw networkError;
+                }
 
-            if (!response.ok || !response.body) {
-                const errorData = await response.json().catch(() => ({}));
-                if (errorData.usage) updateUsage(errorData.usage);
-                throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
-            }
+                if (!response.ok || !response.body) {
+                    const errorData = await response.json().catch(() => ({}));
+                    if (errorData.usage) updateUsage(errorData.usage);
+                    throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
+                }
 
-            const reader = response.body.getReader();
-            const decoder = new TextDecoder();
-            let buffer = '';
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+
+                let readError = null;
+                while (true) {
+                    let result;
+                    try {
+                        result = await reader.read();
+                    } catch (networkError) {
+                        readError = networkError;
+                        break;
+                    }
+                    const { done, value } = result;
+                    if (done) break;
+
+                    buffer += decoder.decode(value, { stream: true });
+                    
+                    let boundary = buffer.indexOf('\n\n');
+                    while (boundary !== -1) {
+                        let message = buffer.substring(0, boundary);
+                        buffer = buffer.substring(boundary + 2);
+
+                        // Numbered events let us pick up where we left off if the connection drops.
+                        const idMatch = message.match(/^id: (.*)$/m);
+                        if (idMatch) {
+                            lastEventId = idMatch[1];
+                            reconnectAttempts = 0;
+                        }
 
-            while (true) {
-                const { done, value } = await reader.read();
-                if (done) break;
-
-                buffer += decoder.decode(value, { stream: true });
-                
-                let boundary = buffer.indexOf('\n\n');
-                while (boundary !== -1) {
-                    const message = buffer.substring(0, boundary);
-                    buffer = buffer.substring(boundary + 2);
-
-                    if (message.startsWith('event: message')) {
-                        const data = message.substring(message.indexOf('data: ') + 6);
-                        try {
-                            let chunk = JSON.parse(data);
-                            let chunkHadDisplayableContent = false;
-
-                            if (inThinkBlock) {
-                                if (!thinkContentStarted) {
-                                    const startTagIndex = chunk.indexOf(thinkStartTag);
-                                    if (startTagIndex !== -1) {
-                                        chunk = chunk.substring(startTagIndex + thinkStartTag.length);
-                                        thinkContentStarted = true;
-                                        thinkStartTime = Date.now();
-                                        uiRefs.thinkContainer.style.display = 'block';
-                                    }
+                        // With SSE_SPLIT_THINK the server sends reasoning as its own event;
+                        // fold it back into the tagged form the handler below understands.
+                        const isReasoning = message.startsWith('event: reasoning');
+                        if (isReasoning && !inThinkBlock) {
+                            message = ''; // late reasoning after the report has started is not shown
+                        } else if (isReasoning || (sawReasoningEvent && inThinkBlock && message.startsWith('event: message'))) {
+                            try {
+                                let text = JSON.parse(message.substring(message.indexOf('data: ') + 6));
+                                if (isReasoning) {
+                                    text = (sawReasoningEvent ? '' : thinkStartTag) + text;
+                                    sawReasoningEvent = true;
+                                } else {
+                                    text = thinkEndTag + text;
                                 }
+                                message = 'event: message\ndata: ' + JSON.stringify(text);
+                            } catch (e) { console.error("Failed to parse reasoning token:", message, e); }
+                        }
 
-                                if (inThinkBlock && thinkContentStarted) {
-                                    const endTagIndex = chunk.indexOf(thinkEndTag);
-                                    if (endTagIndex !== -1) {
-                                        const thoughtPart = chunk.substring(0, endTagIndex);
-                                        currentThinkBuffer += thoughtPart;
-                                        accumulatedThoughtForDuration += thoughtPart;
-                                        if (thoughtPart.trim().length > 0) chunkHadDisplayableContent = true;
-
-                                        const answerPart = chunk.substring(endTagIndex + thinkEndTag.length);
-                                        currentAnswerBuffer += answerPart;
-                                        inThinkBlock = false;
-                                        if (answerPart.trim().length > 0) {
-                                            firstAnswerChunkReceived = true;
-                                            chunkHadDisplayableContent = true;
+                        if (message.startsWith('event: message')) {
+                            const data = message.substring(message.indexOf('data: ') + 6);
+                            try {
+                                let chunk = JSON.parse(data);
+                                let chunkHadDisplayableContent = false;
+
+                                if (inThinkBlock) {
+                                    if (!thinkContentStarted) {
+                                        const startTagIndex = chunk.indexOf(thinkStartTag);
+                                        if (startTagIndex !== -1) {
+                                            chunk = chunk.substring(startTagIndex + thinkStartTag.length);
+                                            thinkContentStarted = true;
+                                            thinkStartTime = Date.now();
+                                            uiRefs.thinkContainer.style.display = 'block';
                                         }
-                                        
-                                        // Smart collapse: wait 1s after think is finished
-                                        if (autoCollapseTimers.has(uiRefs.msgId)) clearTimeout(autoCollapseTimers.get(uiRefs.msgId));
-                                        const timerId = setTimeout(() => {
-                                            if (uiRefs.thinkWrapperElement.classList.contains('expanded')) {
-                                                uiRefs.thinkWrapperElement.classList.remove('expanded');
-                                                uiRefs.toggleElement.classList.remove('expanded');
-                                                uiRefs.toggleElement.innerHTML = `展开完整思考内容 <i class="fas fa-chevron-down"></i>`;
+                                    }
+
+                                    if (inThinkBlock && thinkContentStarted) {
+                                        const endTagIndex = chunk.indexOf(thinkEndTag);
+                                        if (endTagIndex !== -1) {
+                                            const thoughtPart = chunk.substring(0, endTagIndex);
+                                            currentThinkBuffer += thoughtPart;
+                                            accumulatedThoughtForDuration += thoughtPart;
+                                            if (thoughtPart.trim().length > 0) chunkHadDisplayableContent = true;
+
+                                            const answerPart = chunk.substring(endTagIndex + thinkEndTag.length);
+                                            currentAnswerBuffer += answerPart;
+                                            inThinkBlock = false;
+                                            if (answerPart.trim().length > 0) {
+                                                firstAnswerChunkReceived = true;
+                                                chunkHadDisplayableContent = true;
                                             }
-                                            autoCollapseTimers.delete(uiRefs.msgId);
-                                        }, 1000);
-                                        autoCollapseTimers.set(uiRefs.msgId, timerId);
-                                    } else {
-                                        currentThinkBuffer += chunk;
-                                        accumulatedThoughtForDuration += chunk;
-                                        if (chunk.trim().length > 0) chunkHadDisplayableContent = true;
+                                            
+                                            // Smart collapse: wait 1s after think is finished
+                                            if (autoCollapseTimers.has(uiRefs.msgId)) clearTimeout(autoCollapseTimers.get(uiRefs.msgId));
+                                            const timerId = setTimeout(() => {
+                                                if (uiRefs.thinkWrapperElement.classList.contains('expanded')) {
+                                                    uiRefs.thinkWrapperElement.classList.remove('expanded');
+                                                    uiRefs.toggleElement.classList.remove('expanded');
+                                                    uiRefs.toggleElement.innerHTML = `展开完整思考内容 <i class="fas fa-chevron-down"></i>`;
+                                                }
+                                                autoCollapseTimers.delete(uiRefs.msgId);
+                                            }, 1000);
+                                            autoCollapseTimers.set(uiRefs.msgId, timerId);
+                                        } else {
+                                            currentThinkBuffer += chunk;
+                                            accumulatedThoughtForDuration += chunk;
+                                            if (chunk.trim().length > 0) chunkHadDisplayableContent = true;
+                                        }
+                                    } else if (!inThinkBlock) {
+                                        currentAnswerBuffer += chunk;
+                                        if (chunk.trim().length > 0) {
+                                            if (!firstAnswerChunkReceived) firstAnswerChunkReceived = true;
+                                            chunkHadDisplayableContent = true;
+                                        }
                                     }
-                                } else if (!inThinkBlock) {
+                                } else {
                                     currentAnswerBuffer += chunk;
                                     if (chunk.trim().length > 0) {
                                         if (!firstAnswerChunkReceived) firstAnswerChunkReceived = true;
                                         chunkHadDisplayableContent = true;
                                     }
                                 }
-                            } else {
-                                currentAnswerBuffer += chunk;
-                                if (chunk.trim().length > 0) {
-                                    if (!firstAnswerChunkReceived) firstAnswerChunkReceived = true;
-                                    chunkHadDisplayableContent = true;
+
+                                if (chunkHadDisplayableContent && !streamHasStartedVisualOutput) {
+                                    streamHasStartedVisualOutput = true;
+                                    if (loadingPhaseTimeoutId) clearTimeout(loadingPhaseTimeoutId);
+                                    await runLoadingPhases();
                                 }
-                            }
 
-                            if (chunkHadDisplayableContent && !streamHasStartedVisualOutput) {
-                                streamHasStartedVisualOutput = true;
-                                if (loadingPhaseTimeoutId) clearTimeout(loadingPhaseTimeoutId);
-                                await runLoadingPhases();
-                            }
+                                if (thinkContentStarted && currentThinkBuffer.trim().length > 0 && !firstThoughtChunkProcessed) {
+                                    firstThoughtChunkProcessed = true;
+                                    uiRefs.thinkWrapperElement.classList.add('expanded');
+                                    uiRefs.toggleElement.classList.add('expanded');
+                                    uiRefs.toggleElement.innerHTML = `收起思考内容 <i class="fas fa-chevron-up"></i>`;
+                                }
 
-                            if (thinkContentStarted && currentThinkBuffer.trim().length > 0 && !firstThoughtChunkProcessed) {
-                                firstThoughtChunkProcessed = true;
-                                uiRefs.thinkWrapperElement.classList.add('expanded');
-                                uiRefs.toggleElement.classList.add('expanded');
-                                uiRefs.toggleElement.innerHTML = `收起思考内容 <i class="fas fa-chevron-up"></i>`;
-                            }
+                                if (inThinkBlock && thinkContentStarted) {
+                                    uiRefs.thinkCodeElement.textContent = currentThinkBuffer + (currentThinkBuffer.length > 0 ? "▍" : "");
+                                    if (uiRefs.thinkWrapperElement.classList.contains('expanded')) {
+                                        uiRefs.thinkWrapperElement.scrollTop = uiRefs.thinkWrapperElement.scrollHeight;
+                                    }
+                                } else if (currentThinkBuffer.length > 0 && uiRefs.thinkCodeElement.textContent.endsWith("▍")) {
+                                    uiRefs.thinkCodeElement.textContent = currentThinkBuffer.trim();
+                                }
 
-                            if (inThinkBlock && thinkContentStarted) {
-                                uiRefs.thinkCodeElement.textContent = currentThinkBuffer + (currentThinkBuffer.length > 0 ? "▍" : "");
-                                if (uiRefs.thinkWrapperElement.classList.contains('expanded')) {
-                                    uiRefs.thinkWrapperElement.scrollTop = uiRefs.thinkWrapperElement.scrollHeight;
+                                if (!inThinkBlock) {
+                                    if (!firstAnswerChunkReceived && currentAnswerBuffer.trim().length > 0) {
+                                        firstAnswerChunkReceived = true;
+                                    }
+                                    // First, update the raw text immediately for responsiveness
+                                    uiRefs.answerContent.innerText = currentAnswerBuffer + "▍";
+                                    // Then, trigger the debounced markdown rendering
+                                    if (firstAnswerChunkReceived) {
+                                        debouncedRenderAnswerMarkdown();
+                                    }
                                 }
-                            } else if (currentThinkBuffer.length > 0 && uiRefs.thinkCodeElement.textContent.endsWith("▍")) {
-                                uiRefs.thinkCodeElement.textContent = currentThinkBuffer.trim();
+                                
+                                reportContainer.scrollTop = reportContainer.scrollHeight;
+
+                            } catch (e) { console.error("Failed to parse token:", data, e); }
+                        } else if (message.startsWith('event: queued')) {
+                            const data = message.substring(message.indexOf('data: ') + 6);
+                            try {
+                                const queued = JSON.parse(data);
+                                if (loadingPhaseTimeoutId) clearTimeout(loadingPhaseTimeoutId);
+                                const eta = queued.eta_seconds ? `，预计等待约 ${Math.ceil(queued.eta_seconds)} 秒` : '';
+                                uiRefs.loadingTextSpan.textContent = `咨询人数较多，正在排队（前面还有 ${queued.position} 位）${eta}...`;
+                                wasQueued = true;
+                            } catch (e) { console.error("Failed to parse queue data:", data); }
+                        } else if (message.startsWith('event: usage')) {
+                            const data = message.substring(message.indexOf('data: ') + 6);
+                            try { updateUsage(JSON.parse(data)); } catch (e) { console.error("Failed to parse usage data:", data); }
+                            if (wasQueued) {
+                                // Our turn: resume the normal loading phases.
+                                wasQueued = false;
+                                runLoadingPhases();
                             }
+                        } else if (message.startsWith('event: end')) {
+                            if (loadingPhaseTimeoutId) clearTimeout(loadingPhaseTimeoutId);
+                            streamHasStartedVisualOutput = true;
+                            await runLoadingPhases();
 
-                            if (!inThinkBlock) {
-                                if (!firstAnswerChunkReceived && currentAnswerBuffer.trim().length > 0) {
-                                    firstAnswerChunkReceived = true;
-                                }
-                                // First, update the raw text immediately for responsiveness
-                                uiRefs.answerContent.innerText = currentAnswerBuffer + "▍";
-                                // Then, trigger the debounced markdown rendering
-                                if (firstAnswerChunkReceived) {
-                                    debouncedRenderAnswerMarkdown();
-                                }
+                            uiRefs.thinkCodeElement.textContent = currentThinkBuffer.trim();
+                            
+                            const debouncedFunc = debouncedRenderAnswerMarkdown;
+                            if (debouncedFunc && debouncedFunc._timeoutId) {
+                                 clearTimeout(debouncedFunc._timeoutId);
                             }
+                            uiRefs.answerContent.innerHTML = marked.parse(currentAnswerBuffer.trim());
                             
-                            reportContainer.scrollTop = reportContainer.scrollHeight;
-
-                        } catch (e) { console.error("Failed to parse token:", data, e); }
-                    } else if (message.startsWith('event: usage')) {
-                        const data = message.substring(message.indexOf('data: ') + 6);
-                        try { updateUsage(JSON.parse(data)); } catch (e) { console.error("Failed to parse usage data:", data); }
-                    } else if (message.startsWith('event: end')) {
-                        if (loadingPhaseTimeoutId) clearTimeout(loadingPhaseTimeoutId);
-                        streamHasStartedVisualOutput = true;
-                        await runLoadingPhases();
-
-                        uiRefs.thinkCodeElement.textContent = currentThinkBuffer.trim();
-                        
-                        const debouncedFunc = debouncedRenderAnswerMarkdown;
-                        if (debouncedFunc && debouncedFunc._timeoutId) {
-                             clearTimeout(debouncedFunc._timeoutId);
-                        }
-                        uiRefs.answerContent.innerHTML = marked.parse(currentAnswerBuffer.trim());
-                        
-                        if (accumulatedThoughtForDuration.trim() && thinkStartTime) {
-                            const thinkDuration = (Date.now() - thinkStartTime) / 1000;
-                            const durationSpan = uiRefs.previewElement.querySelector('.think-duration');
-                            if (durationSpan) durationSpan.textContent = `(耗时: ${thinkDuration.toFixed(1)}s)`;
-                        } else { uiRefs.thinkContainer.style.display = 'none'; }
-                        
-                        if (!currentAnswerBuffer.trim() && !currentThinkBuffer.trim()){
-                            uiRefs.answerContent.innerHTML = marked.parse("未收到有效回复。");
-                        }
-                        
-                        savePdfBtn.style.display = 'inline-block';
-                        
-                        // Show follow-up bar for the first time after a 1-second delay
-                        setTimeout(() => {
-                            if (!followUpContainer.classList.contains('visible')) {
-                                // Adjust padding to make space for the follow-up bar
-                                const followUpHeight = followUpContainer.offsetHeight;
-                                reportContainer.style.paddingBottom = `${followUpHeight}px`;
-                                
-                                // Use scrollIntoView for more reliable scrolling on all devices
-                                const lastMessage = reportContainer.querySelector('.bot-message:last-child, .user-message:last-child');
-                                if (lastMessage) {
-                                    lastMessage.scrollIntoView({ behavior: 'smooth', block: 'end' });
-                                } else {
-                                    reportContainer.scrollTop = reportContainer.scrollHeight;
-                                }
-
-                                followUpContainer.classList.add('visible');
-                                followUpTooltip.classList.add('visible');
-                                
-                                // Hide the tooltip after 2 seconds
-                                setTimeout(() => {
-                                    followUpTooltip.classList.remove('visible');
-                                }, 2000);
+                            if (accumulatedThoughtForDuration.trim() && thinkStartTime) {
+                                const thinkDuration = (Date.now() - thinkStartTime) / 1000;
+                                const durationSpan = uiRefs.previewElement.querySelector('.think-duration');
+                                if (durationSpan) durationSpan.textContent = `(耗时: ${thinkDuration.toFixed(1)}s)`;
+                            } else { uiRefs.thinkContainer.style.display = 'none'; }
+                            
+                            if (!currentAnswerBuffer.trim() && !currentThinkBuffer.trim()){
+                                uiRefs.answerContent.innerHTML = marked.parse("未收到有效回复。");
                             }
-                        }, 1000); // 1-second delay before showing the bar
-                        return;
-                    } else if (message.startsWith('event: error')) {
-                        const data = message.substring(message.indexOf('data: ') + 6);
-                        throw new Error(`Stream error: ${data}`);
+                            
+                            savePdfBtn.style.display = 'inline-block';
+                            
+                            // Show follow-up bar for the first time after a 1-second delay
+                            setTimeout(() => {
+                                if (!followUpContainer.classList.contains('visible')) {
+                                    // Adjust padding to make space for the follow-up bar
+                                    const followUpHeight = followUpContainer.offsetHeight;
+                                    reportContainer.style.paddingBottom = `${followUpHeight}px`;
+                                    
+                                    // Use scrollIntoView for more reliable scrolling on all devices
+                                    const lastMessage = reportContainer.querySelector('.bot-message:last-child, .user-message:last-child');
+                                    if (lastMessage) {
+                                        lastMessage.scrollIntoView({ behavior: 'smooth', block: 'end' });
+                                    } else {
+                                        reportContainer.scrollTop = reportContainer.scrollHeight;
+                                    }
+
+                                    followUpContainer.classList.add('visible');
+                                    followUpTooltip.classList.add('visible');
+                                    
+                                    // Hide the tooltip after 2 seconds
+                                    setTimeout(() => {
+                                        followUpTooltip.classList.remove('visible');
+                                    }, 2000);
+                                }
+                            }, 1000); // 1-second delay before showing the bar
+                            return;
+                        } else if (message.startsWith('event: error')) {
+                            const data = message.substring(message.indexOf('data: ') + 6);
+                            throw new Error(`Stream error: ${data}`);
+                        }
+                        boundary = buffer.indexOf('\n\n');
                     }
-                    boundary = buffer.indexOf('\n\n');
                 }
+                // The stream ended without an "end" event: the connection dropped.
+                if (await waitToReconnect()) continue;
+                if (readError) throw readError;
+                break;
             }
         } catch(error) {
             console.error("Submit/Fetch Error:", error);
@@ -659,6 +733,31 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    async function downloadServerReport(format) {
+        // Returns false when the server can't export (e.g. no PDF renderer), so the caller can fall back.
+        try {
+            const response = await fetch('/api/report', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ sessionId, invitationCode: modalInput.value.trim(), format })
+            });
+            if (!response.ok) return false;
+            const blob = await response.blob();
+            const url = URL.createObjectURL(blob);
+            const link = document.createElement('a');
+            link.href = url;
+            link.download = `高考志愿AI分析报告.${format}`;
+            document.body.appendChild(link);
+            link.click();
+            document.body.removeChild(link);
+            setTimeout(() => URL.revokeObjectURL(url), 1000);
+            return true;
+        } catch (error) {
+            console.error("Server report export failed:", error);
+            return false;
+        }
+    }
+
     async function handleSavePdf() {
         const reportToSave = reportContainer.querySelector('.bot-message:last-child');
         const userBubbleToSave = reportContainer.querySelector('.user-message:last-child');
@@ -671,6 +770,13 @@ document.addEventListener('DOMContentLoaded', () => {
         savePdfBtn.disabled = true;
         savePdfBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> 正在生成...';
 
+        // Prefer the server-rendered PDF: it is cached and spares low-end phones the rendering.
+        if (await downloadServerReport('pdf')) {
+            savePdfBtn.disabled = false;
+            savePdfBtn.innerHTML = '<i class="fas fa-file-pdf"></i> 保存为PDF';
+            return;
+        }
+
         try {
             const { jsPDF } = window.jspdf;
             
@@ -779,6 +885,7 @@ ${dilemma || '未填写'}
             province: province,
             stream: streamText,
             rank: rank ? parseInt(rank, 10) : null,
+            scoreType: scoreType,
             rawText: rawText,
         };
     }
@@ -0,0 +1,336 @@
+"""
+Operational analytics over the session store: sessions per province, turns
+per session, initial report length and how often students ask follow-ups.
+
+Session files are streamed shard by shard and parsed line by line, so no
+conversation is ever held in memory whole. Each file is reduced to a small
+per-session summary, and those summaries are kept in a cache file keyed by
+path with the file's mtime and size. A re-run only re-parses sessions that
+are new or changed since the last one, spread over a process pool when there
+are many. The totals are then folded from the cached summaries and written
+to a small summary file, which is all the web server ever reads.
+
+Parsing is CPU-bound, so it never runs inside a web worker: run this command
+from cron, or let the server launch it as a separate process every
+ANALYTICS_REFRESH_INTERVAL seconds.
+
+Usage:
+    python session_analytics.py [sessions_dir] [--cache _data/analytics_cache.json]
+                                [--summary _data/analytics.json] [--workers 4]
+"""
+import os
+import re
+import sys
+import json
+import time
+import subprocess
+import argparse
+import threading
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+CACHE_VERSION = 1
+UNKNOWN_PROVINCE = "未知"
+# The frontend puts "省份: <name>" on the first line of the initial question.
+PROVINCE_PATTERN = re.compile(r'^\s*省份[:：]\s*(\S+)', re.M)
+BEIJING_TZ = timezone(timedelta(hours=8))
+
+
+def iter_session_files(directory):
+    """Yields (relative path, path, mtime_ns, size) for every session file, one shard at a time."""
+    try:
+        shards = list(os.scandir(directory))
+    except FileNotFoundError:
+        return
+    for shard in shards:
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            if not entry.name.endswith('.jsonl'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            yield f"{shard.name}/{entry.name}", entry.path, st.st_mtime_ns, st.st_size
+
+
+def iter_turns(path):
+    """Yields (ts, messages) for each intact turn of a session file; torn lines are skipped."""
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            messages = record.get('messages') if isinstance(record, dict) else None
+            if isinstance(messages, list):
+                yield record.get('ts'), [m for m in messages if isinstance(m, dict)]
+
+
+def summarize_session(path):
+    """One session reduced to the numbers the report needs, or None if the file vanished."""
+    summary = {"province": UNKNOWN_PROVINCE, "turns": 0, "report_chars": 0, "first_ts": None, "last_ts": None}
+    try:
+        for ts, messages in iter_turns(path):
+            if summary["turns"] == 0:
+                question = next((m.get('content') or '' for m in messages if m.get('role') == 'user'), '')
+                match = PROVINCE_PATTERN.search(question)
+                if match:
+                    summary["province"] = match.group(1)
+                summary["report_chars"] = sum(len(m.get('content') or '')
+                                              for m in messages if m.get('role') == 'assistant')
+                summary["first_ts"] = ts
+            summary["turns"] += 1
+            summary["last_ts"] = ts
+    except FileNotFoundError:
+        return None
+    return summary
+
+
+def _new_totals():
+    return {"sessions": 0, "turns": 0, "follow_up_sessions": 0, "report_chars": 0}
+
+
+def _add(totals, session):
+    totals["sessions"] += 1
+    totals["turns"] += session["turns"]
+    totals["follow_up_sessions"] += session["turns"] > 1
+    totals["report_chars"] += session["report_chars"]
+
+
+def _finish(totals):
+    sessions = totals["sessions"]
+    return {
+        "sessions": sessions,
+        "turns": totals["turns"],
+        "avg_turns": round(totals["turns"] / sessions, 2) if sessions else 0,
+        "avg_report_chars": round(totals["report_chars"] / sessions) if sessions else 0,
+        "follow_up_ratio": round(totals["follow_up_sessions"] / sessions, 3) if sessions else 0,
+    }
+
+
+def aggregate(sessions):
+    """Overall, per-province and per-day (Beijing time, by first turn) totals of session summaries."""
+    overall = _new_totals()
+    by_province = {}
+    by_day = {}
+    for session in sessions:
+        if not session["turns"]:
+            continue
+        _add(overall, session)
+        _add(by_province.setdefault(session["province"], _new_totals()), session)
+        if isinstance(session["first_ts"], (int, float)):
+            day = datetime.fromtimestamp(session["first_ts"], BEIJING_TZ).strftime('%Y-%m-%d')
+            _add(by_day.setdefault(day, _new_totals()), session)
+    return {
+        "overall": _finish(overall),
+        "by_province": {name: _finish(t) for name, t in sorted(by_province.items(), key=lambda kv: -kv[1]["sessions"])},
+        "by_day": {day: _finish(t) for day, t in sorted(by_day.items())},
+    }
+
+
+class SessionAnalytics:
+    """
+    Incrementally maintained analytics for one sessions directory.
+
+    `refresh()` re-parses only the files whose mtime or size changed since the
+    cache file was written (by this process, another run, or the command
+    line), rewrites it atomically and writes the totals to `summary_path`.
+
+    The web server only calls `read_summary()`, which loads that small file,
+    and `start_refresher()`, which runs `refresh()` in a child process.
+    """
+
+    def __init__(self, directory, cache_path, summary_path, workers=1, min_parallel=64):
+        self.directory = directory
+        self.cache_path = cache_path
+        self.summary_path = summary_path
+        self.workers = workers
+        self.min_parallel = min_parallel
+        self._files = {}
+        self._cache_mtime = None # of the cache file as last read or written by us
+        self._summary = None
+        self._summary_mtime = None
+        self._refresh_lock = threading.Lock()
+        self._refresher_thread = None
+        self._refresher_pid = None
+        self.refreshes = 0
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache.get("version") == CACHE_VERSION:
+                return cache
+        except FileNotFoundError:
+            pass
+        except (ValueError, OSError, AttributeError) as e:
+            print(f"Error loading analytics cache {self.cache_path}: {e}")
+        return {"files": {}}
+
+    def _cached_files(self):
+        """Per-file summaries, re-read from disk only if someone else rewrote the cache file."""
+        try:
+            mtime = os.stat(self.cache_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._cache_mtime:
+            self._files = self._load_cache()["files"]
+            self._cache_mtime = mtime
+        return self._files
+
+    @staticmethod
+    def _write_json(path, data):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _summarize(self, paths):
+        if self.workers > 1 and len(paths) >= self.min_parallel:
+            chunksize = max(1, len(paths) // (self.workers * 8))
+            with ProcessPoolExecutor(self.workers) as pool:
+                return list(pool.map(summarize_session, paths, chunksize=chunksize))
+        return [summarize_session(path) for path in paths]
+
+    def refresh(self):
+        """Brings the cache up to date with the sessions on disk and returns the new summary."""
+        with self._refresh_lock:
+            started = time.monotonic()
+            cached = self._cached_files()
+            files = {}
+            changed = []
+            for rel, path, mtime_ns, size in iter_session_files(self.directory):
+                old = cached.get(rel)
+                if old is not None and old[0] == mtime_ns and old[1] == size:
+                    files[rel] = old
+                else:
+                    changed.append((rel, path, mtime_ns, size))
+            summaries = self._summarize([path for _, path, _, _ in changed])
+            for (rel, _, mtime_ns, size), session in zip(changed, summaries):
+                if session is not None:
+                    files[rel] = [mtime_ns, size, session]
+
+            summary = aggregate(entry[2] for entry in files.values())
+            summary.update({
+                "generated_at": time.time(),
+                "files": len(files),
+                "files_parsed": len(changed),
+                "refresh_seconds": round(time.monotonic() - started, 3),
+            })
+            if changed or len(files) != len(cached):
+                self._write_json(self.cache_path, {"version": CACHE_VERSION, "files": files})
+                self._cache_mtime = os.stat(self.cache_path).st_mtime_ns
+            self._files = files
+            self._write_json(self.summary_path, summary)
+            return summary
+
+    def read_summary(self):
+        """The summary last written by a refresh, or None if there hasn't been one. Re-read only when it changes."""
+        try:
+            mtime = os.stat(self.summary_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if mtime != self._summary_mtime:
+            try:
+                with open(self.summary_path, 'r', encoding='utf-8') as f:
+                    self._summary = json.load(f)
+            except FileNotFoundError:
+                return None
+            self._summary_mtime = mtime
+        return self._summary
+
+    # --- Refreshing from the server ---
+    @property
+    def _lock_path(self):
+        return self.summary_path + ".lock"
+
+    def _claim_refresh(self):
+        """
+        Takes the refresh lock file shared by all workers; False if another
+        live process holds it. A lock left by a process that died is cleared.
+        """
+        try:
+            fd = os.open(self._lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(self._lock_path, 'r') as f:
+                    os.kill(int(f.read()), 0)
+            except (ProcessLookupError, ValueError):
+                self._release_refresh()
+            except (FileNotFoundError, PermissionError):
+                pass
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(os.getpid()))
+        return True
+
+    def _release_refresh(self):
+        try:
+            os.remove(self._lock_path)
+        except FileNotFoundError:
+            pass
+
+    def refresh_in_subprocess(self):
+        """
+        Runs the refresh as `python session_analytics.py` in a child process,
+        so the parsing never holds this worker's GIL or event loop. Returns
+        False if another worker's refresh is already running.
+        """
+        if not self._claim_refresh():
+            return False
+        try:
+            command = [sys.executable, os.path.abspath(__file__), self.directory, "--cache", self.cache_path,
+                       "--summary", self.summary_path, "--workers", str(self.workers)]
+            subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+            self.refreshes += 1
+        finally:
+            self._release_refresh()
+        return True
+
+    def start_refresher(self, interval):
+        """Refreshes in a child process whenever the summary is missing or older than `interval` seconds."""
+        if interval <= 0:
+            return
+        if self._refresher_thread is not None and self._refresher_thread.is_alive() and self._refresher_pid == os.getpid():
+            return
+
+        def run():
+            while True:
+                summary = self.read_summary()
+                if summary is None or time.time() - summary["generated_at"] >= interval:
+                    try:
+                        self.refresh_in_subprocess()
+                    except (OSError, subprocess.SubprocessError) as e:
+                        print(f"Error refreshing session analytics: {e}")
+                time.sleep(interval)
+
+        self._refresher_pid = os.getpid()
+        self._refresher_thread = threading.Thread(target=run, name="session-analytics", daemon=True)
+        self._refresher_thread.start()
+
+    def stats(self):
+        summary = self._summary
+        return {"refreshes": self.refreshes, "generated_at": summary["generated_at"] if summary else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", nargs="?", default="sessions")
+    parser.add_argument("--cache", default=os.path.join("_data", "analytics_cache.json"), help="incremental cache file")
+    parser.add_argument("--summary", default=os.path.join("_data", "analytics.json"), help="summary file the server serves")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processes for parsing changed files")
+    args = parser.parse_args(argv)
+    summary = SessionAnalytics(args.directory, args.cache, args.summary, workers=args.workers).refresh()
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
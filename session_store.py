@@ -0,0 +1,518 @@
+import os
+import re
+import sys
+import json
+import time
+import queue
+import hashlib
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
+try:
+    import fcntl
+except ImportError: # Windows: locking is per process only
+    fcntl = None
+
+TAIL_BLOCK_SIZE = 8192
+MIGRATING_SUFFIX = '.migrating' # a pre-sharding file claimed by one worker's migration
+SHARD_LOCK_NAME = '.lock' # flock()ed by every process writing to the shard
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+
+
+def is_valid_session_id(session_id):
+    """Session ids become file names, so only allow a safe character set."""
+    return isinstance(session_id, str) and bool(SESSION_ID_PATTERN.match(session_id))
+
+
+# A cached tail of a session: the file size it was read at, its last turns
+# (each a list of messages), whether those are all of the session's turns, and
+# the approximate number of bytes they hold.
+CachedSession = namedtuple('CachedSession', ['file_size', 'turns', 'complete', 'nbytes'])
+
+
+class SessionCache:
+    """LRU cache of recently active session tails, bounded by total content size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, session_id, file_size):
+        """Returns the cached entry if it still matches the file on disk."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry.file_size != file_size:
+                return None
+            self._entries.move_to_end(session_id)
+            return entry
+
+    def put(self, session_id, entry):
+        if entry.nbytes > self.max_bytes:
+            self.discard(session_id)
+            return
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[session_id] = entry
+            self._bytes += entry.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def peek(self, session_id):
+        return self._entries.get(session_id)
+
+    def discard(self, session_id):
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def _turn_bytes(turn):
+    return sum(len(m.get('content') or '') for m in turn if isinstance(m, dict))
+
+
+class SessionStore:
+    """
+    Append-only conversation storage: one `<shard>/<session_id>.jsonl` file per
+    session, one line per turn, e.g.
+    {"ts": ..., "messages": [{"role": "user", ...}, {"role": "assistant", ...}]}.
+
+    Saving a turn is a single append, and loading the last K turns seeks back
+    from the end of the file instead of parsing the whole conversation; recently
+    active tails are kept in an LRU cache that is validated against the file
+    size, so appends from other worker processes are never missed. Files are
+    spread over 256 hash-prefix shard directories. Torn lines, legacy flat files
+    and sessions idle for longer than `ttl` seconds are handled by background
+    threads.
+    """
+
+    def __init__(self, directory, ttl=0, cache_max_bytes=32 * 1024 * 1024, cache_turns=8, lock_stripes=64):
+        self.directory = directory
+        self.ttl = ttl
+        self.cache_turns = cache_turns
+        self.cache = SessionCache(cache_max_bytes)
+        self._locks = [threading.Lock() for _ in range(lock_stripes)]
+        self._compact_queue = queue.Queue()
+        self._compact_thread = None
+        self._compact_pid = None
+        self._reaper_thread = None
+        self._reaper_pid = None
+        self.reaped = 0
+
+    # --- Paths & locks ---
+    @staticmethod
+    def shard_for(session_id):
+        return hashlib.md5(session_id.encode('utf-8')).hexdigest()[:2]
+
+    def path_for(self, session_id):
+        if not is_valid_session_id(session_id):
+            raise ValueError(f"Invalid session id: {session_id!r}")
+        return os.path.join(self.directory, self.shard_for(session_id), f"{session_id}.jsonl")
+
+    def _flat_paths_for(self, session_id):
+        """Pre-sharding locations: the legacy `.json` file and the flat `.jsonl` file."""
+        if not is_valid_session_id(session_id):
+            raise ValueError(f"Invalid session id: {session_id!r}")
+        return (os.path.join(self.directory, f"{session_id}.json"),
+                os.path.join(self.directory, f"{session_id}.jsonl"))
+
+    def _lock_for(self, session_id):
+        return self._locks[hash(session_id) % len(self._locks)]
+
+    @contextmanager
+    def _write_lock(self, session_id):
+        """
+        Held for every change to a session file: the session's lock in this
+        process plus an flock on its shard, shared with the other gunicorn
+        workers, so a rewrite (compaction, migration) can't drop an append
+        made by another process in between.
+        """
+        with self._lock_for(session_id):
+            if fcntl is None:
+                yield
+                return
+            shard_dir = os.path.join(self.directory, self.shard_for(session_id))
+            os.makedirs(shard_dir, exist_ok=True)
+            fd = os.open(os.path.join(shard_dir, SHARD_LOCK_NAME), os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd) # releases the flock
+
+    # --- Reads ---
+    @staticmethod
+    def _read_tail_lines(path, count):
+        """Returns the last `count` non-empty lines of a file, reading backwards in blocks."""
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            data = b''
+            while pos > 0 and data.count(b'\n') <= count:
+                step = min(TAIL_BLOCK_SIZE, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        lines = data.split(b'\n')
+        if pos > 0:
+            lines = lines[1:] # The first line is cut off mid-way.
+        return [line for line in lines if line.strip()][-count:]
+
+    def _parse_turns(self, session_id, lines):
+        turns = []
+        for line in lines:
+            try:
+                turns.append(json.loads(line)['messages'])
+            except (ValueError, KeyError, TypeError):
+                self.schedule_compaction(session_id)
+        return turns
+
+    def load_recent(self, session_id, turns):
+        """Returns the messages of the last `turns` turns of a session, oldest first."""
+        if turns <= 0:
+            return []
+        path = self.path_for(session_id)
+        self._migrate_flat(session_id)
+        try:
+            file_size = os.stat(path).st_size
+        except FileNotFoundError:
+            return []
+
+        entry = self.cache.get(session_id, file_size)
+        if entry is not None and (entry.complete or len(entry.turns) >= turns):
+            self.cache.record(hit=True)
+            return [m for turn in entry.turns[-turns:] for m in turn]
+        self.cache.record(hit=False)
+
+        fetch = max(turns, self.cache_turns)
+        try:
+            lines = self._read_tail_lines(path, fetch)
+        except FileNotFoundError:
+            return []
+        recent = self._parse_turns(session_id, lines)
+        cached = recent[-self.cache_turns:]
+        with self._lock_for(session_id):
+            # Only cache what we read if no append landed while we were reading it.
+            try:
+                unchanged = os.stat(path).st_size == file_size
+            except FileNotFoundError:
+                unchanged = False
+            if unchanged:
+                self.cache.put(session_id, CachedSession(
+                    file_size, cached, len(lines) < fetch and len(cached) == len(recent),
+                    sum(_turn_bytes(t) for t in cached)
+                ))
+        return [m for turn in recent[-turns:] for m in turn]
+
+    def load_all(self, session_id):
+        """Returns every message of a session, oldest first."""
+        path = self.path_for(session_id)
+        self._migrate_flat(session_id)
+        try:
+            with open(path, 'rb') as f:
+                lines = [line for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+        return [m for turn in self._parse_turns(session_id, lines) for m in turn]
+
+    # --- Writes ---
+    def append_turn(self, session_id, messages):
+        """Appends one turn (a list of messages) to a session as a single JSONL record."""
+        path = self.path_for(session_id)
+        self._migrate_flat(session_id)
+        record = json.dumps({"ts": time.time(), "messages": messages}, ensure_ascii=False)
+        with self._write_lock(session_id):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as f:
+                old_size = f.tell()
+                if old_size > 0 and not self._ends_with_newline(path):
+                    # The previous write was torn; start a fresh line and clean up later.
+                    f.write(b'\n')
+                    self.schedule_compaction(session_id)
+                f.write(record.encode('utf-8') + b'\n')
+                new_size = f.tell()
+
+            # Extend the cached tail in place if it was current; otherwise drop it.
+            entry = self.cache.peek(session_id)
+            if entry is not None and entry.file_size == old_size:
+                turns = (entry.turns + [messages])[-self.cache_turns:]
+                self.cache.put(session_id, CachedSession(
+                    new_size, turns, entry.complete and len(turns) == len(entry.turns) + 1,
+                    sum(_turn_bytes(t) for t in turns)
+                ))
+            else:
+                self.cache.discard(session_id)
+
+    @staticmethod
+    def _ends_with_newline(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def _write_turns(self, session_id, turns):
+        """Atomically replaces a session file with the given turns (needs the write lock)."""
+        path = self.path_for(session_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Per process and thread: another worker may be rewriting the same file.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for turn in turns:
+                f.write(json.dumps(turn, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, path)
+        self.cache.discard(session_id)
+
+    # --- Migration & compaction ---
+    @staticmethod
+    def _legacy_to_turns(history, ts):
+        """Groups a legacy flat message list into user/assistant turns."""
+        if not all(isinstance(message, dict) for message in history):
+            raise TypeError("legacy history holds something other than messages")
+        turns = []
+        i = 0
+        while i < len(history):
+            if (i + 1 < len(history) and history[i].get('role') == 'user'
+                    and history[i + 1].get('role') == 'assistant'):
+                turns.append({"ts": ts, "messages": history[i:i + 2]})
+                i += 2
+            else:
+                turns.append({"ts": ts, "messages": [history[i]]})
+                i += 1
+        return turns
+
+    @staticmethod
+    def _read_records(path):
+        records = []
+        try:
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return records
+
+    @staticmethod
+    def _claim(path):
+        """
+        Renames a pre-sharding file to a name private to this thread, or returns
+        None if it is gone. Every gunicorn worker migrates at startup; the
+        rename is atomic, so only one of them gets to move each file.
+        """
+        claimed = f"{path}.{os.getpid()}.{threading.get_ident()}{MIGRATING_SUFFIX}"
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        return claimed
+
+    @staticmethod
+    def _unclaim(claimed):
+        """Puts a claimed file back under its own name, unless a newer one took its place."""
+        original = claimed[:-len(MIGRATING_SUFFIX)].rsplit('.', 2)[0]
+        try:
+            if os.path.exists(original):
+                print(f"Cannot restore {claimed}: {original} exists again; left for manual recovery.")
+                return
+            os.rename(claimed, original)
+        except FileNotFoundError:
+            pass
+
+    def _migrate_flat(self, session_id):
+        """Moves a pre-sharding `<id>.json` / `<id>.jsonl` file into its shard."""
+        legacy_path, flat_path = self._flat_paths_for(session_id)
+        if not os.path.exists(legacy_path) and not os.path.exists(flat_path):
+            return False
+        with self._write_lock(session_id):
+            claimed = [self._claim(legacy_path), self._claim(flat_path)]
+            if claimed == [None, None]:
+                return False # already migrated, by another worker or thread
+            legacy_path, flat_path = claimed
+            try:
+                turns = []
+                if legacy_path is not None:
+                    with open(legacy_path, 'r', encoding='utf-8') as f:
+                        history = json.load(f)
+                    turns = self._legacy_to_turns(history if isinstance(history, list) else [],
+                                                  os.path.getmtime(legacy_path))
+                # Older formats go first; anything already in the newer location follows.
+                if flat_path is not None:
+                    turns += self._read_records(flat_path)
+                turns += self._read_records(self.path_for(session_id))
+                self._write_turns(session_id, turns)
+            except (ValueError, AttributeError, TypeError) as e:
+                # Unreadable (not UTF-8, not JSON, not a list of messages): keep the file as it was.
+                print(f"Cannot migrate session {session_id}: {e!r}")
+                for path in claimed:
+                    if path is not None:
+                        self._unclaim(path)
+                return False
+            except BaseException:
+                for path in claimed:
+                    if path is not None:
+                        self._unclaim(path)
+                raise
+            for path in claimed:
+                if path is not None:
+                    os.remove(path)
+        return True
+
+    def _recover_claims(self):
+        """Puts back files whose migration was claimed by a process that has since died."""
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(MIGRATING_SUFFIX) or not entry.is_file():
+                continue
+            try:
+                pid = int(entry.name[:-len(MIGRATING_SUFFIX)].rsplit('.', 2)[1])
+                os.kill(pid, 0)
+            except (ValueError, IndexError, ProcessLookupError):
+                self._unclaim(entry.path) # its migration never finished
+            except PermissionError:
+                pass # alive, but owned by another user
+
+    def migrate_all(self):
+        """Moves every pre-sharding session file into its shard. Returns the number migrated."""
+        self._recover_claims()
+        migrated = 0
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            session_id, ext = os.path.splitext(entry.name)
+            if ext in ('.json', '.jsonl') and is_valid_session_id(session_id) and self._migrate_flat(session_id):
+                migrated += 1
+        return migrated
+
+    def compact(self, session_id):
+        """Rewrites a session file keeping only well-formed turn records."""
+        with self._write_lock(session_id):
+            path = self.path_for(session_id)
+            if not os.path.exists(path):
+                return False
+            turns = [turn for turn in self._read_records(path)
+                     if isinstance(turn, dict) and isinstance(turn.get('messages'), list)]
+            self._write_turns(session_id, turns)
+        return True
+
+    def schedule_compaction(self, session_id):
+        self._ensure_compactor()
+        self._compact_queue.put(session_id)
+
+    def _ensure_compactor(self):
+        # Also restart after a fork: threads don't survive into gunicorn workers.
+        if self._compact_thread is not None and self._compact_thread.is_alive() and self._compact_pid == os.getpid():
+            return
+        self._compact_pid = os.getpid()
+        self._compact_thread = threading.Thread(target=self._run_compactor, name="session-compactor", daemon=True)
+        self._compact_thread.start()
+
+    def _run_compactor(self):
+        while True:
+            session_id = self._compact_queue.get()
+            try:
+                self.compact(session_id)
+            except OSError as e:
+                print(f"Error compacting session {session_id}: {e}")
+
+    def migrate_in_background(self):
+        """Starts a one-off background migration of pre-sharding session files."""
+        def run():
+            try:
+                migrated = self.migrate_all()
+                if migrated:
+                    print(f"Migrated {migrated} session files into sharded JSONL.")
+            except OSError as e:
+                print(f"Error migrating session files: {e}")
+        threading.Thread(target=run, name="session-migration", daemon=True).start()
+
+    # --- Expiry ---
+    def reap_expired(self, now=None):
+        """Deletes sessions not written to for longer than `ttl` seconds. Returns the count."""
+        if self.ttl <= 0:
+            return 0
+        cutoff = (now if now is not None else time.time()) - self.ttl
+        reaped = 0
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith('.jsonl'):
+                    continue
+                session_id = entry.name[:-len('.jsonl')]
+                if not is_valid_session_id(session_id):
+                    continue
+                with self._write_lock(session_id):
+                    try:
+                        if os.stat(entry.path).st_mtime >= cutoff:
+                            continue
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    self.cache.discard(session_id)
+                    reaped += 1
+        self.reaped += reaped
+        return reaped
+
+    def start_reaper(self, interval):
+        """Runs `reap_expired` every `interval` seconds in a background thread."""
+        if self.ttl <= 0:
+            return
+        if self._reaper_thread is not None and self._reaper_thread.is_alive() and self._reaper_pid == os.getpid():
+            return
+
+        def run():
+            while True:
+                try:
+                    reaped = self.reap_expired()
+                    if reaped:
+                        print(f"Reaped {reaped} expired sessions.")
+                except OSError as e:
+                    print(f"Error reaping expired sessions: {e}")
+                time.sleep(interval)
+
+        self._reaper_pid = os.getpid()
+        self._reaper_thread = threading.Thread(target=run, name="session-reaper", daemon=True)
+        self._reaper_thread.start()
+
+    def stats(self):
+        return {**self.cache.stats(), "reaped": self.reaped}
+
+
+if __name__ == "__main__":
+    # Usage: python session_store.py migrate|reap [sessions_dir] [ttl_days]
+    if len(sys.argv) < 2 or sys.argv[1] not in ('migrate', 'reap'):
+        print("Usage: python session_store.py migrate|reap [sessions_dir] [ttl_days]")
+        sys.exit(1)
+    directory = sys.argv[2] if len(sys.argv) > 2 else 'sessions'
+    if sys.argv[1] == 'migrate':
+        store = SessionStore(directory)
+        print(f"Migrated {store.migrate_all()} session files into sharded JSONL.")
+    else:
+        ttl_days = float(sys.argv[3]) if len(sys.argv) > 3 else 180
+        store = SessionStore(directory, ttl=ttl_days * 86400)
+        print(f"Reaped {store.reap_expired()} expired sessions.")
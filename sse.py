@@ -0,0 +1,176 @@
+import json
+import time
+import queue
+import threading
+
+
+def sse_event(event, text):
+    """One SSE event carrying a JSON-encoded text chunk."""
+    return f"event: {event}\ndata: {json.dumps(text)}\n\n"
+
+
+def sse_message(text):
+    """One `message` event, the form script.js reads answer tokens in."""
+    return sse_event("message", text)
+
+
+def with_event_id(frame, event_id):
+    """
+    Adds an `id:` field to a frame, right after its `event:` line so that
+    readers matching on the leading `event:` line still see it first.
+    """
+    head, _, rest = frame.partition("\n")
+    return f"{head}\nid: {event_id}\n{rest}"
+
+
+class DeltaCoalescer:
+    """
+    Buffers upstream deltas so that many tiny tokens go out as one SSE frame.
+
+    `push()` returns the buffered text once `max_delay_ms` have passed since the
+    last frame went out or `max_bytes` have piled up, otherwise None. If no
+    delta arrives in time, `poll()` hands out the text once `time_left()` has
+    run down, so nothing is held back longer than `max_delay_ms`; `flush()`
+    drains the rest at the end. With `max_delay_ms` <= 0 every delta is passed
+    straight through.
+    """
+
+    def __init__(self, max_delay_ms=50, max_bytes=1024, clock=time.monotonic):
+        self.max_delay = max_delay_ms / 1000
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._parts = []
+        self._size = 0
+        self._last_emit = None
+
+    def push(self, delta):
+        if self.max_delay <= 0:
+            return delta
+        self._parts.append(delta)
+        self._size += len(delta.encode('utf-8'))
+        now = self._clock()
+        if (self._last_emit is None or now - self._last_emit >= self.max_delay
+                or self._size >= self.max_bytes):
+            self._last_emit = now
+            return self.flush()
+        return None
+
+    def time_left(self):
+        """Seconds until the buffered text is due; None if nothing is buffered."""
+        if not self._parts:
+            return None
+        return max(self._last_emit + self.max_delay - self._clock(), 0.0)
+
+    def poll(self):
+        """The buffered text if it is due, otherwise None."""
+        if self._parts and self._clock() - self._last_emit >= self.max_delay:
+            self._last_emit = self._clock()
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        return text
+
+
+_END = object()
+READER_JOIN_TIMEOUT = 5 # seconds to wait for the delta reader once the consumer stops
+
+
+def _deltas_with_deadlines(deltas, coalescer, abort=None):
+    """
+    Yields the deltas, and None whenever the coalescer's buffered text falls
+    due before the next delta arrives. The deltas are pulled on a reader
+    thread (a greenlet under gevent) so that waiting for one can time out.
+
+    If the consumer stops early (the client went away), the reader stops
+    pulling and closes `deltas` itself; `abort()` is called to cut off an
+    upstream read it may be blocked in.
+    """
+    if coalescer.max_delay <= 0:
+        yield from deltas
+        return
+    pulled = queue.Queue()
+    stopped = threading.Event()
+
+    def read():
+        try:
+            for delta in deltas:
+                if stopped.is_set():
+                    break
+                pulled.put((delta, None))
+            else:
+                pulled.put((_END, None))
+        except Exception as e:
+            pulled.put((_END, e))
+        finally:
+            # Closed on this thread, the one running it; stops the upstream body being read.
+            close = getattr(deltas, 'close', None)
+            if close is not None:
+                close()
+
+    reader = threading.Thread(target=read, name="sse-deltas", daemon=True)
+    reader.start()
+    try:
+        while True:
+            try:
+                delta, error = pulled.get(timeout=coalescer.time_left())
+            except queue.Empty:
+                yield None
+                continue
+            if delta is _END:
+                if error is not None:
+                    raise error
+                return
+            yield delta
+    finally:
+        stopped.set()
+        if reader.is_alive() and abort is not None:
+            abort()
+        reader.join(READER_JOIN_TIMEOUT)
+
+
+def stream_frames(deltas, coalescer, think_filter, split_think=False, abort=None):
+    """
+    Turns upstream deltas into coalesced SSE frames, feeding each delta through
+    `think_filter`. By default the raw text (tags included) goes out as
+    `message` events; with `split_think` reasoning is sent as `reasoning`
+    events and only the report as `message` events. `abort()` is called if
+    the frames are closed before the deltas ran out, to stop the upstream.
+    """
+    state = {"event": "message"}
+
+    def emit(segments):
+        for kind, text in segments:
+            event = "reasoning" if kind == "reasoning" else "message"
+            if event != state["event"]:
+                pending = coalescer.flush()
+                if pending:
+                    yield sse_event(state["event"], pending)
+                state["event"] = event
+            text = coalescer.push(text)
+            if text:
+                yield sse_event(event, text)
+
+    paced = _deltas_with_deadlines(deltas, coalescer, abort)
+    try:
+        for delta in paced:
+            if delta is None:
+                pending = coalescer.poll()
+                if pending:
+                    yield sse_event(state["event"], pending)
+                continue
+            segments = think_filter.feed(delta)
+            yield from emit(segments if split_think else [("report", delta)])
+    finally:
+        paced.close() # stops the reader at once if the client went away
+    segments = think_filter.finish()
+    if split_think:
+        yield from emit(segments)
+    pending = coalescer.flush()
+    if pending:
+        yield sse_event(state["event"], pending)
@@ -0,0 +1,219 @@
+import os
+import re
+import gzip
+import time
+import hashlib
+import mimetypes
+import threading
+from collections import namedtuple
+
+try:
+    import brotli
+except ImportError: # optional; without it only gzip variants are built
+    brotli = None
+
+# One servable file: its bytes per content-coding ("identity" always present),
+# a quoted ETag derived from the content, and the file mtime it was built from.
+StaticAsset = namedtuple('StaticAsset', ['name', 'content_type', 'etag', 'version', 'variants', 'mtime'])
+
+# Long-lived caching for URLs that carry the content hash; everything else revalidates.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+_TEXT_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+def content_version(data):
+    """The short content hash used in ETags and `?v=` URLs."""
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def _content_type(name):
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if content_type.startswith(_TEXT_TYPES):
+        content_type += "; charset=utf-8"
+    return content_type
+
+
+def _compress(data, content_type):
+    """Identity plus whichever of gzip/brotli actually come out smaller."""
+    variants = {"identity": data}
+    if not content_type.startswith(_TEXT_TYPES) or len(data) < 256:
+        return variants
+    # mtime=0 keeps the gzip bytes (and so any downstream cache key) stable across restarts.
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz) < len(data):
+        variants["gzip"] = gz
+    if brotli is not None:
+        br = brotli.compress(data, quality=11)
+        if len(br) < len(data):
+            variants["br"] = br
+    return variants
+
+
+def parse_accept_encoding(header):
+    """Returns {coding: q} from an Accept-Encoding header."""
+    accepted = {}
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(asset, accept_encoding):
+    """The smallest variant the client accepts, falling back to identity."""
+    accepted = parse_accept_encoding(accept_encoding)
+    best = "identity"
+    for coding, body in asset.variants.items():
+        if coding == "identity":
+            continue
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > 0 and len(body) < len(asset.variants[best]):
+            best = coding
+    return best
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match check; weak comparison, so `W/` and per-coding suffixes still match."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    base = etag.strip('"')
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        candidate = candidate.strip('"')
+        if candidate == base or candidate.split("-", 1)[0] == base:
+            return True
+    return False
+
+
+class StaticAssetStore:
+    """
+    Serves an allowlist of files from `root` out of memory.
+
+    Each file is read once, compressed to gzip (and brotli, when the package is
+    installed) and given a content-hash ETag. Files whose mtime changed are
+    rebuilt at most every `check_interval` seconds. References to other assets
+    in HTML files (`src="script.js?v=..."`) are rewritten to the current
+    content hash, so those URLs can be cached as immutable.
+    """
+
+    def __init__(self, root, names, check_interval=5.0):
+        self.root = root
+        self.names = tuple(names)
+        self.check_interval = check_interval
+        self._assets = {}
+        self._last_check = None
+        self._reload_lock = threading.Lock()
+        self.builds = 0
+
+    def _build(self, name, mtime, versions):
+        with open(os.path.join(self.root, name), 'rb') as f:
+            data = f.read()
+        content_type = _content_type(name)
+        if content_type.startswith("text/html") and versions:
+            data = self._pin_versions(data, versions)
+        version = content_version(data)
+        return StaticAsset(name, content_type, f'"{version}"', version, _compress(data, content_type), mtime)
+
+    @staticmethod
+    def _pin_versions(html, versions):
+        pattern = re.compile(
+            r'((?:src|href)=")(' + "|".join(re.escape(n) for n in versions) + r')(\?v=[^"]*)?(")'
+        )
+        text = html.decode('utf-8')
+        text = pattern.sub(lambda m: f'{m.group(1)}{m.group(2)}?v={versions[m.group(2)]}{m.group(4)}', text)
+        return text.encode('utf-8')
+
+    def reload(self, force=False, blocking=True):
+        """Rebuilds assets whose file changed; HTML pages last, so they pin the new hashes."""
+        if not self._reload_lock.acquire(blocking=blocking):
+            return
+        try:
+            assets = dict(self._assets)
+            changed = False
+            # Non-HTML first: pages need the final hashes of what they reference.
+            ordered = sorted(self.names, key=lambda n: _content_type(n).startswith("text/html"))
+            for name in ordered:
+                path = os.path.join(self.root, name)
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except OSError:
+                    if assets.pop(name, None) is not None:
+                        changed = True
+                    continue
+                is_html = _content_type(name).startswith("text/html")
+                cached = assets.get(name)
+                if cached and cached.mtime == mtime and not force and not (is_html and changed):
+                    continue
+                versions = {n: a.version for n, a in assets.items() if n != name} if is_html else None
+                try:
+                    assets[name] = self._build(name, mtime, versions)
+                    changed = True
+                except OSError as e:
+                    print(f"Error loading static asset {name}: {e}")
+            if changed:
+                self._assets = assets
+                self.builds += 1
+            self._last_check = time.monotonic()
+        finally:
+            self._reload_lock.release()
+
+    def _maybe_reload(self):
+        """Checks file mtimes at most once per `check_interval` seconds."""
+        last_check = self._last_check
+        if last_check is not None and time.monotonic() - last_check < self.check_interval:
+            return
+        self.reload(blocking=last_check is None)
+
+    def get(self, name):
+        """Returns the StaticAsset for an allowlisted name, or None."""
+        if name not in self.names:
+            return None
+        self._maybe_reload()
+        return self._assets.get(name)
+
+    def respond(self, name, accept_encoding=None, if_none_match=None, version=None):
+        """
+        Returns (status, body, headers) for a GET of `name`, or None if it isn't
+        served. `version` is the `?v=` query value; only a URL pinned to the
+        current content hash is cacheable for a year.
+        """
+        asset = self.get(name)
+        if asset is None:
+            return None
+        coding = choose_encoding(asset, accept_encoding)
+        headers = {
+            # Each coding is its own representation, so it gets its own ETag.
+            "ETag": asset.etag if coding == "identity" else f'"{asset.version}-{coding}"',
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if version == asset.version else REVALIDATE_CACHE_CONTROL,
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(if_none_match, asset.etag):
+            return 304, b"", headers
+        headers["Content-Type"] = asset.content_type
+        if coding != "identity":
+            headers["Content-Encoding"] = coding
+        return 200, asset.variants[coding], headers
+
+    def stats(self):
+        assets = self._assets
+        return {
+            "assets": len(assets),
+            "builds": self.builds,
+            "brotli": brotli is not None,
+            "bytes": {name: {coding: len(body) for coding, body in a.variants.items()} for name, a in assets.items()},
+        }
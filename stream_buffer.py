@@ -0,0 +1,184 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import islice
+
+
+class ReplayUnavailable(Exception):
+    """The frames a reader asked for have already been dropped from the ring."""
+
+
+class StreamBuffer:
+    """
+    The SSE frames of one generation, numbered from 1 and kept in a ring of at
+    most `max_bytes` (the newest frame is always kept). One producer appends;
+    any number of readers follow it from an event number, blocking until more
+    frames arrive or the generation finishes.
+    """
+
+    def __init__(self, stream_id, owner, max_bytes, clock=time.monotonic):
+        self.stream_id = stream_id
+        self.owner = owner
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._frames = deque() # (seq, frame), oldest first
+        self._next_seq = 1
+        self.size = 0
+        self.dropped = 0
+        self.done = False
+        self.finished_at = None
+        self._cond = threading.Condition()
+
+    def event_id(self, seq):
+        return f"{self.stream_id}:{seq}"
+
+    def append(self, frame):
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._frames.append((seq, frame))
+            self.size += len(frame)
+            while self.size > self.max_bytes and len(self._frames) > 1:
+                _, old = self._frames.popleft()
+                self.size -= len(old)
+                self.dropped += 1
+            self._cond.notify_all()
+        return seq
+
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self.finished_at = self._clock()
+            self._cond.notify_all()
+
+    def follow(self, after=0):
+        """
+        Yields (seq, frame) for every frame after `after` until the generation
+        finishes. Raises ReplayUnavailable if some of them were already dropped.
+        """
+        while True:
+            with self._cond:
+                while not self.done and self._next_seq - 1 <= after:
+                    self._cond.wait()
+                if not self._frames:
+                    return
+                first = self._frames[0][0]
+                if first > after + 1:
+                    raise ReplayUnavailable(f"{self.stream_id}: frames {after + 1}..{first - 1} dropped")
+                batch = list(islice(self._frames, after + 1 - first, None))
+                if not batch and self.done:
+                    return
+            for seq, frame in batch:
+                yield seq, frame
+                after = seq
+
+
+def parse_event_id(value):
+    """(stream_id, seq) from a Last-Event-ID header, or None if it isn't one of ours."""
+    stream_id, _, seq = (value or "").strip().rpartition(":")
+    if not stream_id or not seq.isdigit():
+        return None
+    return stream_id, int(seq)
+
+
+class StreamRegistry:
+    """
+    Per-process buffers of the generations in progress (and finished within
+    `ttl` seconds), so a client that lost its connection can reattach with
+    Last-Event-ID instead of starting a new generation.
+
+    Each generation runs in its own thread, decoupled from the request that
+    started it. A live generation reserves its full ring size against
+    `max_bytes`; finished ones count their actual size and are evicted oldest
+    first when a new generation needs room. If there is still no room,
+    `start()` returns None and the caller streams without a buffer.
+    """
+
+    def __init__(self, ttl=300, max_bytes=64 * 1024 * 1024, stream_max_bytes=512 * 1024, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stream_max_bytes = stream_max_bytes
+        self._clock = clock
+        self._streams = OrderedDict() # stream_id -> StreamBuffer, oldest first
+        self._lock = threading.Lock()
+        self._threads = set()
+        self._stats = {"started": 0, "unbuffered": 0, "evicted": 0, "expired": 0, "resumed": 0, "not_found": 0}
+
+    def _reserved(self):
+        return sum(b.size if b.done else self.stream_max_bytes for b in self._streams.values())
+
+    def _evict(self, room):
+        now = self._clock()
+        for stream_id, buffer in list(self._streams.items()):
+            if buffer.done and now - buffer.finished_at >= self.ttl:
+                del self._streams[stream_id]
+                self._stats["expired"] += 1
+        reserved = self._reserved()
+        for stream_id, buffer in list(self._streams.items()):
+            if reserved + room <= self.max_bytes:
+                break
+            if buffer.done:
+                del self._streams[stream_id]
+                reserved -= buffer.size
+                self._stats["evicted"] += 1
+        return reserved + room <= self.max_bytes
+
+    def start(self, owner, frames):
+        """
+        Drains the `frames` generator into a new buffer in a background thread.
+        Returns the StreamBuffer, or None if the memory cap leaves no room.
+        """
+        with self._lock:
+            if not self._evict(self.stream_max_bytes):
+                self._stats["unbuffered"] += 1
+                return None
+            buffer = StreamBuffer(secrets.token_hex(8), owner, self.stream_max_bytes, self._clock)
+            self._streams[buffer.stream_id] = buffer
+            self._stats["started"] += 1
+        thread = threading.Thread(target=self._produce, args=(buffer, frames), daemon=True)
+        with self._lock:
+            self._threads.add(thread)
+        thread.start()
+        return buffer
+
+    def _produce(self, buffer, frames):
+        try:
+            for frame in frames:
+                buffer.append(frame)
+        except Exception as e:
+            print(f"Stream {buffer.stream_id} failed: {e!r}")
+        finally:
+            buffer.finish()
+            with self._lock:
+                self._threads.discard(threading.current_thread())
+
+    def join(self, timeout=None):
+        """Waits up to `timeout` seconds for the generations in progress to finish."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+    def get(self, stream_id, owner):
+        """The buffer of a generation started by `owner`, or None if it is unknown or expired."""
+        with self._lock:
+            self._evict(0)
+            buffer = self._streams.get(stream_id)
+            if buffer is None or buffer.owner != owner:
+                self._stats["not_found"] += 1
+                return None
+            self._stats["resumed"] += 1
+            return buffer
+
+    def stats(self):
+        with self._lock:
+            live = sum(1 for b in self._streams.values() if not b.done)
+            return {
+                **self._stats,
+                "live": live,
+                "finished": len(self._streams) - live,
+                "buffered_bytes": sum(b.size for b in self._streams.values()),
+                "reserved_bytes": self._reserved(),
+            }
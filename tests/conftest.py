@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import shutil
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from bench.fake_upstream import FakeUpstream
+
+
+@pytest.fixture
+def fake_upstream():
+    """A local OpenAI-compatible streaming server."""
+    with FakeUpstream(tokens=3, token_text="好") as upstream:
+        yield upstream
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch, fake_upstream):
+    """
+    The app module with fresh in-memory state, running in a scratch directory
+    (so usage and session files never touch the repo) against the fake upstream.
+    """
+    import app
+    from counter_store import MemoryCounterStore
+    from rate_limiter import SlidingWindowLog
+    from usage_journal import UsageJournal
+    from session_store import SessionStore
+    from invitation_codes import InvitationRegistry
+    from report_export import ReportCache
+    from stream_buffer import StreamRegistry
+    from session_analytics import SessionAnalytics
+
+    shutil.copytree(os.path.join(ROOT, '_data', 'scorelines'), tmp_path / '_data' / 'scorelines')
+    shutil.copy(os.path.join(ROOT, '_data', 'users.json'), tmp_path / '_data' / 'users.json')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setenv("OPENAI_API_BASE", fake_upstream.base_url)
+    monkeypatch.setenv("OPENAI_MODEL_NAME", "fake-model")
+
+    monkeypatch.setattr(app, "counter_store", MemoryCounterStore())
+    monkeypatch.setattr(app, "ip_rate_limiter", SlidingWindowLog(app.RATE_LIMIT_PER_MINUTE))
+    monkeypatch.setattr(app, "code_rate_limiter", SlidingWindowLog(0))
+    monkeypatch.setattr(app, "usage_journal", UsageJournal(app.USAGE_FILE, flush_interval=3600))
+    monkeypatch.setattr(app, "session_store", SessionStore(app.SESSIONS_DIR))
+    monkeypatch.setattr(app, "invitation_registry", InvitationRegistry(app.USERS_FILE, check_interval=0))
+    monkeypatch.setattr(app, "report_cache", ReportCache(app.REPORT_CACHE_DIR, 1024 * 1024))
+    monkeypatch.setattr(app, "stream_registry", StreamRegistry())
+    monkeypatch.setattr(app, "session_analytics",
+                        SessionAnalytics(app.SESSIONS_DIR, app.ANALYTICS_CACHE_FILE, app.ANALYTICS_FILE))
+    monkeypatch.setattr(app, "ANALYTICS_REFRESH_INTERVAL", 0) # tests refresh explicitly
+    monkeypatch.setattr(app, "app_initialized", False) # start up again over the fresh state
+    app.init_app()
+    app.app.config['TESTING'] = True
+    yield app
+    # Generations outlive their requests; don't let one leak into the next test.
+    app.stream_registry.join(10)
+
+
+@pytest.fixture
+def admin_code(app_module):
+    """An invitation code allowed to read the operator endpoints, next to the ordinary "ok"."""
+    with open(app_module.USERS_FILE, "w", encoding="utf-8") as f:
+        json.dump({"valid_codes": ["ok"], "codes": {"OPERATOR": {"admin": True}}}, f)
+    app_module.invitation_registry.reload()
+    return "OPERATOR"
+
+
+@pytest.fixture
+def app_client(app_module):
+    with app_module.app.test_client() as client:
+        yield client
@@ -0,0 +1,95 @@
+import json
+
+import numpy as np
+
+from admission_engine import AdmissionModel, RankTable, build_model
+from score_index import ScoreLineIndex
+
+# 700 points = 100 candidates, every point below adds 100 more.
+TABLE_2024 = [[score, (701 - score) * 100] for score in range(500, 701)]
+TABLE_2023 = [[score, (701 - score) * 50] for score in range(500, 701)] # half the cohort
+
+ADMISSIONS = {
+    2024: [
+        {"school": "南京大学", "major": "计算机", "min_rank": 1000},
+        {"school": "东南大学", "major": "电子", "min_rank": 4000},
+        {"school": "河海大学", "major": "水利", "min_score": 600},
+    ],
+    2023: [
+        {"school": "南京大学", "major": "计算机", "min_rank": 450},
+        {"school": "东南大学", "major": "电子", "min_rank": 2100},
+    ],
+}
+
+
+def _model():
+    return AdmissionModel({2024: TABLE_2024, 2023: TABLE_2023}, ADMISSIONS)
+
+
+def test_rank_table_conversions():
+    table = RankTable(2024, TABLE_2024)
+    assert table.total == 20100
+    assert list(table.rank_for_score([700, 650, 499])) == [100, 5100, 20100]
+    assert list(table.score_for_rank([100, 5100, 5050])) == [700, 650, 650]
+
+
+def test_cutoffs_are_rescaled_to_latest_cohort():
+    model = _model()
+    index = model.schools.index("河海大学")
+    assert model.cutoff_ranks[index, model.years.index(2024)] == 10100 # derived from min_score
+    # 2023's 450 in a cohort half the size is 900 in 2024 terms.
+    nju = model.schools.index("南京大学")
+    assert abs(np.exp(model.mean_log_rank[nju]) - 1000 ** (1 / 1.7) * 900 ** (0.7 / 1.7)) < 1
+    assert model.equivalent_scores(5100) == {2024: 650, 2023: 650}
+
+
+def test_probabilities_fall_with_rank_and_bands_follow():
+    model = _model()
+    better, worse = model.probabilities(800), model.probabilities(8000)
+    assert (better > worse).all()
+    p, labels = model.evaluate(4000)
+    assert labels[model.schools.index("河海大学")] == "保"
+    assert labels[model.schools.index("南京大学")] == "难"
+    assert 0.4 <= p[model.schools.index("东南大学")] < 0.8
+
+
+def test_summary_names_mentioned_schools():
+    model = _model()
+    summary = model.summarize(model.student_rank(655, "score"), "想去东南大学")
+    assert "考生位次: 4600（同位次约等于 2024年655分 / 2023年655分）" in summary
+    assert "全省院校专业: 保 1 / 稳 0 / 冲 1 / 难 1" in summary
+    assert "考生提到的院校:\n  - 东南大学 电子: 冲" in summary
+    assert "最低位次 2024年4000 / 2023年2100" in summary
+
+
+def test_build_model_needs_admissions():
+    assert build_model({2024: TABLE_2024}, None) is None
+
+
+def test_score_index_loads_model(tmp_path):
+    with open(tmp_path / "江苏.json", "w", encoding="utf-8") as f:
+        json.dump({"province": "江苏", "yearly_data": [
+            {"year": 2024, "batches": {"理科": {"一本": 588}},
+             "score_rank": {"理科": TABLE_2024}, "admissions": {"理科": ADMISSIONS[2024]}},
+        ]}, f, ensure_ascii=False)
+    entry = ScoreLineIndex(str(tmp_path)).get("江苏", "物理")
+    assert entry.model.stats() == {"years": [2024], "programs": 3, "rank_tables": 1}
+
+
+def test_handler_prompt_carries_estimate(app_module, app_client, fake_upstream):
+    with open("_data/scorelines/江苏.json", encoding="utf-8") as f:
+        data = json.load(f)
+    data["yearly_data"][0].setdefault("score_rank", {})["理科"] = TABLE_2024
+    data["yearly_data"][0].setdefault("admissions", {})["理科"] = ADMISSIONS[2024]
+    with open("_data/scorelines/江苏.json", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    app_module.score_index.reload()
+
+    app_client.post('/api/handler', json={
+        "invitationCode": "ok", "sessionId": "admission-1",
+        "userInput": {"rawText": "分数: 640\n南京大学还是东南大学？", "province": "江苏",
+                      "stream": "物理", "rank": 640, "scoreType": "score"},
+    }).get_data()
+    prompt = fake_upstream.last_payload["messages"][-1]["content"]
+    assert "录取概率测算" in prompt and "考生位次: 6100" in prompt
+    assert prompt.index("录取概率测算") < prompt.index("南京大学还是东南大学")
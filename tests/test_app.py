@@ -1,210 +1,135 @@
-import pytest
+import re
 import json
-from unittest.mock import patch, MagicMock
-
-# Add the project root to the Python path to allow importing 'app'
-import sys
-import os
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-
-from app import app, kv, DAILY_LIMIT, prepare_prompt, get_daily_key
-from datetime import datetime
-
-class MockDateTime(datetime):
-    @classmethod
-    def utcnow(cls):
-        return datetime(2025, 6, 24, 12, 0, 0)
-
-@pytest.fixture
-def client():
-    """Create a test client for the Flask app."""
-    app.config['TESTING'] = True
-    with app.test_client() as client:
-        yield client
-
-@pytest.fixture
-def mock_datetime(mocker):
-    """Fixture to mock datetime.utcnow to a fixed date."""
-    mocker.patch('app.datetime', new=MockDateTime)
-    return MockDateTime.utcnow()
-
-@pytest.fixture(autouse=True)
-def mock_redis(mocker, mock_datetime):
-    """Auto-mock Redis for all tests to prevent actual Redis calls."""
-    if not kv:
-        yield None
-        return
-
-    mock = MagicMock()
-    mock.ping.return_value = True
-    # Default get for the current mocked day
-    mock.get.return_value = '0'
-    # Default incr for the current mocked day
-    mock.incr.return_value = 1
-    
-    mocker.patch('app.kv', new=mock)
-    yield mock
-
-def test_index_route(client):
+
+
+def _consult(client, **user_input):
+    return client.post('/api/handler', json={
+        "invitationCode": "ok",
+        "userInput": {"rawText": "纠结：去复旦大学还是华中科技大学？", "province": "江苏", "stream": "物理",
+                      "rank": "4500", **user_input},
+    })
+
+
+def _message_text(body):
+    return "".join(json.loads(line[6:]) for line in body.splitlines()
+                   if line.startswith("data: ") and line[6:].startswith('"'))
+
+
+def test_index_route(app_client):
     """Test if the index route returns the main page."""
-    response = client.get('/')
+    response = app_client.get('/')
     assert response.status_code == 200
     assert '<title>高考志愿AI决策顾问</title>' in response.data.decode('utf-8')
 
-def test_prepare_prompt_logic():
+
+def test_prepare_user_prompt_logic(app_module):
     """TCD 2.1: Test the core prompt generation logic."""
-    # Input
-    user_data = {
-        'rawText': '纠结：去复旦大学还是华中科技大学？',
-        'province': '上海',
-        'rank': '4500'
-    }
-    enrollment_data = {
-        'data': {
-            '华中科技大学': '计算机科学与技术专业在湖北省扩招5人。'
-        }
-    }
-    # Execution
-    prompt = prepare_prompt(user_data, enrollment_data)
-    # Assertions
+    user_data = {'rawText': '纠结：去复旦大学还是华中科技大学？', 'province': '上海', 'rank': '4500'}
+    prompt = app_module.prepare_user_prompt(user_data, "上海本科线 2024: 403")
     assert '4500' in prompt
-    assert '复旦大学' in prompt
-    assert '华中科技大学' in prompt
-    assert '扩招5人' in prompt
-    assert '<think>' in prompt and '</think>' in prompt
+    assert '复旦大学' in prompt and '华中科技大学' in prompt
+    assert prompt.index('上海本科线') < prompt.index('4500')
+
 
-def test_get_usage_success(client, mock_redis):
+def test_get_usage_success(app_module, app_client):
     """Test the /api/usage endpoint successfully."""
-    if not mock_redis:
-        pytest.skip("Redis is not configured, skipping test.")
-    
-    mock_redis.get.return_value = '10'
-    response = client.get('/api/usage')
-    
+    for _ in range(10):
+        app_module.increment_usage()
+    response = app_client.get('/api/usage')
     assert response.status_code == 200
-    mock_redis.get.assert_called_once_with(get_daily_key())
-    data = response.get_json()
-    assert data['used'] == 10
-    assert data['limit'] == DAILY_LIMIT
-
-def test_get_usage_redis_error(client, mock_redis):
-    """Test /api/usage when Redis connection fails."""
-    if not mock_redis:
-        pytest.skip("Redis is not configured, skipping test.")
-
-    mock_redis.get.side_effect = Exception("Redis down")
-    response = client.get('/api/usage')
+    assert response.get_json() == {"used": 10, "limit": app_module.DAILY_LIMIT}
+
+
+def test_day_rollover_only_resets_usage(app_module, app_client, monkeypatch):
+    """A new day reseeds the usage counter without repeating the rest of startup."""
+    app_module.increment_usage()
+    startup = []
+    monkeypatch.setattr(app_module.session_store, "migrate_in_background", lambda: startup.append("migrate"))
+    monkeypatch.setattr(app_module.static_assets, "reload", lambda: startup.append("static"))
+    monkeypatch.setattr(app_module, "get_beijing_today_str", lambda: "2099-01-01")
+    assert app_client.get('/api/usage').get_json()["used"] == 0
+    assert app_module.usage_journal.has_day("2099-01-01")
+    app_module.init_app() # already done for this process
+    assert startup == []
+
+
+def test_get_usage_store_error(app_module, app_client, monkeypatch):
+    """Test /api/usage when the counter store is down."""
+    def broken(key):
+        raise ConnectionError("Redis down")
+    monkeypatch.setattr(app_module.counter_store, "get", broken)
+    response = app_client.get('/api/usage')
     assert response.status_code == 500
-    data = response.get_json()
-    assert "error" in data
-    assert "Redis down" in data["error"]
+    assert "Redis down" in response.get_json()["error"]
 
-def test_handler_limit_exceeded(client, mock_redis):
-    """TCD 2.2: Test /api/handler when the daily usage limit is exhausted."""
-    if not mock_redis:
-        pytest.skip("Redis is not configured, skipping test.")
 
-    daily_key = get_daily_key()
-    mock_redis.get.return_value = str(DAILY_LIMIT)
-    response = client.post('/api/handler', json={'userInput': {'rawText': 'test'}})
-    
+def test_handler_limit_exceeded(app_module, app_client, fake_upstream):
+    """TCD 2.2: Test /api/handler when the daily usage limit is exhausted."""
+    for _ in range(app_module.DAILY_LIMIT):
+        app_module.increment_usage()
+    response = _consult(app_client)
     assert response.status_code == 429
-    mock_redis.get.assert_called_once_with(daily_key)
-    mock_redis.incr.assert_not_called() # Should not increment if limit is reached
-    data = response.get_json()
-    assert 'error' in data
-    assert '已被抢完' in data['error']
-
-@patch('app.OpenAI')
-def test_quota_available(mock_openai, client, mock_redis):
-    """TCD 2.2: Test that usage is incremented when quota is available."""
-    if not mock_redis:
-        pytest.skip("Redis is not configured, skipping test.")
-
-    # Mock OpenAI to prevent actual API calls
-    mock_stream = MagicMock()
-    mock_stream.__iter__.return_value = []
-    mock_openai.return_value.chat.completions.create.return_value = mock_stream
-
-    daily_key = get_daily_key()
-    mock_redis.get.return_value = str(DAILY_LIMIT - 1)
-    
-    with patch.dict(os.environ, {'OPENAI_API_KEY': 'test-key', 'OPENAI_API_BASE': 'http://test.url'}):
-        client.post('/api/handler', json={'userInput': {'rawText': 'test'}})
-
-    mock_redis.get.assert_called_once_with(daily_key)
-    mock_redis.incr.assert_called_once_with(daily_key)
-
-def test_handler_redis_error(client, mock_redis):
-    """TCD 2.2: Test /api/handler when Redis connection fails."""
-    if not mock_redis:
-        pytest.skip("Redis is not configured, skipping test.")
-
-    mock_redis.get.side_effect = Exception("Connection Error")
-    response = client.post('/api/handler', json={'userInput': {'rawText': 'test'}})
-    
-    assert response.status_code == 500
-    data = response.get_json()
-    assert 'error' in data
-    assert '数据库连接丢失' in data['error']
+    assert '已被抢完' in response.get_json()['error']
+    assert app_module.get_current_usage() == app_module.DAILY_LIMIT # not incremented
+    assert fake_upstream.stats["requests"] == 0
 
-def test_handler_bad_request(client):
-    """Test /api/handler with a malformed request."""
-    response = client.post('/api/handler', json={'wrong_key': 'test'})
-    assert response.status_code == 400
-    data = response.get_json()
-    assert 'error' in data
-    assert "缺少'userInput'字段" in data['error']
-
-@patch('app.OpenAI')
-def test_handler_stream_success(mock_openai, client, mock_redis):
-    """Test a successful streaming response from /api/handler."""
-    if not mock_redis:
-        pytest.skip("Redis is not configured, skipping test.")
-        
-    # Mock the OpenAI client and its stream
-    mock_stream = MagicMock()
-    mock_chunk = MagicMock()
-    mock_chunk.choices = [MagicMock()]
-    mock_chunk.choices[0].delta.content = "Hello"
-    mock_stream.__iter__.return_value = [mock_chunk]
-
-    mock_openai.return_value.chat.completions.create.return_value = mock_stream
-
-    # Mock environment variables
-    with patch.dict(os.environ, {'OPENAI_API_KEY': 'test-key', 'OPENAI_API_BASE': 'http://test.url'}):
-        response = client.post('/api/handler', json={'userInput': {'rawText': 'Analyse this'}})
 
+def test_handler_stream_success(app_module, app_client, fake_upstream):
+    """TCD 2.2: A consultation increments usage, streams the answer and ends the stream."""
+    response = _consult(app_client)
     assert response.status_code == 200
     assert response.mimetype == 'text/event-stream'
+    body = response.get_data(as_text=True)
+    assert re.search(r"event: usage\nid: \w+:1\ndata: " + re.escape(json.dumps({'used': 1, 'limit': app_module.DAILY_LIMIT})), body)
+    assert _message_text(body) == "好好好"
+    assert re.search(r"event: end\nid: \w+:\d+\ndata: End of stream", body)
+    assert app_module.get_current_usage() == 1
+    # The score lines for the student's province reach the upstream.
+    prompt = fake_upstream.last_payload["messages"][-1]["content"]
+    assert "4500" in prompt and "江苏" in prompt
+
+
+def test_handler_saves_and_replays_history(app_client, fake_upstream):
+    session_id = "a" * 32
+    app_client.post('/api/handler', json={"invitationCode": "ok", "sessionId": session_id,
+                                          "userInput": {"rawText": "第一问", "isFollowUp": True}}).get_data()
+    app_client.post('/api/handler', json={"invitationCode": "ok", "sessionId": session_id,
+                                          "userInput": {"rawText": "第二问", "isFollowUp": True}}).get_data()
+    messages = fake_upstream.last_payload["messages"]
+    assert [m["role"] for m in messages] == ["system", "user", "assistant", "user"]
+    assert messages[1]["content"] == "第一问" and messages[2]["content"] == "好好好"
+    assert messages[3]["content"] == "第二问"
+
+
+def test_handler_bad_request(app_client):
+    """Test /api/handler with a malformed request."""
+    response = app_client.post('/api/handler', json={'invitationCode': 'ok', 'wrong_key': 'test'})
+    assert response.status_code == 400
+    assert "缺少'userInput'字段" in response.get_json()['error']
+
 
-    # Check the content of the stream
-    stream_content = response.get_data(as_text=True)
-    
-    # Assert that the usage was incremented and sent
-    mock_redis.incr.assert_called_once_with(get_daily_key())
-    assert f"event: usage\ndata: {json.dumps({'used': 1, 'limit': DAILY_LIMIT})}" in stream_content
-    
-    assert f"event: message\ndata: {json.dumps('Hello')}" in stream_content
-    assert "event: end\ndata: End of stream" in stream_content
-
-def test_handler_missing_env_vars(client, mocker):
-    """Test /api/handler when OpenAI env vars are missing."""
-    mocker.patch.dict(os.environ, {"OPENAI_API_KEY": "", "OPENAI_API_BASE": ""}, clear=True)
-    
-    response = client.post('/api/handler', json={'userInput': {'rawText': 'test'}})
-    
+def test_handler_invalid_code(app_client, fake_upstream):
+    response = app_client.post('/api/handler', json={'invitationCode': 'nope', 'userInput': {'rawText': 'test'}})
+    assert response.status_code == 403
+    assert response.get_json()['error'] == "无效的邀请码。"
+    assert fake_upstream.stats["requests"] == 0
+
+
+def test_handler_missing_env_vars(app_client, monkeypatch):
+    """Test /api/handler when the upstream is not configured."""
+    monkeypatch.delenv("OPENAI_API_KEY")
+    monkeypatch.delenv("OPENAI_API_BASE")
+    monkeypatch.delenv("OPENAI_ENDPOINTS", raising=False)
+    response = _consult(app_client)
     assert response.status_code == 200
-    stream_content = response.get_data(as_text=True)
-    assert 'event: error' in stream_content
-    assert '服务器环境变量' in stream_content
-
-@patch('builtins.open')
-def test_handler_file_not_found(mock_open, client):
-    """Test /api/handler when the enrollment data file is not found."""
-    mock_open.side_effect = FileNotFoundError
-    response = client.post('/api/handler', json={'userInput': {'rawText': 'test'}})
-    assert response.status_code == 500
-    data = response.get_json()
-    assert 'error' in data
-    assert '关键数据文件丢失' in data['error']
\ No newline at end of file
+    body = response.get_data(as_text=True)
+    assert 'event: error' in body
+    assert '服务器环境变量' in body
+
+
+def test_handler_upstream_down(app_module, app_client, fake_upstream, monkeypatch):
+    monkeypatch.setattr(app_module, "UPSTREAM_MAX_RETRIES", 0)
+    fake_upstream.fail_status = 503
+    body = _consult(app_client).get_data(as_text=True)
+    assert 'AI服务暂时繁忙' in body
+    assert 'traceback' not in body
@@ -0,0 +1,137 @@
+import json
+
+import pytest
+
+import batch_runner
+from batch_runner import BatchRunner, load_checkpoint, read_records, run_to_file
+
+
+class Flaky(Exception):
+    pass
+
+
+def _write(path, text):
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def test_read_records_csv_and_jsonl(tmp_path):
+    csv_path = _write(tmp_path / "students.csv",
+                      "id,province,stream,rank,rawText\ns1,江苏,物理,4500,南大还是东南？\n,江苏,历史,,\n")
+    assert list(read_records(csv_path)) == [
+        ("s1", {"province": "江苏", "stream": "物理", "rank": 4500, "rawText": "南大还是东南？"}),
+        ("2", {"province": "江苏", "stream": "历史"}),
+    ]
+    jsonl_path = _write(tmp_path / "students.jsonl",
+                        '{"id": "a", "userInput": {"province": "江苏"}}\n\n{"province": "上海"}\n')
+    assert list(read_records(jsonl_path)) == [("a", {"province": "江苏"}), ("3", {"province": "上海"})]
+
+
+def test_runner_retries_transient_errors_with_backoff():
+    calls, sleeps = {}, []
+
+    def consult(user_input):
+        calls[user_input["n"]] = calls.get(user_input["n"], 0) + 1
+        if user_input["n"] == 1 and calls[1] < 3:
+            raise Flaky("busy")
+        if user_input["n"] == 2:
+            raise ValueError("bad record")
+        return f"report {user_input['n']}"
+
+    runner = BatchRunner(consult, concurrency=2, max_retries=3, backoff=1.0, retry_on=(Flaky,), sleep=sleeps.append)
+    results = {r["id"]: r for r in runner.run([(str(n), {"n": n}) for n in range(4)], total=4)}
+    assert results["1"]["status"] == "ok" and results["1"]["attempts"] == 3
+    assert results["2"] == {**results["2"], "status": "failed", "attempts": 1, "error": "ValueError: bad record"}
+    assert len(sleeps) == 2 and 0.5 <= sleeps[0] <= 1.0 and 1.0 <= sleeps[1] <= 2.0
+    progress = runner.progress()
+    assert (progress["completed"], progress["failed"], progress["retries"]) == (3, 1, 2)
+
+
+def test_runner_gives_up_after_max_retries():
+    def consult(user_input):
+        raise Flaky("still busy")
+
+    runner = BatchRunner(consult, max_retries=2, retry_on=(Flaky,), sleep=lambda s: None)
+    [result] = runner.run([("x", {})])
+    assert result["status"] == "failed" and result["attempts"] == 3
+
+
+def test_run_to_file_resumes_from_checkpoint(tmp_path):
+    input_path = _write(tmp_path / "in.jsonl", "".join(json.dumps({"id": f"s{n}", "n": n}) + "\n" for n in range(5)))
+    output = tmp_path / "out.jsonl"
+    # A previous run finished s0, failed s1 and was killed while writing s2.
+    output.write_text(json.dumps({"id": "s0", "status": "ok"}) + "\n"
+                      + json.dumps({"id": "s1", "status": "failed"}) + "\n" + '{"id": "s2", "sta',
+                      encoding="utf-8")
+    assert load_checkpoint(str(output)) == {"s0"}
+
+    seen = []
+    runner = BatchRunner(lambda user_input: seen.append(user_input["n"]) or "ok", concurrency=2)
+    progress = run_to_file(runner, input_path, str(output), report=lambda line: None)
+    assert sorted(seen) == [1, 2, 3, 4]
+    assert progress["skipped"] == 1 and progress["total"] == 4 and progress["eta_seconds"] == 0
+    assert load_checkpoint(str(output)) == {f"s{n}" for n in range(5)}
+
+
+def test_cli_end_to_end_against_fake_upstream(app_module, fake_upstream, tmp_path, capsys):
+    input_path = _write(tmp_path / "cohort.csv", "id,province,stream,rank,rawText\n"
+                        + "".join(f"s{n},江苏,物理,{4000 + n},南京大学还是东南大学？\n" for n in range(6)))
+    assert batch_runner.main([input_path, "--concurrency", "3"]) == 0
+    results = [json.loads(line) for line in open(tmp_path / "cohort.results.jsonl", encoding="utf-8")]
+    assert sorted(r["id"] for r in results) == [f"s{n}" for n in range(6)]
+    assert all(r["status"] == "ok" and r["report"] == "好好好" for r in results)
+    assert fake_upstream.stats["requests"] == 6
+    assert "南京大学还是东南大学" in fake_upstream.last_payload["messages"][-1]["content"]
+    assert "6/6 done" in capsys.readouterr().out
+    assert app_module.get_current_usage() == 0 # operator batches don't use the public quota
+
+    # Everything is checkpointed, so a second run has nothing to do.
+    assert batch_runner.main([input_path]) == 0
+    assert fake_upstream.stats["requests"] == 6
+
+
+@pytest.fixture
+def batch_code(app_module):
+    with open(app_module.USERS_FILE, "w", encoding="utf-8") as f:
+        json.dump({"valid_codes": ["ok"], "codes": {"SCHOOL": {"batch": True, "daily_limit": 2}}}, f)
+    app_module.invitation_registry.reload()
+    return "SCHOOL"
+
+
+def test_batch_endpoint_streams_results(app_module, app_client, fake_upstream, batch_code):
+    records = [{"id": f"s{n}", "userInput": {"province": "江苏", "stream": "物理", "rawText": "选哪个？"}}
+               for n in range(3)]
+    response = app_client.post('/api/batch', json={"invitationCode": batch_code, "records": records})
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    results, summary = lines[:-1], lines[-1]["summary"]
+    # The code's daily limit of 2 stops the third record.
+    assert sorted(r["status"] for r in results) == ["failed", "ok", "ok"]
+    assert (summary["completed"], summary["failed"]) == (2, 1)
+    assert fake_upstream.stats["requests"] == 2
+
+
+def test_batch_endpoint_requires_batch_access(app_client, batch_code):
+    records = [{"province": "江苏"}]
+    assert app_client.post('/api/batch', json={"invitationCode": "ok", "records": records}).status_code == 403
+    assert app_client.post('/api/batch', json={"invitationCode": batch_code, "records": []}).status_code == 400
+
+
+def test_batch_reserves_code_quota_in_the_counter_store(app_module, app_client, batch_code, monkeypatch):
+    """Uses are taken from the shared counter up front, and failed records give theirs back."""
+    def run_consultation(user_data):
+        if user_data["rawText"] == "bad":
+            raise ValueError("broken record")
+        return "好"
+    monkeypatch.setattr(app_module, "run_consultation", run_consultation)
+    records = [{"id": name, "userInput": {"rawText": name}} for name in ("bad", "a", "b")]
+    response = app_client.post('/api/batch', json={"invitationCode": batch_code, "records": records})
+    results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()[:-1]]
+    assert {r["id"]: r["status"] for r in results} == {"bad": "failed", "a": "ok", "b": "ok"}
+
+    key = app_module._code_usage_key(app_module.get_beijing_today_str(), batch_code)
+    assert app_module.counter_store.get(key) == 2
+    # A request in another worker sees the limit as used up and leaves the counter alone.
+    policy = app_module.invitation_registry.lookup(batch_code)
+    assert app_module.reserve_code_usage(batch_code, policy) is False
+    assert app_module.counter_store.get(key) == 2
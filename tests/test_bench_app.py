@@ -0,0 +1,23 @@
+from bench.bench_app import run_suite, compare
+
+
+def test_dev_server_run_reports_every_scenario():
+    results = run_suite(["dev"], ["handler", "usage", "static"], [2], rounds=2, tokens=3,
+                        token_interval=0, first_token_delay=0, warmup=1)
+    assert [(r["scenario"], r["requests"], r["failed"], r["errors"]) for r in results] == [
+        ("handler", 4, 0, 0), ("usage", 4, 0, 0), ("static", 4, 0, 0),
+    ]
+    handler = results[0]
+    assert handler["ttfb_p50_ms"] <= handler["ttft_p50_ms"] <= handler["latency_p99_ms"]
+    assert results[1]["ttft_p50_ms"] is None
+
+
+def test_compare_flags_regressions_past_tolerance():
+    row = {"server": "gunicorn", "scenario": "handler", "concurrency": 8,
+           "requests_per_second": 100.0, "latency_p99_ms": 50.0, "ttft_p99_ms": None}
+    baseline = {"results": [dict(row, requests_per_second=105.0, latency_p99_ms=40.0)]}
+    lines, regressed = compare([row], baseline, tolerance=0.10)
+    assert regressed
+    assert "latency_p99_ms 40.0 -> 50.0 (+25.0%) REGRESSION" in lines[0]
+    assert "requests_per_second" in lines[0] and "requests_per_second 105.0 -> 100.0 (-4.8%);" in lines[0]
+    assert compare([row], {"results": []}, 0.10) == ([], False)
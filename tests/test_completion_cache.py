@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from completion_cache import CompletionCache, make_cache_key
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _messages(text):
+    return [{"role": "system", "content": "sys"}, {"role": "user", "content": text}]
+
+
+def test_key_normalizes_whitespace_and_width():
+    base = make_cache_key("m", _messages("南京大学 还是 东南大学？"))
+    assert make_cache_key("m", _messages("  南京大学   还是\n东南大学？ ")) == base
+    assert make_cache_key("m", _messages("南京大学 还是 东南大学?")) == base  # full-width '？'
+    assert make_cache_key("other-model", _messages("南京大学 还是 东南大学？")) != base
+    assert make_cache_key("m", _messages("南京大学 还是 苏州大学？")) != base
+
+
+def test_cache_hit_miss_and_ttl():
+    clock = FakeClock()
+    cache = CompletionCache(max_bytes=1024, ttl=60, clock=clock)
+    assert cache.get("k") is None
+    cache.put("k", "report")
+    assert cache.get("k") == "report"
+    clock.now += 61
+    assert cache.get("k") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["expired"] == 1
+
+
+def test_cache_evicts_least_recently_used_by_size():
+    cache = CompletionCache(max_bytes=10, ttl=60)
+    cache.put("a", "aaaa")
+    cache.put("b", "bbbb")
+    cache.get("a")
+    cache.put("c", "cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa"
+    assert cache.stats()["evictions"] == 1
+    cache.put("huge", "x" * 11)
+    assert cache.get("huge") is None
+
+
+def _consult(client, session_id):
+    return client.post('/api/handler', json={
+        "invitationCode": "ok",
+        "sessionId": session_id,
+        "userInput": {"rawText": "南京大学还是东南大学？", "province": "江苏", "stream": "物理"},
+    }).get_data(as_text=True)
+
+
+def test_handler_replays_cached_consultation(app_module, app_client, fake_upstream, monkeypatch):
+    monkeypatch.setattr(app_module, "COMPLETION_CACHE_ENABLED", True)
+    monkeypatch.setattr(app_module, "COMPLETION_CACHE_REPLAY_INTERVAL_MS", 0)
+    monkeypatch.setattr(app_module, "COMPLETION_CACHE_REPLAY_CHUNK_CHARS", 2)
+    monkeypatch.setattr(app_module, "completion_cache", CompletionCache(1024 * 1024, 60))
+
+    _consult(app_client, "session-a")
+    second = _consult(app_client, "session-b")
+
+    assert fake_upstream.stats["requests"] == 1
+    assert f'data: {json.dumps("好好")}' in second
+    assert "event: end" in second
+    assert app_module.get_current_usage() == 2
+    assert app_module.load_session_history("session-b")[-1]["content"] == "好好好"
+
+
+def test_cache_hits_can_skip_the_quota(app_module, app_client, fake_upstream, monkeypatch):
+    monkeypatch.setattr(app_module, "COMPLETION_CACHE_ENABLED", True)
+    monkeypatch.setattr(app_module, "COMPLETION_CACHE_HITS_COUNT_QUOTA", False)
+    monkeypatch.setattr(app_module, "COMPLETION_CACHE_REPLAY_INTERVAL_MS", 0)
+    monkeypatch.setattr(app_module, "DAILY_LIMIT", 1)
+    monkeypatch.setattr(app_module, "completion_cache", CompletionCache(1024 * 1024, 60))
+
+    _consult(app_client, "session-a")
+    assert app_module.get_current_usage() == 1
+
+    # The quota is used up, but an identical consultation is still served from cache.
+    replay = _consult(app_client, "session-b")
+    assert "event: end" in replay
+    assert app_module.get_current_usage() == 1
+    assert fake_upstream.stats["requests"] == 1
+
+    response = app_client.post('/api/handler', json={
+        "invitationCode": "ok",
+        "userInput": {"rawText": "别的问题", "province": "江苏", "stream": "物理"},
+    })
+    assert response.status_code == 429
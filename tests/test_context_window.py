@@ -0,0 +1,84 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from context_window import ContextWindow, estimate_tokens, excerpt
+
+
+def _turn(i, answer_chars=2000):
+    return [
+        {"role": "user", "content": f"第{i}个问题"},
+        {"role": "assistant", "content": "报告" * (answer_chars // 2)},
+    ]
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("南京大学") == 4
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("南京 abc") == 3
+
+
+def test_excerpt_fits_budget():
+    text = "很长的报告内容" * 100
+    short = excerpt(text, 50)
+    assert estimate_tokens(short) <= 50
+    assert short.startswith("很长的报告")
+    assert excerpt("短", 50) == "短"
+
+
+def test_prompt_size_stays_bounded_as_session_grows():
+    window = ContextWindow(token_budget=3000)
+    history = []
+    totals = []
+    for i in range(30):
+        messages, stats = window.build("系统" * 100, history, "新问题")
+        assert stats.total_tokens <= 3000
+        assert stats.total_tokens == sum(estimate_tokens(m["content"]) + 4 for m in messages)
+        totals.append(stats.total_tokens)
+        history.extend(_turn(i))
+    assert max(totals) <= 3000
+    assert window.stats()["max_prompt_tokens"] == max(totals)
+
+
+def test_keeps_most_recent_turns_and_shortens_the_boundary_turn():
+    history = _turn(1) + _turn(2) + _turn(3)
+    messages, stats = ContextWindow(token_budget=2600).build("sys", history, "q")
+    assert messages[0]["role"] == "system"
+    assert messages[-1] == {"role": "user", "content": "q"}
+    assert stats.turns_included == 2
+    assert stats.turns_truncated == 1
+    assert stats.turns_dropped == 1
+    assert messages[1]["content"] == "第2个问题"
+    assert messages[2]["content"].endswith("（较早的内容已截断）")
+    assert messages[3:5] == _turn(3)
+
+
+def test_current_question_is_never_truncated():
+    question = "问" * 5000
+    messages, stats = ContextWindow(token_budget=1000).build("sys", _turn(1), question)
+    assert messages[-1]["content"] == question
+    assert stats.turns_included == 0
+    assert stats.turns_dropped == 1
+
+
+def test_max_turns_still_applies():
+    history = _turn(1, 10) + _turn(2, 10) + _turn(3, 10)
+    messages, stats = ContextWindow(token_budget=0, max_turns=2).build("sys", history, "q")
+    assert len(messages) == 6
+    assert stats.turns_dropped == 1
+
+
+def test_handler_reports_prompt_tokens(app_module, app_client, monkeypatch):
+    monkeypatch.setattr(app_module, "context_window", ContextWindow(token_budget=4000, max_turns=3))
+    for i in range(4):
+        app_module.save_session_turn("session-a", f"问题{i}", "报告" * 3000)
+    response = app_client.post('/api/handler', json={
+        "invitationCode": "ok",
+        "sessionId": "session-a",
+        "userInput": {"rawText": "追问", "isFollowUp": True},
+    })
+    response.get_data()
+    assert int(response.headers["X-Prompt-Tokens"]) <= 4000
+    assert app_module.context_window.stats()["turns_truncated"] == 1
@@ -0,0 +1,113 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from counter_store import MemoryCounterStore, RedisCounterStore, create_counter_store
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def memory_store():
+    clock = FakeClock()
+    store = MemoryCounterStore(clock=clock)
+    store.clock = clock
+    return store
+
+
+@pytest.fixture
+def redis_store():
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisCounterStore(fakeredis.FakeRedis(decode_responses=True))
+
+
+def test_memory_incr_and_expiry(memory_store):
+    """Counters increment and disappear once their TTL passes."""
+    assert memory_store.incr("rate:1.2.3.4:1", 60) == 1
+    assert memory_store.incr("rate:1.2.3.4:1", 60) == 2
+    assert memory_store.get("rate:1.2.3.4:1") == 2
+
+    memory_store.clock.now += 61
+    assert memory_store.get("rate:1.2.3.4:1") == 0
+    assert memory_store.incr("rate:1.2.3.4:1", 60) == 1
+
+
+def test_memory_expired_keys_are_evicted(memory_store):
+    """Expired keys are dropped from memory, not just hidden."""
+    for i in range(100):
+        memory_store.incr(f"rate:10.0.0.{i}:1", 60)
+    memory_store.clock.now += 61
+    memory_store.incr("usage:2025-06-24", 3600)
+    assert list(memory_store._values) == ["usage:2025-06-24"]
+
+
+def test_memory_hot_key_keeps_one_expiry_entry(memory_store):
+    """Repeated increments don't grow the expiry heap, and the latest TTL still wins."""
+    for _ in range(1000):
+        memory_store.incr("usage:2025-06-24", 60)
+    assert len(memory_store._expiry) == 1
+
+    memory_store.clock.now += 50
+    memory_store.incr("usage:2025-06-24", 60)
+    memory_store.clock.now += 20
+    assert memory_store.get("usage:2025-06-24") == 1001
+    assert len(memory_store._expiry) == 1
+    memory_store.clock.now += 41
+    assert memory_store.get("usage:2025-06-24") == 0
+    assert memory_store._expiry == []
+
+
+def test_memory_seed_only_if_absent(memory_store):
+    assert memory_store.seed("usage:2025-06-24", 5, 3600) is True
+    assert memory_store.seed("usage:2025-06-24", 9, 3600) is False
+    assert memory_store.incr("usage:2025-06-24", 3600) == 6
+
+
+def test_redis_incr_sets_ttl(redis_store):
+    """INCR and EXPIRE land together, so a counter never lives without a TTL."""
+    assert redis_store.incr("rate:1.2.3.4:1", 60) == 1
+    assert redis_store.incr("rate:1.2.3.4:1", 60) == 2
+    assert redis_store.get("rate:1.2.3.4:1") == 2
+    assert 0 < redis_store.client.ttl("rate:1.2.3.4:1") <= 60
+    assert redis_store.get("missing") == 0
+
+
+def test_redis_seed_only_if_absent(redis_store):
+    assert redis_store.seed("usage:2025-06-24", 5, 3600) is True
+    assert redis_store.seed("usage:2025-06-24", 9, 3600) is False
+    assert redis_store.incr("usage:2025-06-24", 3600) == 6
+
+
+@pytest.mark.parametrize("store_fixture", ["memory_store", "redis_store"])
+def test_decr_takes_back_an_increment(request, store_fixture):
+    store = request.getfixturevalue(store_fixture)
+    store.incr("rate:code:1", 60)
+    store.incr("rate:code:1", 60)
+    assert store.decr("rate:code:1", 60) == 1
+    assert store.get("rate:code:1") == 1
+
+
+def test_redis_store_is_shared_between_workers():
+    """Two stores on the same server see one counter, unlike per-process memory."""
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    worker_a = RedisCounterStore(fakeredis.FakeRedis(server=server, decode_responses=True))
+    worker_b = RedisCounterStore(fakeredis.FakeRedis(server=server, decode_responses=True))
+    worker_a.incr("usage:2025-06-24", 3600)
+    worker_b.incr("usage:2025-06-24", 3600)
+    assert worker_a.get("usage:2025-06-24") == 2
+
+
+def test_create_counter_store_falls_back_to_memory():
+    """An unreachable Redis doesn't take the app down."""
+    assert isinstance(create_counter_store(None), MemoryCounterStore)
+    assert isinstance(create_counter_store("redis://127.0.0.1:1"), MemoryCounterStore)
@@ -0,0 +1,87 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from invitation_codes import InvitationRegistry, CodePolicy, UNLIMITED, hash_code
+
+
+def _write(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+
+
+def test_plain_and_configured_codes(tmp_path):
+    path = str(tmp_path / "users.json")
+    _write(path, {
+        "valid_codes": ["A", "B"],
+        "codes": {"SCHOOL_1": {"daily_limit": 5, "expires": "2025-07-31"}, "SCHOOL_2": {"daily_limit": 5, "expires": "2025-07-31"},
+                  "OPS": {"admin": True}},
+    })
+    registry = InvitationRegistry(path)
+    assert registry.lookup("A") is UNLIMITED
+    assert registry.lookup("SCHOOL_1") == CodePolicy(5, "2025-07-31")
+    assert registry.lookup("SCHOOL_1") is registry.lookup("SCHOOL_2")  # policies are shared
+    assert registry.lookup("C") is None
+    assert registry.lookup(None) is None
+    assert registry.lookup(["A"]) is None
+    assert registry.lookup("OPS").admin and not registry.lookup("SCHOOL_1").admin
+    assert len(registry) == 5
+
+
+def test_expiry_is_inclusive():
+    policy = CodePolicy(0, "2025-07-31")
+    assert not policy.expired("2025-07-31")
+    assert policy.expired("2025-08-01")
+    assert not UNLIMITED.expired("2099-01-01")
+
+
+def test_hashed_codes(tmp_path):
+    path = str(tmp_path / "users.json")
+    _write(path, {"codes": {hash_code("SECRET"): {"daily_limit": 2}}})
+    registry = InvitationRegistry(path)
+    assert registry.lookup("SECRET") == CodePolicy(2, None)
+    # The stored hash itself is not a valid code.
+    assert registry.lookup(hash_code("SECRET")) is None
+
+
+def test_hot_reload_keeps_last_good_file(tmp_path):
+    path = str(tmp_path / "users.json")
+    _write(path, {"valid_codes": ["A"]})
+    registry = InvitationRegistry(path, check_interval=0)
+    assert registry.lookup("A") is not None
+
+    _write(path, {"valid_codes": ["A", "NEW"]})
+    assert registry.lookup("NEW") is not None
+
+    with open(path, 'w') as f:
+        f.write('{"valid_codes": [')
+    assert registry.lookup("NEW") is not None
+    assert registry.stats()["reloads"] == 2
+
+
+def _consult(client, code):
+    return client.post('/api/handler', json={
+        "invitationCode": code,
+        "userInput": {"rawText": "南京大学还是东南大学？", "province": "江苏", "stream": "物理"},
+    })
+
+
+def test_per_code_quota_and_expiry(app_module, app_client):
+    _write(app_module.USERS_FILE, {
+        "valid_codes": ["ok"],
+        "codes": {"LIMITED": {"daily_limit": 1}, "OLD": {"expires": "2000-01-01"}},
+    })
+
+    assert app_client.post('/api/verify_code', json={"invitationCode": "LIMITED"}).get_json()["success"]
+    expired = app_client.post('/api/verify_code', json={"invitationCode": "OLD"})
+    assert expired.status_code == 403
+    assert expired.get_json()["error"] == "该邀请码已过期。"
+
+    assert "event: end" in _consult(app_client, "LIMITED").get_data(as_text=True)
+    second = _consult(app_client, "LIMITED")
+    assert second.status_code == 429
+    assert "该邀请码今日的使用次数" in second.get_json()["error"]
+    # Other codes are unaffected.
+    assert _consult(app_client, "ok").status_code == 200
@@ -0,0 +1,73 @@
+from metrics import MetricsRegistry
+
+
+def test_counter_renders_labelled_totals():
+    registry = MetricsRegistry("app")
+    requests = registry.counter("requests", "Requests.", ["outcome"])
+    requests.inc(outcome="ok")
+    requests.inc(2, outcome="ok")
+    requests.inc(outcome='bad "quote"')
+    text = registry.render()
+    assert "# HELP app_requests Requests.\n# TYPE app_requests counter\n" in text
+    assert 'app_requests_total{outcome="ok"} 3\n' in text
+    assert 'app_requests_total{outcome="bad \\"quote\\""} 1\n' in text
+    assert requests.value(outcome="ok") == 3
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    latency = registry.histogram("latency_seconds", "Latency.", ["stage"], buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value, stage="load")
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{stage="load",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{stage="load",le="1"} 3' in lines
+    assert 'latency_seconds_bucket{stage="load",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{stage="load"} 3.65' in lines
+    assert 'latency_seconds_count{stage="load"} 4' in lines
+    assert latency.count(stage="load") == 4
+    assert latency.count(stage="other") == 0
+
+
+def test_histogram_time_observes_even_on_error():
+    latency = MetricsRegistry().histogram("latency_seconds", "Latency.")
+    try:
+        with latency.time():
+            raise ValueError
+    except ValueError:
+        pass
+    assert latency.count() == 1
+
+
+def test_gauge_reads_callback_and_survives_errors():
+    registry = MetricsRegistry()
+    registry.gauge("queue", "Queue length.", lambda: 7)
+    registry.gauge("broken", "Broken.", lambda: 1 / 0)
+    text = registry.render()
+    assert "queue 7\n" in text
+    assert "# TYPE broken gauge\n" in text and "\nbroken " not in text
+
+
+def test_handler_records_stages_and_metrics_endpoint(app_module, app_client):
+    stages = app_module.stage_seconds
+    before = {stage: stages.count(stage=stage) for stage in ("score_lookup", "context_build", "upstream_ttft", "stream_total")}
+    completed = app_module.handler_requests.value(outcome="completed")
+    sent = app_module.sse_bytes.value()
+
+    body = app_client.post('/api/handler', json={
+        "invitationCode": "ok",
+        "userInput": {"rawText": "南京大学还是东南大学？", "province": "江苏", "stream": "物理"},
+    }).get_data()
+    assert b"event: end" in body
+    for stage, count in before.items():
+        assert stages.count(stage=stage) == count + 1, stage
+    assert app_module.handler_requests.value(outcome="completed") == completed + 1
+    assert app_module.sse_bytes.value() - sent == len(body)
+
+    app_client.post('/api/handler', json={"invitationCode": "nope", "userInput": {}})
+    response = app_client.get('/api/metrics')
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert 'gaokao_handler_requests_total{outcome="invalid_code"}' in text
+    assert 'gaokao_handler_stage_seconds_bucket{stage="upstream_ttft",le="+Inf"}' in text
+    assert "gaokao_upstream_in_flight 0\n" in text
@@ -0,0 +1,47 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from prompts import SYSTEM_PROMPT, PROMPT_TEMPLATE_VERSION, build_user_prompt, compile_score_block
+
+
+def test_templates_are_compiled_once():
+    assert SYSTEM_PROMPT.startswith("你是一位顶级的")
+    assert len(PROMPT_TEMPLATE_VERSION) == 12
+
+
+def test_user_prompt_puts_score_block_before_student_text():
+    block = compile_score_block({2024: {"一本": 588}})
+    prompt = build_user_prompt({"rawText": "南大还是东南？", "province": "江苏", "rank": "12000"}, block)
+    assert prompt.startswith(block)
+    assert prompt.endswith("南大还是东南？\n\n---")
+    assert '"一本": 588' in prompt
+
+
+def test_user_text_with_braces_is_not_formatted():
+    prompt = build_user_prompt({"rawText": "{province} {0}"})
+    assert "- 省份: 未知" in prompt
+    assert "{province} {0}" in prompt
+
+
+def test_initial_requests_share_a_byte_identical_prefix(app_module, app_client, admin_code, fake_upstream):
+    payloads = []
+    for text in ["南京大学还是东南大学？", "苏州大学还是南京师范大学？"]:
+        response = app_client.post('/api/handler', json={
+            "invitationCode": "ok",
+            "userInput": {"rawText": text, "province": "江苏", "stream": "物理", "rank": "12000"},
+        })
+        response.get_data()
+        assert response.headers["X-Prompt-Version"] == PROMPT_TEMPLATE_VERSION
+        payloads.append(fake_upstream.last_payload["messages"])
+
+    first, second = payloads
+    assert first[0] == second[0] == {"role": "system", "content": SYSTEM_PROMPT}
+    score_block = app_module.lookup_score_entry("江苏", "物理").prompt_block
+    assert first[-1]["content"].startswith(score_block)
+    assert second[-1]["content"].startswith(score_block)
+    assert app_client.get('/api/stats').status_code == 403
+    assert app_client.get('/api/stats', headers={"X-Invitation-Code": "ok"}).status_code == 403
+    stats = app_client.get('/api/stats', headers={"X-Invitation-Code": admin_code}).get_json()
+    assert stats["prompt_template_version"] == PROMPT_TEMPLATE_VERSION
@@ -0,0 +1,103 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from counter_store import MemoryCounterStore, RedisCounterStore
+from rate_limiter import SlidingWindowLog, SlidingWindowCounter, create_rate_limiter
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_sliding_log_limits_within_window():
+    """The (limit+1)-th request inside any 60s window is rejected."""
+    clock = FakeClock()
+    limiter = SlidingWindowLog(limit=3, window=60, clock=clock)
+    assert [limiter.hit("1.2.3.4") for _ in range(4)] == [False, False, False, True]
+    assert limiter.hit("5.6.7.8") is False
+
+
+def test_sliding_log_has_no_boundary_burst():
+    """Unlike fixed windows, a window boundary doesn't reset the budget."""
+    clock = FakeClock(now=59.0)
+    limiter = SlidingWindowLog(limit=2, window=60, clock=clock)
+    assert limiter.hit("ip") is False
+    assert limiter.hit("ip") is False
+    clock.now = 61.0
+    assert limiter.hit("ip") is True
+    clock.now = 119.5
+    assert limiter.hit("ip") is False
+
+
+def test_sliding_log_lazily_evicts_idle_keys():
+    """A burst of distinct IPs doesn't stay resident once it falls out of the window."""
+    clock = FakeClock()
+    limiter = SlidingWindowLog(limit=10, window=60, clock=clock)
+    for i in range(5000):
+        limiter.hit(f"10.0.{i // 256}.{i % 256}")
+    assert limiter.tracked_keys() == 5000
+
+    clock.now += 61
+    # New traffic touches every shard, which drains its expired head.
+    for i in range(200):
+        limiter.hit(f"172.16.0.{i}")
+    assert limiter.tracked_keys() == 200
+
+
+def test_sliding_log_zero_limit_disables():
+    limiter = SlidingWindowLog(limit=0)
+    assert not any(limiter.hit("ip") for _ in range(100))
+
+
+def test_sliding_counter_weights_previous_window():
+    """The shared-store limiter carries the previous window over proportionally."""
+    clock = FakeClock(now=60.0)
+    limiter = SlidingWindowCounter(MemoryCounterStore(clock=clock), limit=4, window=60, clock=clock)
+    assert [limiter.hit("code") for _ in range(4)] == [False, False, False, False]
+    # A quarter into the next window, 75% of the previous 4 hits still count.
+    clock.now = 135.0
+    assert limiter.hit("code") is False  # 3 + 1
+    assert limiter.hit("code") is True   # 3 + 2
+
+
+def test_sliding_counter_over_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    clock = FakeClock(now=0.0)
+    store = RedisCounterStore(fakeredis.FakeRedis(decode_responses=True))
+    limiter = SlidingWindowCounter(store, limit=2, window=60, prefix="rate:ip", clock=clock)
+    assert [limiter.hit("1.2.3.4") for _ in range(3)] == [False, False, True]
+    assert store.get("rate:ip:1.2.3.4:0") == 2
+
+
+@pytest.fixture(params=["memory", "redis"])
+def counter_store(request):
+    if request.param == "memory":
+        return MemoryCounterStore(clock=FakeClock(now=0.0))
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisCounterStore(fakeredis.FakeRedis(decode_responses=True))
+
+
+def test_sliding_counter_does_not_count_rejected_hits(counter_store):
+    """A client hammering while limited gets through again once the window slides."""
+    clock = FakeClock(now=0.0)
+    limiter = SlidingWindowCounter(counter_store, limit=2, window=60, clock=clock)
+    assert [limiter.hit("code") for _ in range(12)] == [False, False] + [True] * 10
+    assert counter_store.get("rate:code:0") == 2
+    # Halfway into the next window only half of the 2 admitted hits still count.
+    clock.now = 90.0
+    assert limiter.hit("code") is False
+
+
+def test_create_rate_limiter_picks_by_store():
+    assert isinstance(create_rate_limiter(MemoryCounterStore(), 10), SlidingWindowLog)
+    fakeredis = pytest.importorskip("fakeredis")
+    store = RedisCounterStore(fakeredis.FakeRedis(decode_responses=True))
+    assert isinstance(create_rate_limiter(store, 10), SlidingWindowCounter)
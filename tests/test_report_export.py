@@ -0,0 +1,151 @@
+import os
+import time
+import threading
+
+import pytest
+
+import report_export
+from report_export import RenderPool, ReportCache, ReportNotFound, content_hash, final_report, markdown_to_html, render
+
+
+def test_markdown_blocks_and_inline():
+    html = markdown_to_html(
+        "# 结论\n\n**推荐** 选择 *南京大学*，`计算机` 专业。\n第二行\n\n"
+        "| 学校 | 位次 |\n|---|:-:|\n| 南大 | 1200 |\n| 东南 |\n\n"
+        "- 优势\n  - 学科强\n- 劣势\n\n1. 第一\n2. 第二\n\n> 仅供参考\n\n---\n"
+    )
+    assert "<h1>结论</h1>" in html
+    assert "<p><strong>推荐</strong> 选择 <em>南京大学</em>，<code>计算机</code> 专业。<br>\n第二行</p>" in html
+    assert "<thead><tr><th>学校</th><th>位次</th></tr></thead>" in html
+    assert "<tr><td>东南</td><td></td></tr>" in html
+    assert "<ul>\n<li>优势\n<ul>\n<li>学科强\n</li></ul>\n</li>\n<li>劣势\n</li></ul>" in html
+    assert "<ol>\n<li>第一\n</li>\n<li>第二\n</li></ol>" in html
+    assert "<blockquote><p>仅供参考</p></blockquote>" in html
+    assert "<hr>" in html
+
+
+def test_markdown_escapes_raw_html():
+    html = markdown_to_html('<script>alert(1)</script> [x](https://a.example/"onmouseover=")')
+    assert "<script>" not in html
+    assert "&lt;script&gt;" in html
+    assert 'href="https://a.example/&quot;onmouseover=&quot;"' in html
+
+
+def test_final_report_takes_last_answer_without_reasoning():
+    messages = [
+        {"role": "user", "content": "旧问题"}, {"role": "assistant", "content": "旧答案"},
+        {"role": "user", "content": "新问题"}, {"role": "assistant", "content": "<think>想想</think>\n新答案"},
+    ]
+    assert final_report(messages) == ("新问题", "新答案")
+    with pytest.raises(ReportNotFound):
+        final_report([{"role": "user", "content": "只有问题"}])
+
+
+def test_render_formats():
+    md = render("md", "选哪个？", "## 建议\n选A").decode()
+    assert md.startswith("# 高考志愿AI分析报告") and "> 选哪个？" in md and "## 建议\n选A" in md
+    page = render("html", "选哪个？", "## 建议\n选A").decode()
+    assert '<div class="question">选哪个？</div>' in page and "<h2>建议</h2>" in page
+    assert content_hash("md", "q", "r") != content_hash("html", "q", "r")
+
+
+def test_cache_replaces_stale_renderings_and_evicts_lru(tmp_path):
+    cache = ReportCache(str(tmp_path), max_bytes=25)
+    cache.put(ReportCache.file_name("s-1", "aaa", "md"), b"x" * 10)
+    cache.put(ReportCache.file_name("s-1", "bbb", "md"), b"x" * 10) # replaces aaa
+    assert not os.path.exists(tmp_path / "s-1-aaa.md")
+    cache.put(ReportCache.file_name("s-1-2", "ccc", "md"), b"x" * 10) # a different session
+    assert cache.get("s-1-bbb.md") # now most recently used
+    cache.put(ReportCache.file_name("s-3", "ddd", "html"), b"x" * 10)
+    assert cache.get("s-1-2-ccc.md") is None # evicted as least recently used
+    assert cache.get("s-1-bbb.md") and cache.get("s-3-ddd.html")
+    assert cache.stats()["evictions"] == 1
+
+    # A fresh instance (another worker, or a restart) indexes what is on disk.
+    assert ReportCache(str(tmp_path), max_bytes=25).get("s-3-ddd.html") == b"x" * 10
+
+
+def test_cache_never_evicts_the_rendering_being_stored(tmp_path):
+    cache = ReportCache(str(tmp_path), max_bytes=25)
+    cache.put("s-1-aaa.md", b"x" * 10)
+    cache.put("s-2-bbb.pdf", b"y" * 20) # evicts s-1 to make room
+    assert cache.get("s-2-bbb.pdf") == b"y" * 20 and cache.get("s-1-aaa.md") is None
+    cache.put("s-3-ccc.pdf", b"z" * 30) # larger than the whole budget: not kept, nothing evicted
+    assert cache.get("s-3-ccc.pdf") is None and cache.get("s-2-bbb.pdf") == b"y" * 20
+    os.remove(tmp_path / "s-2-bbb.pdf") # removed by another worker
+    assert cache.get("s-2-bbb.pdf") is None and cache.stats()["bytes"] == 0
+
+
+def test_report_served_even_when_too_large_to_cache(app_module, app_client):
+    app_module.report_cache.max_bytes = 10
+    _finish_consultation(app_client, "export-big")
+    response = app_client.post('/api/report', json={"invitationCode": "ok", "sessionId": "export-big", "format": "html"})
+    assert response.status_code == 200 and "<h2>AI分析报告</h2>" in response.get_data(as_text=True)
+    assert app_module.report_cache.stats()["files"] == 0
+
+
+def _finish_consultation(client, session_id):
+    client.post('/api/handler', json={
+        "invitationCode": "ok", "sessionId": session_id,
+        "userInput": {"rawText": "南京大学还是东南大学？", "province": "江苏", "stream": "物理"},
+    }).get_data()
+
+
+def test_report_endpoint_renders_and_caches(app_module, app_client):
+    session_id = "export-session-1"
+    _finish_consultation(app_client, session_id)
+
+    response = app_client.post('/api/report', json={"invitationCode": "ok", "sessionId": session_id, "format": "md"})
+    assert response.status_code == 200
+    assert response.mimetype == "text/markdown"
+    assert "attachment" in response.headers["Content-Disposition"]
+    text = response.get_data(as_text=True)
+    assert "南京大学还是东南大学？" in text and "好好好" in text
+    assert app_module.report_cache.stats()["misses"] == 1
+
+    again = app_client.post('/api/report', json={"invitationCode": "ok", "sessionId": session_id, "format": "md"})
+    assert again.get_data(as_text=True) == text
+    assert again.headers["ETag"] == response.headers["ETag"]
+    assert app_module.report_cache.stats()["hits"] == 1
+
+    html = app_client.post('/api/report', json={"invitationCode": "ok", "sessionId": session_id, "format": "html"})
+    assert "<h2>AI分析报告</h2>" in html.get_data(as_text=True)
+
+    pdf = app_client.post('/api/report', json={"invitationCode": "ok", "sessionId": session_id, "format": "pdf"})
+    try:
+        report_export.render_pdf("<p>x</p>")
+    except report_export.PdfRendererUnavailable:
+        assert pdf.status_code == 501
+    else:
+        assert pdf.status_code == 200 and pdf.data.startswith(b"%PDF")
+
+
+def test_report_endpoint_rejects_bad_requests(app_client):
+    assert app_client.post('/api/report', json={"invitationCode": "nope", "sessionId": "s1"}).status_code == 403
+    assert app_client.post('/api/report', json={"invitationCode": "ok", "sessionId": "../x"}).status_code == 400
+    assert app_client.post('/api/report', json={"invitationCode": "ok", "sessionId": "s1", "format": "docx"}).status_code == 400
+    assert app_client.post('/api/report', json={"invitationCode": "ok", "sessionId": "never-used"}).status_code == 404
+
+
+def test_render_pool_caps_concurrent_renders():
+    pool = RenderPool(2)
+    running, peak, lock = [0], [0], threading.Lock()
+
+    def render(n):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return threading.current_thread().name, n
+
+    results = []
+    callers = [threading.Thread(target=lambda n=n: results.append(pool.run(render, n))) for n in range(6)]
+    for t in callers:
+        t.start()
+    for t in callers:
+        t.join()
+    assert sorted(n for _, n in results) == list(range(6))
+    assert all(name.startswith("report-render") for name, _ in results)
+    assert peak[0] == 2 and pool.stats() == {"workers": 2, "pending": 0, "completed": 6}
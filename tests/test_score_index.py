@@ -0,0 +1,92 @@
+import os
+import json
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from prompts import compile_score_block
+from score_index import ScoreLineIndex, normalize_stream
+
+
+def _write_province(directory, province, yearly_data, mtime=None):
+    path = os.path.join(directory, f"{province}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"province": province, "yearly_data": yearly_data}, f, ensure_ascii=False)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_normalize_stream():
+    """New-gaokao first choices map onto the traditional stream keys."""
+    assert normalize_stream("新高考 (3+1+2): 物理 + 化学 + 生物") == "理科"
+    assert normalize_stream("新高考 (3+1+2): 历史 + 政治 + 地理") == "文科"
+    assert normalize_stream("理科") == "理科"
+    assert normalize_stream(None) == ""
+
+
+def test_index_lookup(tmp_path):
+    """Entries are keyed by (province, normalized stream) and carry the prompt block."""
+    _write_province(tmp_path, "江苏", [
+        {"year": 2024, "batches": {"理科": {"一本": 588}, "文科": {"一本": 565}}},
+        {"year": 2023, "batches": {"理科": {"一本": 520}}},
+    ])
+    index = ScoreLineIndex(str(tmp_path))
+
+    entry = index.get("江苏", "新高考 (3+1+2): 物理 + 化学 + 生物")
+    assert entry.batches == {2024: {"一本": 588}, 2023: {"一本": 520}}
+    assert entry.prompt_block == compile_score_block({2024: {"一本": 588}, 2023: {"一本": 520}})
+    assert '"2024": {\n    "一本": 588' in entry.prompt_block
+    assert index.get("江苏", "历史").batches == {2024: {"一本": 565}}
+    assert index.get("江苏", "艺术") is None
+    assert index.get("广东", "理科") is None
+
+
+def test_stream_without_batches_has_no_prompt_block(tmp_path):
+    """Admissions data alone yields a model but no empty score block."""
+    table = [[score, (701 - score) * 100] for score in range(500, 701)]
+    _write_province(tmp_path, "江苏", [
+        {"year": 2024, "batches": {"理科": {"一本": 588}},
+         "score_rank": {"艺术": table},
+         "admissions": {"艺术": [{"school": "南京艺术学院", "major": "美术", "min_rank": 1000}]}},
+    ])
+    entry = ScoreLineIndex(str(tmp_path)).get("江苏", "艺术")
+    assert entry.batches == {}
+    assert entry.prompt_block is None
+    assert entry.model is not None
+
+
+def test_index_skips_mismatched_province(tmp_path):
+    """A file whose 'province' field differs from its name is ignored."""
+    path = os.path.join(tmp_path, "浙江.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"province": "江苏", "yearly_data": [{"year": 2024, "batches": {"理科": {}}}]}, f)
+    index = ScoreLineIndex(str(tmp_path))
+    assert index.get("浙江", "理科") is None
+
+
+def test_index_hot_reload_on_mtime_change(tmp_path):
+    """Changed files are picked up after the check interval; old snapshots stay intact."""
+    _write_province(tmp_path, "江苏", [{"year": 2024, "batches": {"理科": {"一本": 588}}}], mtime=1000)
+    index = ScoreLineIndex(str(tmp_path), check_interval=0)
+    old_entry = index.get("江苏", "理科")
+
+    _write_province(tmp_path, "江苏", [{"year": 2025, "batches": {"理科": {"一本": 590}}}], mtime=2000)
+    _write_province(tmp_path, "广东", [{"year": 2025, "batches": {"理科": {"本科": 442}}}], mtime=2000)
+
+    assert index.get("江苏", "理科").batches == {2025: {"一本": 590}}
+    assert index.get("广东", "物理").batches == {2025: {"本科": 442}}
+    assert old_entry.batches == {2024: {"一本": 588}}
+
+
+def test_index_keeps_last_good_version_on_parse_error(tmp_path):
+    """A half-written file doesn't evict the previously loaded data."""
+    path = _write_province(tmp_path, "江苏", [{"year": 2024, "batches": {"理科": {"一本": 588}}}], mtime=1000)
+    index = ScoreLineIndex(str(tmp_path), check_interval=0)
+    assert index.get("江苏", "理科") is not None
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"province": "江苏", "yearly_')
+    os.utime(path, (2000, 2000))
+
+    assert index.get("江苏", "理科").batches == {2024: {"一本": 588}}
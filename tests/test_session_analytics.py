@@ -0,0 +1,116 @@
+import os
+import json
+
+import session_analytics
+from session_analytics import SessionAnalytics, summarize_session
+from session_store import SessionStore
+
+# 2025-06-25 12:00 Beijing time
+TS = 1750824000
+
+
+def _question(province):
+    return f"省份: {province}\n科类: 物理\n位次: 4500\n纠结的方案:\n南大还是东南"
+
+
+def _session(store, session_id, province, follow_ups=0, report="报告" * 10):
+    store.append_turn(session_id, [{"role": "user", "content": _question(province)},
+                                   {"role": "assistant", "content": report}])
+    for _ in range(follow_ups):
+        store.append_turn(session_id, [{"role": "user", "content": "那就业呢？"},
+                                       {"role": "assistant", "content": "还行"}])
+
+
+def _set_ts(store, session_id, ts):
+    path = store.path_for(session_id)
+    with open(path, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    with open(path, "w", encoding="utf-8") as f:
+        for record in lines:
+            f.write(json.dumps({**record, "ts": ts}, ensure_ascii=False) + "\n")
+
+
+def test_summarize_session_skips_torn_lines(tmp_path):
+    store = SessionStore(str(tmp_path))
+    _session(store, "s1", "江苏", follow_ups=2)
+    with open(store.path_for("s1"), "a", encoding="utf-8") as f:
+        f.write('{"ts": 1, "messages": [{"role": "us')
+    summary = summarize_session(store.path_for("s1"))
+    assert summary["province"] == "江苏" and summary["turns"] == 3 and summary["report_chars"] == 20
+    assert summarize_session(str(tmp_path / "missing.jsonl")) is None
+
+
+def test_refresh_aggregates_and_only_reparses_changes(tmp_path, monkeypatch):
+    store = SessionStore(str(tmp_path / "sessions"))
+    _session(store, "a", "江苏", follow_ups=1)
+    _session(store, "b", "江苏")
+    _session(store, "c", "上海", report="短")
+    for session_id in "abc":
+        _set_ts(store, session_id, TS)
+    analytics = SessionAnalytics(str(tmp_path / "sessions"), str(tmp_path / "cache.json"), str(tmp_path / "summary.json"))
+
+    summary = analytics.refresh()
+    assert summary["overall"] == {"sessions": 3, "turns": 4, "avg_turns": 1.33, "avg_report_chars": 14,
+                                  "follow_up_ratio": 0.333}
+    assert list(summary["by_province"]) == ["江苏", "上海"]
+    assert summary["by_province"]["江苏"]["follow_up_ratio"] == 0.5
+    assert summary["by_day"]["2025-06-25"]["sessions"] == 3
+    assert summary["files_parsed"] == 3
+
+    parsed = []
+    monkeypatch.setattr(session_analytics, "summarize_session",
+                        lambda path: parsed.append(os.path.basename(path)) or summarize_session(path))
+    _session(store, "d", "浙江")
+    store.append_turn("b", [{"role": "user", "content": "还有呢？"}, {"role": "assistant", "content": "没了"}])
+    os.remove(store.path_for("c"))
+
+    # A fresh instance (another worker, or the command line) picks up the same cache file.
+    summary = SessionAnalytics(str(tmp_path / "sessions"), str(tmp_path / "cache.json"),
+                               str(tmp_path / "summary.json")).refresh()
+    assert sorted(parsed) == ["b.jsonl", "d.jsonl"]
+    assert summary["files"] == 3 and summary["overall"]["turns"] == 5
+    assert set(summary["by_province"]) == {"江苏", "浙江"}
+    assert analytics.read_summary() == summary # written by the other instance
+
+
+def test_process_pool_gives_the_same_result(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions"))
+    for n in range(12):
+        _session(store, f"s{n}", ["江苏", "上海", "广东"][n % 3], follow_ups=n % 2)
+    serial = SessionAnalytics(str(tmp_path / "sessions"), str(tmp_path / "serial.json"),
+                              str(tmp_path / "serial-summary.json")).refresh()
+    pooled = SessionAnalytics(str(tmp_path / "sessions"), str(tmp_path / "pooled.json"),
+                              str(tmp_path / "pooled-summary.json"), workers=2, min_parallel=1).refresh()
+    assert pooled["overall"] == serial["overall"] and pooled["by_province"] == serial["by_province"]
+
+
+def test_refresh_runs_in_a_child_process_one_worker_at_a_time(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions"))
+    _session(store, "a", "江苏")
+    analytics = SessionAnalytics(str(tmp_path / "sessions"), str(tmp_path / "cache.json"), str(tmp_path / "summary.json"))
+    assert analytics.read_summary() is None
+    assert analytics.refresh_in_subprocess()
+    assert analytics.read_summary()["overall"]["sessions"] == 1 and analytics.refreshes == 1
+
+    # Another live worker holds the lock: skip. A lock left by a dead process is cleared.
+    (tmp_path / "summary.json.lock").write_text(str(os.getppid()))
+    assert not analytics.refresh_in_subprocess()
+    (tmp_path / "summary.json.lock").write_text("999999999")
+    assert not analytics.refresh_in_subprocess()
+    assert analytics.refresh_in_subprocess() and not (tmp_path / "summary.json.lock").exists()
+
+
+def test_analytics_endpoint(app_module, app_client, admin_code):
+    assert app_client.post('/api/analytics', json={"invitationCode": "nope"}).status_code == 403
+    # An ordinary student code can't read operator data.
+    assert app_client.post('/api/analytics', json={"invitationCode": "ok"}).status_code == 403
+    assert app_client.post('/api/analytics', json={"invitationCode": admin_code}).status_code == 503
+
+    _session(app_module.session_store, "web-1", "江苏", follow_ups=1)
+    app_module.session_analytics.refresh()
+    body = app_client.post('/api/analytics', json={"invitationCode": admin_code}).get_json()
+    assert body["overall"]["sessions"] == 1 and body["by_province"]["江苏"]["avg_turns"] == 2
+
+    # The endpoint only serves the last refresh; it never parses sessions itself.
+    _session(app_module.session_store, "web-2", "江苏")
+    assert app_client.post('/api/analytics', json={"invitationCode": admin_code}).get_json()["overall"]["sessions"] == 1
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import threading
+import multiprocessing
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import session_store
+from session_store import SessionStore, is_valid_session_id
+
+
+def _turn(i):
+    return [{"role": "user", "content": f"question {i}"}, {"role": "assistant", "content": f"answer {i}"}]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SessionStore(str(tmp_path))
+
+
+def test_append_writes_one_line_per_turn(store):
+    for i in range(3):
+        store.append_turn("session-1", _turn(i))
+    with open(store.path_for("session-1"), encoding="utf-8") as f:
+        lines = f.readlines()
+    assert len(lines) == 3
+    assert json.loads(lines[2])["messages"] == _turn(2)
+
+
+def test_load_recent_returns_last_turns(store):
+    for i in range(10):
+        store.append_turn("session-1", _turn(i))
+    assert store.load_recent("session-1", 2) == _turn(8) + _turn(9)
+    assert store.load_recent("session-1", 50) == [m for i in range(10) for m in _turn(i)]
+    assert store.load_all("session-1") == [m for i in range(10) for m in _turn(i)]
+    assert store.load_recent("missing", 3) == []
+
+
+def test_load_recent_reads_only_the_tail(tmp_path, monkeypatch):
+    """A long session is read back in a few blocks, not parsed in full."""
+    monkeypatch.setattr(session_store, "TAIL_BLOCK_SIZE", 256)
+    store = SessionStore(str(tmp_path), cache_turns=3)
+    for i in range(2000):
+        store.append_turn("session-1", _turn(i))
+
+    reads = []
+    real_open = open
+
+    class CountingFile:
+        def __init__(self, f):
+            self._f = f
+
+        def read(self, size=-1):
+            data = self._f.read(size)
+            reads.append(len(data))
+            return data
+
+        def __getattr__(self, name):
+            return getattr(self._f, name)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return self._f.__exit__(*args)
+
+    monkeypatch.setattr("builtins.open", lambda *a, **kw: CountingFile(real_open(*a, **kw)))
+    assert store.load_recent("session-1", 3) == _turn(1997) + _turn(1998) + _turn(1999)
+    assert sum(reads) < 1024 < os.path.getsize(store.path_for("session-1"))
+
+
+def test_torn_line_is_skipped_and_compacted(store):
+    store.append_turn("session-1", _turn(0))
+    with open(store.path_for("session-1"), "a", encoding="utf-8") as f:
+        f.write('{"ts": 1, "messages": [{"role": "us')
+    store.append_turn("session-1", _turn(1))
+
+    assert store.load_all("session-1") == _turn(0) + _turn(1)
+    store.compact("session-1")
+    with open(store.path_for("session-1"), encoding="utf-8") as f:
+        assert len(f.readlines()) == 2
+
+
+def test_files_are_sharded_by_hash_prefix(store, tmp_path):
+    store.append_turn("session-1", _turn(0))
+    shard = SessionStore.shard_for("session-1")
+    assert len(shard) == 2
+    assert os.listdir(tmp_path) == [shard]
+    assert os.path.exists(tmp_path / shard / "session-1.jsonl")
+
+
+def test_legacy_json_is_migrated(store, tmp_path):
+    legacy = _turn(0) + _turn(1) + [{"role": "user", "content": "dangling"}]
+    with open(tmp_path / "session-old.json", "w", encoding="utf-8") as f:
+        json.dump(legacy, f)
+
+    assert store.load_recent("session-old", 1) == [{"role": "user", "content": "dangling"}]
+    assert not os.path.exists(tmp_path / "session-old.json")
+    store.append_turn("session-old", _turn(2))
+    assert store.load_all("session-old") == legacy + _turn(2)
+
+
+def test_migrate_all(store, tmp_path):
+    with open(tmp_path / "a.json", "w", encoding="utf-8") as f:
+        json.dump(_turn(0), f)
+    with open(tmp_path / "b.jsonl", "w", encoding="utf-8") as f:
+        f.write(json.dumps({"ts": 1, "messages": _turn(0)}) + "\n")
+    assert store.migrate_all() == 2
+    assert not any(name.endswith((".json", ".jsonl")) for name in os.listdir(tmp_path))
+    assert store.load_all("a") == _turn(0)
+    assert store.load_all("b") == _turn(0)
+
+
+def _append_many(directory, count):
+    store = SessionStore(directory)
+    for n in range(count):
+        store.append_turn("shared", _turn(n))
+
+
+def _compact_many(directory, count):
+    store = SessionStore(directory)
+    for _ in range(count):
+        store.compact("shared")
+
+
+@pytest.mark.skipif(session_store.fcntl is None, reason="needs flock")
+def test_compaction_in_another_process_never_drops_appends(tmp_path):
+    SessionStore(str(tmp_path)).append_turn("shared", _turn(-1))
+    ctx = multiprocessing.get_context("fork")
+    workers = [ctx.Process(target=_append_many, args=(str(tmp_path), 200)),
+               ctx.Process(target=_compact_many, args=(str(tmp_path), 200))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join(30)
+    assert [w.exitcode for w in workers] == [0, 0]
+    assert len(SessionStore(str(tmp_path)).load_all("shared")) == 2 * 201
+
+
+@pytest.mark.parametrize("content", [b"\xff\xfe not utf-8", b'["hi", "there"]', b'{"broken": '])
+def test_unreadable_legacy_file_is_left_in_place(store, tmp_path, content):
+    (tmp_path / "bad.json").write_bytes(content)
+    assert store.migrate_all() == 0
+    assert (tmp_path / "bad.json").read_bytes() == content
+    store.append_turn("bad", _turn(0)) # new turns still work
+    assert store.load_all("bad") == _turn(0)
+    assert (tmp_path / "bad.json").read_bytes() == content
+
+
+def test_claim_left_by_a_dead_worker_is_recovered(store, tmp_path):
+    with open(tmp_path / "s1.json.999999999.1.migrating", "w", encoding="utf-8") as f:
+        json.dump(_turn(0), f) # that worker crashed mid-migration
+    with open(tmp_path / f"s2.json.{os.getpid()}.1.migrating", "w", encoding="utf-8") as f:
+        json.dump(_turn(1), f) # this one is still running
+    assert store.migrate_all() == 1
+    assert store.load_all("s1") == _turn(0)
+    assert os.path.exists(tmp_path / f"s2.json.{os.getpid()}.1.migrating")
+
+
+def test_workers_migrating_at_once_move_each_file_exactly_once(tmp_path):
+    for n in range(50):
+        with open(tmp_path / f"s{n}.json", "w", encoding="utf-8") as f:
+            json.dump(_turn(n), f)
+    # Separate stores have separate locks, like separate gunicorn workers.
+    workers = [SessionStore(str(tmp_path)) for _ in range(4)]
+    counts, errors = [], []
+
+    def migrate(worker):
+        try:
+            counts.append(worker.migrate_all())
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=migrate, args=(w,)) for w in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == [] and sum(counts) == 50
+    assert all(workers[0].load_all(f"s{n}") == _turn(n) for n in range(50))
+    assert not [name for name in os.listdir(tmp_path) if os.path.isfile(tmp_path / name)]
+
+
+def test_cache_hits_and_stays_fresh(store):
+    for i in range(5):
+        store.append_turn("session-1", _turn(i))
+    assert store.load_recent("session-1", 2) == _turn(3) + _turn(4)
+    assert store.load_recent("session-1", 2) == _turn(3) + _turn(4)
+    stats = store.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+    # A local append extends the cached tail without another read.
+    store.append_turn("session-1", _turn(5))
+    assert store.load_recent("session-1", 2) == _turn(4) + _turn(5)
+    assert store.stats()["hits"] == 2
+
+
+def test_cache_notices_writes_from_other_processes(store, tmp_path):
+    store.append_turn("session-1", _turn(0))
+    store.load_recent("session-1", 3)
+
+    other_worker = SessionStore(str(tmp_path))
+    other_worker.append_turn("session-1", _turn(1))
+
+    assert store.load_recent("session-1", 3) == _turn(0) + _turn(1)
+    assert store.stats()["misses"] == 2
+
+
+def test_cache_evicts_by_size(tmp_path):
+    store = SessionStore(str(tmp_path), cache_max_bytes=100)
+    big = [{"role": "user", "content": "x" * 40}, {"role": "assistant", "content": "y" * 20}]
+    for session_id in ("a", "b", "c"):
+        store.append_turn(session_id, big)
+        store.load_recent(session_id, 1)
+    stats = store.stats()
+    assert stats["entries"] == 1
+    assert stats["bytes"] <= 100
+    assert stats["evictions"] == 2
+
+
+def test_reaper_removes_idle_sessions(tmp_path):
+    store = SessionStore(str(tmp_path), ttl=3600)
+    store.append_turn("old", _turn(0))
+    store.append_turn("new", _turn(0))
+    store.load_recent("old", 1)
+    os.utime(store.path_for("old"), (1000, 1000))
+
+    assert store.reap_expired(now=1000 + 7200) == 1
+    assert store.load_recent("old", 1) == []
+    assert store.load_recent("new", 1) == _turn(0)
+    assert store.stats()["reaped"] == 1
+
+
+def test_reaper_disabled_without_ttl(store):
+    store.append_turn("old", _turn(0))
+    os.utime(store.path_for("old"), (1000, 1000))
+    assert store.reap_expired() == 0
+
+
+def test_session_id_validation(store):
+    assert is_valid_session_id("session-1750778143887-b3sa1k0")
+    assert not is_valid_session_id("../_data/users")
+    assert not is_valid_session_id(None)
+    with pytest.raises(ValueError):
+        store.append_turn("../_data/users", _turn(0))
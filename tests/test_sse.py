@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import time
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sse import sse_message, DeltaCoalescer, stream_frames
+from think_filter import ThinkFilter
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_sse_message_is_a_single_data_line():
+    frame = sse_message("第一行\n第二行")
+    assert frame.startswith("event: message\ndata: ")
+    assert frame.endswith("\n\n")
+    assert frame.count("\n") == 3
+    assert json.loads(frame.split("data: ", 1)[1]) == "第一行\n第二行"
+
+
+def test_coalescer_batches_by_time():
+    clock = FakeClock()
+    coalescer = DeltaCoalescer(max_delay_ms=50, max_bytes=1024, clock=clock)
+    assert coalescer.push("a") == "a"  # the first delta goes out right away
+    assert coalescer.push("b") is None
+    clock.now += 0.01
+    assert coalescer.push("c") is None
+    clock.now += 0.05
+    assert coalescer.push("d") == "bcd"
+    assert coalescer.push("e") is None
+    assert coalescer.flush() == "e"
+    assert coalescer.flush() is None
+
+
+def test_coalescer_poll_releases_text_once_due():
+    clock = FakeClock()
+    coalescer = DeltaCoalescer(max_delay_ms=500, max_bytes=1024, clock=clock)
+    assert coalescer.time_left() is None
+    coalescer.push("a")
+    coalescer.push("b")
+    clock.now += 0.25
+    assert coalescer.time_left() == 0.25 and coalescer.poll() is None
+    clock.now += 0.25
+    assert coalescer.time_left() == 0 and coalescer.poll() == "b"
+    assert coalescer.time_left() is None and coalescer.poll() is None
+
+
+def test_stalled_stream_is_not_held_back():
+    def stalling():
+        yield "a"
+        yield "b"
+        time.sleep(0.5) # a reasoning pause or slow upstream
+        yield "c"
+
+    started = time.monotonic()
+    sent = []
+    for frame in stream_frames(stalling(), DeltaCoalescer(max_delay_ms=50), ThinkFilter()):
+        sent.append((json.loads(frame.split("data: ", 1)[1]), time.monotonic() - started))
+    assert [text for text, _ in sent] == ["a", "b", "c"]
+    assert sent[1][1] < 0.3 # "b" went out on the deadline, not with "c"
+    assert sent[2][1] >= 0.5
+
+
+def test_closing_frames_early_stops_upstream_iteration():
+    pulled, closed, aborted = [], [], []
+
+    def endless():
+        try:
+            n = 0
+            while True:
+                n += 1
+                pulled.append(n)
+                yield "x"
+                time.sleep(0.005)
+        finally:
+            closed.append(True)
+
+    frames = stream_frames(endless(), DeltaCoalescer(max_delay_ms=20), ThinkFilter(), abort=lambda: aborted.append(True))
+    next(frames)
+    next(frames)
+    frames.close() # the client went away
+    count = len(pulled)
+    time.sleep(0.1)
+    assert len(pulled) <= count + 1 and closed == [True]
+    assert not any(t.name == "sse-deltas" and t.is_alive() for t in threading.enumerate())
+
+
+def test_abort_unblocks_a_reader_waiting_on_the_upstream():
+    release = threading.Event()
+
+    def stalled():
+        yield "a"
+        release.wait(10) # a read that only the upstream being cut off ends
+        raise ConnectionError("hung up")
+
+    frames = stream_frames(stalled(), DeltaCoalescer(max_delay_ms=20), ThinkFilter(), abort=release.set)
+    next(frames)
+    started = time.monotonic()
+    frames.close()
+    assert time.monotonic() - started < 1 and release.is_set()
+
+
+def test_stream_frames_passes_on_upstream_errors():
+    def failing():
+        yield "a"
+        raise ConnectionError("upstream went away")
+
+    frames = stream_frames(failing(), DeltaCoalescer(max_delay_ms=50), ThinkFilter())
+    assert next(frames).endswith('"a"\n\n')
+    with pytest.raises(ConnectionError):
+        next(frames)
+
+
+def test_coalescer_batches_by_size():
+    coalescer = DeltaCoalescer(max_delay_ms=10000, max_bytes=6, clock=FakeClock())
+    coalescer.push("x")
+    assert coalescer.push("好") is None  # 3 bytes
+    assert coalescer.push("好") == "好好"
+
+
+def test_coalescer_disabled_passes_deltas_through():
+    coalescer = DeltaCoalescer(max_delay_ms=0)
+    assert [coalescer.push(t) for t in "abc"] == ["a", "b", "c"]
+    assert coalescer.flush() is None
+
+
+def _frames(body):
+    return [json.loads(block.split("data: ", 1)[1])
+            for block in body.split("\n\n") if block.startswith("event: message")]
+
+
+def _consult(client):
+    return client.post('/api/handler', json={
+        "invitationCode": "ok",
+        "sessionId": "session-a",
+        "userInput": {"rawText": "南京大学还是东南大学？", "province": "江苏", "stream": "物理"},
+    }).get_data(as_text=True)
+
+
+def test_handler_coalesces_token_frames(app_module, app_client, fake_upstream, monkeypatch):
+    fake_upstream.tokens = 40
+    monkeypatch.setattr(app_module, "SSE_COALESCE_MS", 10000)
+    frames = _frames(_consult(app_client))
+    assert "".join(frames) == "好" * 40
+    assert len(frames) < 40
+    assert app_module.load_session_history("session-a")[-1]["content"] == "好" * 40
+
+
+def test_handler_streams_every_token_when_disabled(app_module, app_client, fake_upstream, monkeypatch):
+    monkeypatch.setattr(app_module, "SSE_COALESCE_MS", 0)
+    assert _frames(_consult(app_client)) == ["好", "好", "好"]
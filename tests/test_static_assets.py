@@ -0,0 +1,88 @@
+import gzip
+import os
+
+import static_assets
+from static_assets import StaticAssetStore, choose_encoding, etag_matches, parse_accept_encoding
+
+SCRIPT = b"console.log('hello');\n" * 100
+
+
+def _store(tmp_path, **kwargs):
+    (tmp_path / "index.html").write_text('<link href="style.css?v=1.0"><script src="script.js"></script>',
+                                         encoding="utf-8")
+    (tmp_path / "script.js").write_bytes(SCRIPT)
+    (tmp_path / "style.css").write_bytes(b"body { color: red; }\n" * 50)
+    (tmp_path / "secret.json").write_text("{}")
+    return StaticAssetStore(str(tmp_path), ["index.html", "script.js", "style.css"], check_interval=0, **kwargs)
+
+
+def test_assets_are_precompressed_with_content_etags(tmp_path):
+    store = _store(tmp_path)
+    asset = store.get("script.js")
+    assert asset.content_type.endswith("javascript; charset=utf-8")
+    assert asset.variants["identity"] == SCRIPT
+    assert gzip.decompress(asset.variants["gzip"]) == SCRIPT
+    assert asset.etag == f'"{static_assets.content_version(SCRIPT)}"'
+    assert store.get("secret.json") is None
+    assert store.get("../app.py") is None
+
+
+def test_html_pins_asset_urls_to_content_hashes(tmp_path):
+    store = _store(tmp_path)
+    html = store.get("index.html").variants["identity"].decode()
+    assert f'href="style.css?v={store.get("style.css").version}"' in html
+    assert f'src="script.js?v={store.get("script.js").version}"' in html
+
+    changed = b"console.log('changed');"
+    (tmp_path / "script.js").write_bytes(changed)
+    os.utime(tmp_path / "script.js", ns=(1, 1))
+    html = store.get("index.html").variants["identity"].decode()
+    assert f'src="script.js?v={static_assets.content_version(changed)}"' in html
+
+
+def test_respond_negotiates_encoding_and_caching(tmp_path):
+    store = _store(tmp_path)
+    version = store.get("script.js").version
+    status, body, headers = store.respond("script.js", "gzip, deflate", None, version)
+    assert status == 200 and headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(body) == SCRIPT
+    assert headers["ETag"] == f'"{version}-gzip"' and headers["Vary"] == "Accept-Encoding"
+    assert "immutable" in headers["Cache-Control"]
+
+    status, body, headers = store.respond("script.js", None, None, "stale")
+    assert body == SCRIPT and "Content-Encoding" not in headers
+    assert headers["Cache-Control"] == "no-cache"
+
+    status, body, _ = store.respond("script.js", "gzip", f'"{version}-gzip"')
+    assert (status, body) == (304, b"")
+    assert store.respond("secret.json") is None
+
+
+def test_accept_encoding_parsing():
+    assert parse_accept_encoding("gzip;q=0.5, br, identity;q=0") == {"gzip": 0.5, "br": 1.0, "identity": 0.0}
+    asset = static_assets.StaticAsset("a.js", "", '"v"', "v", {"identity": b"x" * 10, "gzip": b"x" * 6, "br": b"x" * 5}, 0)
+    assert choose_encoding(asset, "gzip, br") == "br"
+    assert choose_encoding(asset, "gzip, br;q=0") == "gzip"
+    assert choose_encoding(asset, "*") == "br"
+    assert choose_encoding(asset, "") == "identity"
+
+
+def test_etag_matching_is_weak():
+    assert etag_matches('W/"abc"', '"abc"')
+    assert etag_matches('"zzz", "abc-br"', '"abc"')
+    assert etag_matches('*', '"abc"')
+    assert not etag_matches('"abd"', '"abc"')
+    assert not etag_matches(None, '"abc"')
+
+
+def test_app_serves_only_allowlisted_assets(app_client):
+    response = app_client.get('/', headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert '<title>高考志愿AI决策顾问</title>' in gzip.decompress(response.data).decode('utf-8')
+    etag = response.headers["ETag"]
+    assert app_client.get('/', headers={"If-None-Match": etag}).status_code == 304
+
+    for path in ('/_data/users.json', '/_data/usage.json', '/images/pc.png', '/app.py', '/.env', '/requests.jsonl'):
+        assert app_client.get(path).status_code == 404, path
+    assert app_client.get('/style.css').status_code == 200
@@ -0,0 +1,118 @@
+import re
+import json
+import threading
+
+import pytest
+
+from stream_buffer import ReplayUnavailable, StreamBuffer, StreamRegistry, parse_event_id
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_follow_replays_then_waits_for_more():
+    buffer = StreamBuffer("s", "owner", max_bytes=1024)
+    for frame in ("a", "b", "c"):
+        buffer.append(frame)
+    reader = buffer.follow(after=1)
+    assert [next(reader), next(reader)] == [(2, "b"), (3, "c")]
+
+    threading.Timer(0.05, lambda: (buffer.append("d"), buffer.finish())).start()
+    assert list(reader) == [(4, "d")]
+
+
+def test_ring_drops_oldest_frames():
+    buffer = StreamBuffer("s", "owner", max_bytes=4)
+    for frame in ("aa", "bb", "cc"):
+        buffer.append(frame)
+    buffer.finish()
+    assert buffer.size == 4 and buffer.dropped == 1
+    assert list(buffer.follow(after=1)) == [(2, "bb"), (3, "cc")]
+    with pytest.raises(ReplayUnavailable):
+        list(buffer.follow(after=0))
+
+
+def test_parse_event_id():
+    assert parse_event_id("abc:12") == ("abc", 12)
+    assert parse_event_id("abc") is None
+    assert parse_event_id(None) is None
+
+
+def test_registry_runs_generation_without_a_reader():
+    registry = StreamRegistry()
+    buffer = registry.start("owner", iter(["x", "y"]))
+    registry.join(5)
+    assert buffer.done and list(buffer.follow()) == [(1, "x"), (2, "y")]
+    assert registry.get(buffer.stream_id, "someone else") is None
+    assert registry.get(buffer.stream_id, "owner") is buffer
+
+
+def test_registry_ttl_and_memory_cap():
+    clock = FakeClock()
+    registry = StreamRegistry(ttl=60, max_bytes=10, stream_max_bytes=4, clock=clock)
+    first = registry.start("o", iter(["1234"]))
+    second = registry.start("o", iter(["1234"]))
+    registry.join(5)
+    clock.now = 30
+    third = registry.start("o", iter([])) # 8 finished + 4 reserved: the oldest finished one goes
+    assert registry.get(first.stream_id, "o") is None and registry.stats()["evicted"] == 1
+    registry.join(5)
+
+    clock.now = 61
+    assert registry.get(second.stream_id, "o") is None # finished 61s ago
+    assert registry.get(third.stream_id, "o") is third
+
+    gate = threading.Event()
+
+    def blocked():
+        gate.wait(5)
+        yield "x"
+
+    assert registry.start("o", blocked()) and registry.start("o", blocked())
+    assert registry.start("o", blocked()) is None # two live rings reserve 8 of 10 bytes
+    assert registry.stats()["unbuffered"] == 1
+    gate.set()
+    registry.join(5)
+
+
+def _consult(client, headers=None):
+    return client.post('/api/handler', headers=headers or {}, buffered=False, json={
+        "invitationCode": "ok", "sessionId": "resume-1",
+        "userInput": {"rawText": "南京大学还是东南大学？", "province": "江苏", "stream": "物理"},
+    })
+
+
+def _messages(body):
+    return "".join(json.loads(block.split("data: ", 1)[1])
+                   for block in body.split("\n\n") if block.startswith("event: message"))
+
+
+def test_reconnect_resumes_without_a_second_generation(app_module, app_client, fake_upstream, monkeypatch):
+    fake_upstream.tokens = 6
+    fake_upstream.token_interval = 0.05
+    monkeypatch.setattr(app_module, "SSE_COALESCE_MS", 0)
+    response = _consult(app_client)
+    chunks = iter(response.response)
+    received = ""
+    while "event: message" not in received:
+        received += next(chunks).decode()
+    response.close() # the phone lost its connection
+
+    last_id = re.findall(r"^id: (\S+)$", received, re.M)[-1]
+    resumed = _consult(app_client, {"Last-Event-ID": last_id}).get_data(as_text=True)
+    assert "event: usage" not in resumed and "event: end" in resumed
+    assert _messages(received) + _messages(resumed) == "好" * 6
+    assert fake_upstream.stats["requests"] == 1
+    assert app_module.get_current_usage() == 1
+    assert app_module.stream_resumes.value(result="resumed") >= 1
+
+
+def test_reconnect_to_unknown_stream_is_gone(app_client):
+    response = _consult(app_client, {"Last-Event-ID": "feedbeef:3"})
+    assert response.status_code == 410
+    assert "error" in response.get_json()
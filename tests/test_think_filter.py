@@ -0,0 +1,108 @@
+import os
+import sys
+import re
+import json
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from think_filter import ThinkFilter, strip_think
+from sse import DeltaCoalescer, stream_frames
+
+
+def _run(deltas):
+    think_filter = ThinkFilter()
+    segments = []
+    for delta in deltas:
+        segments.extend(think_filter.feed(delta))
+    segments.extend(think_filter.finish())
+    reasoning = "".join(text for kind, text in segments if kind == "reasoning")
+    report = "".join(text for kind, text in segments if kind == "report")
+    return think_filter, reasoning, report
+
+
+def _splits(text):
+    """Every way of cutting `text` into two or three deltas."""
+    for i in range(len(text) + 1):
+        yield [text[:i], text[i:]]
+        for j in range(i, len(text) + 1):
+            yield [text[:i], text[i:j], text[j:]]
+
+
+def test_tags_split_at_every_boundary():
+    text = "<think>先分析位次。a<b</think>\n\n## 报告 <br> 完"
+    for deltas in _splits(text):
+        think_filter, reasoning, report = _run(deltas)
+        assert reasoning == "先分析位次。a<b", deltas
+        assert report == "\n\n## 报告 <br> 完", deltas
+        assert think_filter.report == "## 报告 <br> 完"
+
+
+def test_one_character_deltas():
+    text = "<think>x</thi</think>结论<thin"
+    think_filter, reasoning, report = _run(list(text))
+    assert reasoning == "x</thi"
+    # A partial tag left at the end of the stream is plain text.
+    assert report == "结论<thin"
+
+
+def test_repeated_close_tags_are_dropped():
+    # Shape of the reply saved in sessions/: no opening tag and dozens of closing ones.
+    text = "思考过程</think>\n\n" + "</think>\n\n" * 50 + "最终报告"
+    think_filter, reasoning, report = _run([text[i:i + 7] for i in range(0, len(text), 7)])
+    assert think_filter.report == "最终报告"
+    assert reasoning == ""
+    assert think_filter.reasoning_chars == len("思考过程")
+    assert think_filter.stray_tags == 50
+
+
+def test_unterminated_think_is_reasoning():
+    think_filter, reasoning, report = _run(["<think>还没想完"])
+    assert reasoning == "还没想完"
+    assert think_filter.report == ""
+
+
+def test_plain_reply_passes_through():
+    assert strip_think("没有思考标签的回答") == "没有思考标签的回答"
+    assert strip_think("<think>r</think> 报告 ") == "报告"
+
+
+def _events(frames):
+    events = []
+    for frame in frames:
+        head, data = frame.rstrip("\n").split("\n", 1)
+        events.append((head[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+def test_stream_frames_split_think_events():
+    think_filter = ThinkFilter()
+    frames = stream_frames(["<thi", "nk>想", "</th", "ink>答", "案"], DeltaCoalescer(0), think_filter, split_think=True)
+    assert _events(frames) == [("reasoning", "想"), ("message", "答"), ("message", "案")]
+    assert think_filter.report == "答案"
+
+
+def test_stream_frames_keep_raw_text_by_default():
+    think_filter = ThinkFilter()
+    coalescer = DeltaCoalescer(max_delay_ms=10000)
+    frames = list(stream_frames(["<think>想</think>", "答", "案"], coalescer, think_filter))
+    assert "".join(text for _, text in _events(frames)) == "<think>想</think>答案"
+    assert {event for event, _ in _events(frames)} == {"message"}
+    assert think_filter.report == "答案"
+
+
+def test_handler_saves_only_the_report(app_module, app_client, fake_upstream, monkeypatch):
+    fake_upstream.token_source = lambda payload: iter(["<think>先想", "一想</th", "ink>\n\n报告", "</think>"])
+    monkeypatch.setattr(app_module, "SSE_SPLIT_THINK", True)
+    body = app_client.post('/api/handler', json={
+        "invitationCode": "ok",
+        "sessionId": "session-a",
+        "userInput": {"rawText": "南京大学还是东南大学？", "province": "江苏", "stream": "物理"},
+    }).get_data(as_text=True)
+    assert re.search(r"event: reasoning\nid: \S+\ndata: " + re.escape(json.dumps("先想")), body)
+    assert "event: end" in body
+    assert app_module.load_session_history("session-a")[-1]["content"] == "报告"
+
+
+def test_legacy_history_is_cleaned_on_load(app_module):
+    app_module.save_session_turn("session-b", "问题", "</think>\n\n</think>\n\n")
+    assert app_module.load_session_history("session-b")[-1]["content"] == ""
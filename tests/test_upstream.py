@@ -0,0 +1,162 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import upstream
+from upstream import UpstreamScheduler, UpstreamBusyError
+from bench.fake_upstream import FakeUpstream
+
+
+def test_get_client_is_reused_per_endpoint():
+    a = upstream.get_client("key", "http://127.0.0.1:1/v1")
+    assert upstream.get_client("key", "http://127.0.0.1:1/v1") is a
+    assert upstream.get_client("key", "http://127.0.0.1:2/v1") is not a
+
+
+def test_get_client_is_rebuilt_after_fork(monkeypatch):
+    a = upstream.get_client("key", "http://127.0.0.1:1/v1")
+    monkeypatch.setattr(upstream.os, "getpid", lambda: -1)
+    assert upstream.get_client("key", "http://127.0.0.1:1/v1") is not a
+
+
+def test_pooled_client_streams_from_fake_upstream():
+    with FakeUpstream(tokens=5, token_text="好") as fake:
+        client = upstream.get_client("key", fake.base_url)
+        for _ in range(2):
+            with client.chat.completions.create(
+                messages=[{"role": "user", "content": "hi"}], model="fake-model", stream=True
+            ) as stream:
+                text = "".join(chunk.choices[0].delta.content or "" for chunk in stream)
+            assert text == "好" * 5
+        assert fake.stats["requests"] == 2
+        assert fake.last_payload["model"] == "fake-model"
+
+
+def test_gate_caps_in_flight_and_times_out():
+    gate = UpstreamScheduler(1, queue_timeout=0.05)
+    with gate.slot():
+        assert gate.stats()["in_flight"] == 1
+        with pytest.raises(UpstreamBusyError):
+            with gate.slot():
+                pass
+    stats = gate.stats()
+    assert (stats["in_flight"], stats["waiting"], stats["admitted"], stats["timed_out"]) == (0, 0, 1, 1)
+
+
+def test_gate_queues_until_a_slot_frees():
+    gate = UpstreamScheduler(1, queue_timeout=5)
+    entered = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def holder():
+        with gate.slot():
+            entered.set()
+            release.wait()
+            order.append("holder")
+
+    t = threading.Thread(target=holder)
+    t.start()
+    entered.wait()
+    threading.Timer(0.05, release.set).start()
+    with gate.slot():
+        order.append("waiter")
+    t.join()
+    assert order == ["holder", "waiter"]
+
+
+def test_gate_zero_is_unlimited():
+    gate = UpstreamScheduler(0)
+    with gate.slot(), gate.slot():
+        assert gate.stats()["in_flight"] == 2
+
+
+def test_scheduler_rejects_when_queue_is_full():
+    scheduler = UpstreamScheduler(1, queue_timeout=5, max_queue=1)
+    held = scheduler.enqueue()
+    queued = scheduler.enqueue()
+    with pytest.raises(UpstreamBusyError):
+        scheduler.enqueue()
+    assert scheduler.stats()["rejected"] == 1
+    scheduler.release(held)
+    assert queued.granted
+    scheduler.release(queued)
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_scheduler_orders_waiters_by_priority_then_arrival():
+    scheduler = UpstreamScheduler(1, priority_boost=10)
+    held = scheduler.enqueue()
+    first = scheduler.enqueue()
+    second = scheduler.enqueue()
+    vip = scheduler.enqueue(priority=1)
+    assert [scheduler.position(t) for t in (vip, first, second)] == [0, 1, 2]
+
+    scheduler.release(held)
+    assert vip.granted and not first.granted
+    scheduler.release(vip)
+    assert first.granted and not second.granted
+    scheduler.release(first)
+    assert second.granted
+
+
+def test_scheduler_wait_reports_position_and_gives_up_its_place():
+    scheduler = UpstreamScheduler(1, queue_timeout=0.1)
+    held = scheduler.enqueue()
+    scheduler.release(held)  # one finished stream, so there is a service-time estimate
+    held = scheduler.enqueue()
+    ticket = scheduler.enqueue()
+    updates = []
+    with pytest.raises(UpstreamBusyError):
+        for position, eta in scheduler.wait(ticket, poll_interval=0.02):
+            updates.append((position, eta))
+    assert updates[0][0] == 0
+    assert updates[0][1] is not None
+    assert scheduler.stats()["waiting"] == 0
+
+    later = scheduler.enqueue()
+    scheduler.release(held)
+    assert later.granted and not ticket.granted
+
+
+def test_released_waiter_leaves_the_queue():
+    scheduler = UpstreamScheduler(1)
+    held = scheduler.enqueue()
+    gone = scheduler.enqueue()
+    scheduler.release(gone)  # e.g. the client disconnected while queued
+    nxt = scheduler.enqueue()
+    assert scheduler.position(nxt) == 0
+    scheduler.release(held)
+    assert nxt.granted and not gone.granted
+
+
+def test_handler_sends_queued_events(app_module, app_client, fake_upstream, monkeypatch):
+    scheduler = UpstreamScheduler(1, queue_timeout=5)
+    monkeypatch.setattr(app_module, "upstream_scheduler", scheduler)
+    monkeypatch.setattr(app_module, "UPSTREAM_QUEUE_EVENT_INTERVAL", 0.02)
+    held = scheduler.enqueue()
+    threading.Timer(0.1, scheduler.release, args=(held,)).start()
+
+    body = app_client.post('/api/handler', json={
+        "invitationCode": "ok",
+        "userInput": {"rawText": "南京大学还是东南大学？", "province": "江苏", "stream": "物理"},
+    }).get_data(as_text=True)
+    assert body.startswith('event: queued\nid: ')
+    assert 'data: {"position": 0, "eta_seconds": null}' in body.split("\n\n")[0]
+    assert body.index("event: queued") < body.index("event: usage") < body.index("event: end")
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_handler_hides_tracebacks_for_upstream_overload(app_module, app_client, fake_upstream, monkeypatch):
+    fake_upstream.fail_status = 429
+    monkeypatch.setattr(app_module, "UPSTREAM_MAX_RETRIES", 0)
+    body = app_client.post('/api/handler', json={
+        "invitationCode": "ok",
+        "userInput": {"rawText": "南京大学还是东南大学？", "province": "江苏", "stream": "物理"},
+    }).get_data(as_text=True)
+    assert "event: error" in body
+    assert "traceback" not in body
@@ -0,0 +1,139 @@
+import os
+import sys
+import json
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import openai
+from upstream_router import UpstreamRouter, EndpointSpec, NoEndpointAvailable, parse_endpoints
+from bench.fake_upstream import FakeUpstream
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@pytest.fixture
+def servers():
+    with FakeUpstream(tokens=3, token_text="A") as a, FakeUpstream(tokens=3, token_text="B") as b:
+        yield a, b
+
+
+def _spec(name, server):
+    return EndpointSpec(name, server.base_url, "key", "fake-model")
+
+
+def _read(router):
+    with router.open_stream(MESSAGES) as routed:
+        return routed.endpoint.name, "".join(routed)
+
+
+def test_parse_endpoints_falls_back_to_single_endpoint():
+    assert parse_endpoints(None, "key", "http://a/v1", "m") == (EndpointSpec("endpoint-0", "http://a/v1", "key", "m"),)
+    raw = json.dumps([{"name": "x", "base_url": "http://x/v1", "model": "mx"}, {"base_url": "http://y/v1", "api_key": "ky"}])
+    assert parse_endpoints(raw, "key", "http://a/v1", "m") == (
+        EndpointSpec("x", "http://x/v1", "key", "mx"),
+        EndpointSpec("endpoint-1", "http://y/v1", "ky", "m"),
+    )
+    assert parse_endpoints(None, None, "http://a/v1", "m") == ()
+
+
+def test_fails_over_before_the_first_token(servers):
+    a, b = servers
+    a.fail_status = 500
+    router = UpstreamRouter([_spec("a", a), _spec("b", b)], max_retries=0)
+    assert _read(router) == ("b", "BBB")
+    stats = {s["name"]: s for s in router.stats()}
+    assert stats["a"]["failures"] == 1
+    assert stats["b"]["wins"] == 1
+
+
+def test_failing_endpoint_cools_down(servers):
+    a, b = servers
+    a.fail_status = 503
+    router = UpstreamRouter([_spec("a", a), _spec("b", b)], failure_threshold=2, cooldown=60, max_retries=0)
+    _read(router)
+    _read(router)
+    # a has no latency sample and would sort first; only the cooldown keeps it last.
+    assert [h.spec.name for h in router.ranked()] == ["b", "a"]
+    assert a.stats["requests"] == 2
+    _read(router)
+    assert a.stats["requests"] == 2
+
+
+def test_routes_to_the_faster_endpoint(servers):
+    a, b = servers
+    a.first_token_delay = 0.15
+    router = UpstreamRouter([_spec("a", a), _spec("b", b)])
+    _read(router)  # a, never measured yet
+    _read(router)  # b, never measured yet
+    assert [h.spec.name for h in router.ranked()] == ["b", "a"]
+    assert _read(router) == ("b", "BBB")
+
+
+def test_hedges_a_slow_first_token(servers):
+    a, b = servers
+    a.first_token_delay = 1.0
+    router = UpstreamRouter([_spec("a", a), _spec("b", b)], hedge_after=0.05)
+    started = time.monotonic()
+    assert _read(router) == ("b", "BBB")
+    assert time.monotonic() - started < 0.8
+    stats = {s["name"]: s for s in router.stats()}
+    assert stats["b"]["hedges"] == 1
+    assert stats["b"]["wins"] == 1
+    assert stats["a"]["wins"] == 0
+
+
+def test_hedge_loser_is_hung_up_before_its_first_token(servers):
+    a, b = servers
+    a.first_token_delay = 2.0
+    router = UpstreamRouter([_spec("a", a), _spec("b", b)], hedge_after=0.05)
+    started = time.monotonic()
+    assert _read(router) == ("b", "BBB")
+    while a.stats["disconnects"] == 0 and time.monotonic() - started < 1.0:
+        time.sleep(0.01)
+    # a dropped the connection while still waiting to send its first token.
+    assert a.stats["disconnects"] == 1 and a.stats["active_streams"] == 0
+    assert time.monotonic() - started < 1.0
+    assert {s["name"]: s for s in router.stats()}["a"]["failures"] == 0
+
+
+def test_hedge_loser_is_hung_up_when_endpoints_share_a_name(servers):
+    """Attempts are tracked per endpoint, not per configured name."""
+    a, b = servers
+    a.first_token_delay = 2.0
+    router = UpstreamRouter([_spec("same", a), _spec("same", b)], hedge_after=0.05)
+    started = time.monotonic()
+    assert _read(router) == ("same", "BBB")
+    while a.stats["disconnects"] == 0 and time.monotonic() - started < 1.0:
+        time.sleep(0.01)
+    assert a.stats["disconnects"] == 1 and a.stats["active_streams"] == 0
+
+
+def test_raises_when_every_endpoint_fails(servers):
+    a, b = servers
+    a.fail_status = b.fail_status = 429
+    router = UpstreamRouter([_spec("a", a), _spec("b", b)], max_retries=0)
+    with pytest.raises(openai.RateLimitError):
+        _read(router)
+    with pytest.raises(NoEndpointAvailable):
+        UpstreamRouter([]).open_stream(MESSAGES)
+
+
+def test_handler_fails_over_between_configured_endpoints(app_module, app_client, admin_code, servers, monkeypatch):
+    a, b = servers
+    a.fail_status = 500
+    monkeypatch.setattr(app_module, "UPSTREAM_MAX_RETRIES", 0)
+    monkeypatch.setenv("OPENAI_ENDPOINTS", json.dumps([
+        {"name": "a", "base_url": a.base_url}, {"name": "b", "base_url": b.base_url},
+    ]))
+    body = app_client.post('/api/handler', json={
+        "invitationCode": "ok",
+        "userInput": {"rawText": "南京大学还是东南大学？", "province": "江苏", "stream": "物理"},
+    }).get_data(as_text=True)
+    assert "BBB" in "".join(json.loads(line[6:]) for line in body.splitlines()
+                           if line.startswith("data: ") and line[6:].startswith('"'))
+    assert "event: end" in body
+    endpoints = app_client.get('/api/stats', headers={"X-Invitation-Code": admin_code}).get_json()["upstream_endpoints"]
+    assert [e["name"] for e in endpoints] == ["a", "b"]
@@ -0,0 +1,93 @@
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from usage_journal import UsageJournal
+
+
+def _read(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def test_record_does_not_touch_disk_until_flush(tmp_path):
+    """Increments stay in memory and are counted as pending."""
+    path = str(tmp_path / "usage.json")
+    journal = UsageJournal(path, flush_interval=3600, flush_threshold=1000)
+    assert journal.load("2025-06-24") == 0
+    assert _read(path) == {"2025-06-24": 0}
+
+    for count in range(1, 6):
+        journal.record("2025-06-24", count)
+    assert _read(path) == {"2025-06-24": 0}
+    assert journal.stats()["pending_increments"] == 5
+
+    assert journal.flush() is True
+    assert _read(path) == {"2025-06-24": 5}
+    stats = journal.stats()
+    assert stats["pending_increments"] == 0
+    assert stats["last_flush_seconds"] is not None
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_threshold_triggers_background_flush(tmp_path):
+    path = str(tmp_path / "usage.json")
+    journal = UsageJournal(path, flush_interval=3600, flush_threshold=3)
+    journal.load("2025-06-24")
+    for count in range(1, 4):
+        journal.record("2025-06-24", count)
+
+    deadline = time.time() + 2
+    while _read(path) != {"2025-06-24": 3} and time.time() < deadline:
+        time.sleep(0.01)
+    assert _read(path) == {"2025-06-24": 3}
+
+
+def test_interval_triggers_background_flush(tmp_path):
+    path = str(tmp_path / "usage.json")
+    journal = UsageJournal(path, flush_interval=0.05, flush_threshold=1000)
+    journal.load("2025-06-24")
+    journal.record("2025-06-24", 1)
+
+    deadline = time.time() + 2
+    while _read(path) != {"2025-06-24": 1} and time.time() < deadline:
+        time.sleep(0.01)
+    assert _read(path) == {"2025-06-24": 1}
+
+
+def test_load_replays_snapshot_and_leftover_temp_file(tmp_path):
+    """A crash between writing the temp file and renaming it loses nothing."""
+    path = str(tmp_path / "usage.json")
+    with open(path, "w") as f:
+        json.dump({"2025-06-23": 90, "2025-06-24": 7}, f)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"2025-06-24": 9}, f)
+
+    journal = UsageJournal(path)
+    assert journal.load("2025-06-24") == 9
+    assert _read(path) == {"2025-06-24": 9}
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_load_ignores_truncated_temp_file(tmp_path):
+    path = str(tmp_path / "usage.json")
+    with open(path, "w") as f:
+        json.dump({"2025-06-24": 7}, f)
+    with open(path + ".tmp", "w") as f:
+        f.write('{"2025-06-24": ')
+
+    journal = UsageJournal(path)
+    assert journal.load("2025-06-24") == 7
+
+
+def test_new_day_drops_old_counts(tmp_path):
+    path = str(tmp_path / "usage.json")
+    journal = UsageJournal(path)
+    journal.load("2025-06-24")
+    journal.record("2025-06-24", 3)
+    journal.record("2025-06-25", 1)
+    journal.flush()
+    assert _read(path) == {"2025-06-25": 1}
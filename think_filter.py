@@ -0,0 +1,98 @@
+OPEN_TAG = "<think>"
+CLOSE_TAG = "</think>"
+
+
+def strip_think(text):
+    """The report part of a complete reply; see ThinkFilter."""
+    think_filter = ThinkFilter()
+    think_filter.feed(text)
+    think_filter.finish()
+    return think_filter.report
+
+
+class ThinkFilter:
+    """
+    Incremental splitter for `<think>...</think>` reasoning in a streamed reply.
+
+    `feed()` takes each upstream delta and returns `(kind, text)` segments where
+    kind is "reasoning" or "report"; tags split across deltas are held back
+    until they can be told apart from ordinary text. Only the report is kept
+    (see `report`), so memory grows with the answer, not the reasoning.
+
+    Models sometimes drop the opening tag or repeat the closing one. A closing
+    tag before any opening tag marks everything streamed so far as reasoning;
+    any other unmatched tag is discarded.
+    """
+
+    def __init__(self):
+        self._in_think = False
+        self._seen_tag = False
+        self._pending = ""
+        self._report = []
+        self.reasoning_chars = 0
+        self.stray_tags = 0
+
+    def feed(self, delta):
+        text = self._pending + delta
+        self._pending = ""
+        segments = []
+        pos = 0
+        while True:
+            i = text.find("<", pos)
+            if i == -1:
+                self._emit(segments, text[pos:])
+                break
+            self._emit(segments, text[pos:i])
+            rest = text[i:]
+            if rest.startswith(OPEN_TAG):
+                if self._in_think:
+                    self.stray_tags += 1
+                self._in_think = True
+                self._seen_tag = True
+                pos = i + len(OPEN_TAG)
+            elif rest.startswith(CLOSE_TAG):
+                if self._in_think:
+                    self._in_think = False
+                elif not self._seen_tag:
+                    self._reclassify_as_reasoning()
+                else:
+                    self.stray_tags += 1
+                self._seen_tag = True
+                pos = i + len(CLOSE_TAG)
+            elif OPEN_TAG.startswith(rest) or CLOSE_TAG.startswith(rest):
+                self._pending = rest
+                break
+            else:
+                self._emit(segments, "<")
+                pos = i + 1
+        return segments
+
+    def finish(self):
+        """Releases a trailing partial tag as plain text once the stream has ended."""
+        segments = []
+        self._emit(segments, self._pending)
+        self._pending = ""
+        return segments
+
+    @property
+    def report(self):
+        """The reply without any reasoning, as saved to session history."""
+        return "".join(self._report).strip()
+
+    def _reclassify_as_reasoning(self):
+        self.reasoning_chars += sum(len(part) for part in self._report)
+        self._report = []
+
+    def _emit(self, segments, text):
+        if not text:
+            return
+        if self._in_think:
+            kind = "reasoning"
+            self.reasoning_chars += len(text)
+        else:
+            kind = "report"
+            self._report.append(text)
+        if segments and segments[-1][0] == kind:
+            segments[-1] = (kind, segments[-1][1] + text)
+        else:
+            segments.append((kind, text))
@@ -0,0 +1,194 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+import openai
+from openai import OpenAI
+
+
+# Upstream failures that mean "try again later" rather than a bug worth a traceback.
+TRANSIENT_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class UpstreamBusyError(Exception):
+    """Raised when the queue is full or no upstream slot frees up within the queue timeout."""
+
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key, base_url, timeout=120.0, max_retries=2):
+    """
+    Returns the process-wide OpenAI client for an endpoint, creating it once.
+    Reusing it keeps the SDK's keep-alive connection pool warm, so requests skip
+    the TCP and TLS handshake. Clients are rebuilt after a fork, since pooled
+    sockets must not be shared between gunicorn workers.
+    """
+    global _clients, _clients_pid
+    key = (api_key, base_url, timeout, max_retries)
+    if _clients_pid == os.getpid():
+        client = _clients.get(key)
+        if client is not None:
+            return client
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients = {}
+            _clients_pid = os.getpid()
+        client = _clients.get(key)
+        if client is None:
+            client = OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=max_retries)
+            _clients[key] = client
+        return client
+
+
+class _Ticket:
+    __slots__ = ("key", "priority", "granted", "cancelled", "event", "granted_at")
+
+    def __init__(self, key, priority):
+        self.key = key
+        self.priority = priority
+        self.granted = False
+        self.cancelled = False
+        self.event = threading.Event()
+        self.granted_at = None
+
+
+class UpstreamScheduler:
+    """
+    Admission control in front of the upstream: at most `max_in_flight` streams
+    run in this process, the rest wait in a priority queue for up to
+    `queue_timeout` seconds, and once `max_queue` requests are waiting new ones
+    are turned away at once instead of piling up.
+
+    Waiters are ordered by arrival time minus `priority * priority_boost`
+    seconds, so a higher-priority code jumps ahead of recent arrivals without
+    starving older ones. Under gevent the events are cooperative, so waiting
+    doesn't block the worker.
+    """
+
+    def __init__(self, max_in_flight, queue_timeout=30.0, max_queue=0, priority_boost=10.0, clock=time.monotonic):
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.priority_boost = priority_boost
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._heap = [] # [((sort_time, seq), ticket)]; cancelled tickets are skipped when popped
+        self._seq = itertools.count()
+        self._avg_service = None # EWMA of seconds a slot is held
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def enqueue(self, priority=0):
+        """
+        Returns a ticket that is either granted already or waiting in line.
+        Raises UpstreamBusyError if the queue is full.
+        """
+        with self._lock:
+            ticket = _Ticket((self._clock() - priority * self.priority_boost, next(self._seq)), priority)
+            if self.max_in_flight <= 0 or (self.in_flight < self.max_in_flight and not self.waiting):
+                self._grant_locked(ticket)
+                return ticket
+            if self.max_queue and self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise UpstreamBusyError()
+            heapq.heappush(self._heap, (ticket.key, ticket))
+            self.waiting += 1
+            return ticket
+
+    def _grant_locked(self, ticket):
+        ticket.granted = True
+        ticket.granted_at = self._clock()
+        self.in_flight += 1
+        self.admitted += 1
+        ticket.event.set()
+
+    def _grant_next_locked(self):
+        while self._heap and (self.max_in_flight <= 0 or self.in_flight < self.max_in_flight):
+            _, ticket = heapq.heappop(self._heap)
+            if ticket.cancelled:
+                continue
+            self.waiting -= 1
+            self._grant_locked(ticket)
+
+    def wait(self, ticket, poll_interval=1.0):
+        """
+        Generator that waits for `ticket` to be granted, yielding
+        (position, estimated_wait_seconds) right away and then every
+        `poll_interval` seconds while still queued. Raises UpstreamBusyError
+        (and gives up the place in line) after `queue_timeout`.
+        """
+        deadline = self._clock() + self.queue_timeout
+        while not ticket.granted:
+            yield self.position(ticket), self.estimated_wait(ticket)
+            remaining = deadline - self._clock()
+            if remaining > 0:
+                ticket.event.wait(min(poll_interval, remaining))
+            if not ticket.granted and self._clock() >= deadline:
+                with self._lock:
+                    if not ticket.granted:
+                        self._cancel_locked(ticket)
+                        self.timed_out += 1
+                        raise UpstreamBusyError()
+
+    def position(self, ticket):
+        """How many live requests are ahead of `ticket` in the queue."""
+        with self._lock:
+            if ticket.granted:
+                return 0
+            return sum(1 for key, other in self._heap if not other.cancelled and key < ticket.key)
+
+    def estimated_wait(self, ticket):
+        """Seconds until `ticket` is likely to start, from the average slot hold time."""
+        avg = self._avg_service
+        if avg is None or ticket.granted or self.max_in_flight <= 0:
+            return None
+        return round((self.position(ticket) + 1) * avg / self.max_in_flight, 1)
+
+    def _cancel_locked(self, ticket):
+        ticket.cancelled = True
+        self.waiting -= 1
+
+    def release(self, ticket):
+        """Frees a granted slot, or leaves the queue if the ticket is still waiting."""
+        with self._lock:
+            if ticket.cancelled:
+                return
+            if not ticket.granted:
+                self._cancel_locked(ticket)
+                return
+            ticket.cancelled = True # released; a second call is a no-op
+            held = self._clock() - ticket.granted_at
+            self._avg_service = held if self._avg_service is None else 0.8 * self._avg_service + 0.2 * held
+            self.in_flight -= 1
+            self._grant_next_locked()
+
+    @contextmanager
+    def slot(self, priority=0):
+        """Blocking form: holds one upstream slot for the duration of the block."""
+        ticket = self.enqueue(priority)
+        try:
+            for _ in self.wait(ticket, poll_interval=self.queue_timeout or 1.0):
+                pass
+            yield
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_service_seconds": round(self._avg_service, 3) if self._avg_service is not None else None,
+        }
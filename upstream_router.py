@@ -0,0 +1,296 @@
+import json
+import time
+import queue
+import socket
+import threading
+from collections import namedtuple
+
+from upstream import get_client
+
+EndpointSpec = namedtuple('EndpointSpec', ['name', 'base_url', 'api_key', 'model'])
+
+
+def parse_endpoints(raw, default_api_key=None, default_base_url=None, default_model=None):
+    """
+    Builds the endpoint list from `OPENAI_ENDPOINTS` (a JSON list of objects with
+    `base_url` and optional `name`, `api_key`, `model`), falling back to the
+    single `OPENAI_API_BASE` endpoint. Missing keys and models fall back to the
+    defaults. Returns a tuple of EndpointSpec; empty if nothing is configured.
+    """
+    entries = json.loads(raw) if raw else []
+    if not entries and default_base_url:
+        entries = [{"base_url": default_base_url}]
+    specs = []
+    for i, entry in enumerate(entries):
+        base_url = entry.get("base_url")
+        api_key = entry.get("api_key") or default_api_key
+        if not base_url or not api_key:
+            continue
+        specs.append(EndpointSpec(entry.get("name") or f"endpoint-{i}", base_url, api_key,
+                                  entry.get("model") or default_model))
+    return tuple(specs)
+
+
+def _hang_up(stream):
+    """
+    Closes an upstream stream another thread may be blocked reading. Closing
+    the response alone doesn't wake a read waiting for the first byte, so the
+    socket is shut down first through httpx's documented "network_stream"
+    response extension; the read then fails at once.
+    """
+    response = stream.response
+    network_stream = response.extensions.get("network_stream")
+    sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+class NoEndpointAvailable(Exception):
+    """Every endpoint failed before sending a first token."""
+
+
+class _EndpointHealth:
+    __slots__ = ("spec", "ewma_ttft", "consecutive_failures", "cooldown_until",
+                 "requests", "failures", "wins", "hedges")
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.ewma_ttft = None
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.wins = 0
+        self.hedges = 0
+
+
+class RoutedStream:
+    """The winning upstream stream: iterates content deltas, starting with the first token."""
+
+    def __init__(self, router, health, stream, chunks, first_content):
+        self.router = router
+        self.endpoint = health.spec
+        self._health = health
+        self._stream = stream
+        self._chunks = chunks
+        self._first = first_content
+
+    def __iter__(self):
+        if self._first:
+            yield self._first
+        try:
+            for chunk in self._chunks:
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield content
+        except Exception:
+            # Too late to fail over once tokens went out, but the endpoint is still suspect.
+            self.router._record_failure(self._health)
+            raise
+
+    def close(self):
+        self._stream.close()
+
+    def abort(self):
+        """Closes the stream from another thread, waking a read blocked on it; for early exits only."""
+        _hang_up(self._stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class UpstreamRouter:
+    """
+    Picks an upstream endpoint per request and fails over until a first token
+    arrives.
+
+    Endpoints are tried fastest first, by a moving average of their
+    time-to-first-token. After `failure_threshold` failures in a row an
+    endpoint cools down for `cooldown` seconds and is only used when nothing
+    else is left. With `hedge_after` > 0, a request that has not produced a
+    token after that many seconds is raced against the next endpoint; the
+    first to answer wins and the other is closed.
+    """
+
+    def __init__(self, specs, hedge_after=0.0, failure_threshold=3, cooldown=30.0,
+                 timeout=120.0, max_retries=2, clock=time.monotonic):
+        self.specs = tuple(specs)
+        self.hedge_after = hedge_after
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._clock = clock
+        self._health = [_EndpointHealth(spec) for spec in self.specs]
+        self._lock = threading.Lock()
+
+    def ranked(self):
+        """Endpoints in the order they should be tried."""
+        now = self._clock()
+        with self._lock:
+            return sorted(self._health, key=lambda h: (
+                h.cooldown_until > now,
+                h.ewma_ttft if h.ewma_ttft is not None else 0.0,
+            ))
+
+    def _record_success(self, health, ttft):
+        with self._lock:
+            health.consecutive_failures = 0
+            health.cooldown_until = 0.0
+            health.ewma_ttft = ttft if health.ewma_ttft is None else 0.7 * health.ewma_ttft + 0.3 * ttft
+
+    def _record_failure(self, health):
+        with self._lock:
+            health.failures += 1
+            health.consecutive_failures += 1
+            if health.consecutive_failures >= self.failure_threshold:
+                health.cooldown_until = self._clock() + self.cooldown
+
+    def _attempt(self, health, messages, race, results, streams):
+        """
+        Runs one upstream request up to its first token and reports to `results`.
+        The open stream is kept in `streams` so the race can hang it up.
+        """
+        spec = health.spec
+        started = self._clock()
+        with self._lock:
+            health.requests += 1
+        try:
+            client = get_client(spec.api_key, spec.base_url, timeout=self.timeout, max_retries=self.max_retries)
+            stream = client.chat.completions.create(messages=messages, model=spec.model, stream=True)
+        except Exception as e:
+            self._record_failure(health)
+            results.put((health, None, None, None, e))
+            return
+        with self._lock:
+            lost = race.is_set()
+            if not lost:
+                streams[health] = stream
+        if lost:
+            stream.close()
+            return
+        try:
+            chunks = iter(stream)
+            first = None
+            for chunk in chunks:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    first = chunk.choices[0].delta.content
+                    break
+                if race.is_set():
+                    # Another endpoint already won; stop reading this one.
+                    stream.close()
+                    return
+        except Exception as e:
+            stream.close()
+            if race.is_set():
+                return # hung up because another endpoint won, not the endpoint's fault
+            self._record_failure(health)
+            results.put((health, None, None, None, e))
+            return
+        self._record_success(health, self._clock() - started)
+        with self._lock:
+            lost = race.is_set()
+            race.set()
+        if lost:
+            stream.close()
+        else:
+            results.put((health, stream, chunks, first, None))
+
+    def open_stream(self, messages):
+        """
+        Returns a RoutedStream from the first endpoint to produce a token.
+        Raises the last upstream error (or NoEndpointAvailable) if all fail.
+        """
+        candidates = self.ranked()
+        if not candidates:
+            raise NoEndpointAvailable("no upstream endpoints configured")
+        race = threading.Event()
+        results = queue.Queue()
+        streams = {} # _EndpointHealth -> stream of every attempt still running
+        in_flight = 0
+        hedged = False
+        last_error = None
+        deadline = self._clock() + self.timeout * (1 + self.max_retries) + 1
+
+        def launch(health):
+            if self.hedge_after <= 0:
+                # Nothing to race against, so no need for a thread.
+                self._attempt(health, messages, race, results, streams)
+                return
+            threading.Thread(target=self._attempt, args=(health, messages, race, results, streams),
+                             name=f"upstream-{health.spec.name}", daemon=True).start()
+
+        launch(candidates.pop(0))
+        in_flight += 1
+        while True:
+            can_hedge = self.hedge_after > 0 and not hedged and candidates
+            wait = self.hedge_after if can_hedge else max(deadline - self._clock(), 0)
+            try:
+                health, stream, chunks, first, error = results.get(timeout=wait)
+            except queue.Empty:
+                if can_hedge:
+                    hedged = True
+                    health = candidates.pop(0)
+                    with self._lock:
+                        health.hedges += 1
+                    launch(health)
+                    in_flight += 1
+                    continue
+                self._abandon(race, results, streams)
+                raise last_error or NoEndpointAvailable("upstream timed out before the first token")
+            in_flight -= 1
+            if error is None:
+                with self._lock:
+                    health.wins += 1
+                    losers = [s for s in streams.values() if s is not stream]
+                    streams.clear()
+                # A loser still waiting for its first token holds a connection and a billed generation.
+                for loser in losers:
+                    _hang_up(loser)
+                return RoutedStream(self, health, stream, chunks, first)
+            last_error = error
+            print(f"Upstream endpoint {health.spec.name} failed before the first token: {error!r}")
+            if candidates and in_flight == 0:
+                launch(candidates.pop(0))
+                in_flight += 1
+            elif in_flight == 0:
+                raise last_error
+
+    def _abandon(self, race, results, streams):
+        """Stops a race nobody is waiting for any more, hanging up every attempt still running."""
+        with self._lock:
+            race.set()
+            running = list(streams.values())
+            streams.clear()
+        for stream in running:
+            _hang_up(stream)
+        while True:
+            try:
+                _, stream, _, _, _ = results.get_nowait()
+            except queue.Empty:
+                return
+            if stream is not None:
+                stream.close()
+
+    def stats(self):
+        now = self._clock()
+        with self._lock:
+            return [{
+                "name": h.spec.name,
+                "model": h.spec.model,
+                "requests": h.requests,
+                "failures": h.failures,
+                "wins": h.wins,
+                "hedges": h.hedges,
+                "ewma_ttft_ms": round(h.ewma_ttft * 1000, 1) if h.ewma_ttft is not None else None,
+                "cooling_down": h.cooldown_until > now,
+            } for h in self._health]
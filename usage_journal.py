@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import threading
+
+
+class UsageJournal:
+    """
+    Write-behind persistence for the daily usage counts in `usage.json`.
+
+    `record()` only updates memory; a background thread writes a snapshot every
+    `flush_interval` seconds, or sooner once `flush_threshold` increments are
+    pending. Snapshots go to a temp file that is renamed over the real one, so a
+    crash loses at most one flush window and never leaves a truncated file.
+    """
+
+    def __init__(self, path, flush_interval=2.0, flush_threshold=20):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._counts = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+        self._last_flush_seconds = None
+        self._last_flush_at = None
+        self._flushes = 0
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (json.JSONDecodeError, FileNotFoundError):
+            return {}
+
+    def load(self, today_str):
+        """
+        Replays the last snapshot (and a temp file left by a crash mid-flush) and
+        returns today's count. Days other than today are dropped.
+        """
+        replayed = self._read(self.path)
+        for day, count in self._read(self.tmp_path).items():
+            replayed[day] = max(replayed.get(day, 0), count)
+
+        with self._lock:
+            self._counts = {today_str: replayed.get(today_str, 0)}
+            self._pending = 0
+        if replayed != self._counts or not os.path.exists(self.path):
+            self.flush()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        return self._counts[today_str]
+
+    def has_day(self, day):
+        return day in self._counts
+
+    def record(self, day, count):
+        """Notes the latest usage count for `day`; persisted by the next flush."""
+        with self._lock:
+            if day not in self._counts:
+                self._counts = {day: count}
+            else:
+                self._counts[day] = count
+            self._pending += 1
+            pending = self._pending
+        self._ensure_flusher()
+        if pending >= self.flush_threshold:
+            self._wake.set()
+
+    def flush(self):
+        """Atomically writes the current counts to disk if anything changed."""
+        with self._write_lock:
+            with self._lock:
+                snapshot = dict(self._counts)
+                flushed = self._pending
+                self._pending = 0
+
+            started = time.perf_counter()
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                with open(self.tmp_path, 'w') as f:
+                    json.dump(snapshot, f, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(self.tmp_path, self.path)
+            except OSError as e:
+                print(f"Error flushing usage journal: {e}")
+                with self._lock:
+                    self._pending += flushed
+                return False
+
+            self._last_flush_seconds = time.perf_counter() - started
+            self._last_flush_at = time.time()
+            self._flushes += 1
+            return True
+
+    def close(self):
+        """Flushes anything still pending; registered to run at interpreter exit."""
+        if self._pending:
+            self.flush()
+
+    def _ensure_flusher(self):
+        # Also restart after a fork: threads don't survive into gunicorn workers.
+        if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+            return
+        with self._write_lock:
+            if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="usage-journal", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._pending:
+                self.flush()
+
+    def stats(self):
+        return {
+            "pending_increments": self._pending,
+            "last_flush_seconds": self._last_flush_seconds,
+            "last_flush_at": self._last_flush_at,
+            "flushes": self._flushes,
+        }